@@ -0,0 +1,160 @@
+"""
+Work order update latency while heavy report and list traffic overloads
+the service, without and with admission control (ADMISSION_LIMITS).
+
+Field clients update work orders at a steady pace while heavy clients
+request /reports/plans and the full /work_orders list back to back. The
+update p50/p99 latency and the heavy requests served and shed with 503
+are reported. The service runs on a gevent WSGIServer in this process.
+
+usage (with the planner package installed or on PYTHONPATH):
+    python benchmarks/bench_admission.py [--heavy N] [--field N]
+        [--duration S] [--tasks N] [--work-orders N] [--dir DIR]
+"""
+from gevent import monkey
+# Sockets only, the db pool runs SQLAlchemy on native threads
+monkey.patch_all(thread = False)
+
+import argparse
+import gevent
+import httplib
+import json
+import os
+import random
+import tempfile
+import time
+
+import planner.views
+from planner import models, utils
+
+# Limits of the run with admission control
+LIMITS = {'read': (2, 2), 'report': (1, 1), 'write': (16, 64)}
+
+
+def percentile(latencies, pct):
+    latencies = sorted(latencies)
+    if not latencies:
+        return 0
+    return latencies[int(round(pct / 100.0 * (len(latencies) - 1)))]
+
+
+def seed(app, tasks, work_orders):
+    """
+    @return ids of the work orders
+    """
+    client = app.test_client()
+    with utils.db_session() as session:
+        item = models.Inventory('bench', 10 ** 9)
+        session.add(item)
+        session.flush()
+        prod_id = item.id
+
+    rv = client.post('/plans', data = json.dumps({'name': 'bench'}),
+                     content_type = 'application/json')
+    plan = json.loads(rv.data)
+    rv = client.post('/plans/%d/tasks/batch' % plan['id'],
+                     data = json.dumps([{'prod_id': prod_id,
+                                         'quantity': 10 ** 6,
+                                         'work_orders': [{'target_quantity':
+                                                          10}] * work_orders}]
+                                       * tasks),
+                     content_type = 'application/json')
+    return [wo['id'] for task in json.loads(rv.data)
+            for wo in task['work_orders']]
+
+
+def run(port, work_orders, heavy, field, duration):
+    """
+    @return (update latencies, updates shed, heavy served, heavy shed)
+    """
+    deadline = time.time() + duration
+    latencies = []
+    counts = {'update_shed': 0, 'served': 0, 'shed': 0}
+
+    def request(conn, method, url, body = None):
+        conn.request(method, url, body, {'Content-Type': 'application/json'})
+        rv = conn.getresponse()
+        rv.read()
+        return rv.status
+
+    def field_client():
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        while time.time() < deadline:
+            start = time.time()
+            status = request(conn, 'PUT', '/work_orders/%d'
+                             % random.choice(work_orders),
+                             json.dumps({'actual_quantity':
+                                         random.randint(1, 10)}))
+            if status == 503:
+                counts['update_shed'] += 1
+            else:
+                latencies.append(time.time() - start)
+            gevent.sleep(0.05)
+
+    def heavy_client(i):
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        url = '/reports/plans' if i % 2 else '/work_orders'
+        while time.time() < deadline:
+            if request(conn, 'GET', url) == 503:
+                counts['shed'] += 1
+                gevent.sleep(0.01)
+            else:
+                counts['served'] += 1
+
+    gevent.joinall([gevent.spawn(field_client) for i in range(field)] +
+                   [gevent.spawn(heavy_client, i) for i in range(heavy)],
+                   raise_error = True)
+    return latencies, counts['update_shed'], counts['served'], counts['shed']
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+    parser.add_argument('--heavy', type = int, default = 32,
+                        help = 'report and list clients')
+    parser.add_argument('--field', type = int, default = 4,
+                        help = 'work order update clients')
+    parser.add_argument('--duration', type = float, default = 10)
+    parser.add_argument('--tasks', type = int, default = 100)
+    parser.add_argument('--work-orders', type = int, default = 10,
+                        help = 'work orders per task')
+    parser.add_argument('--dir', default = None,
+                        help = 'directory of the benchmark db')
+    args = parser.parse_args()
+
+    app = planner.views.app
+    print '%-10s %9s %9s %9s %12s %10s' % ('admission', 'updates', 'p50 ms',
+                                          'p99 ms', 'heavy served',
+                                          'heavy shed')
+    for limits in ({}, LIMITS):
+        fd, path = tempfile.mkstemp(dir = args.dir)
+        server = None
+        try:
+            app.config['DATABASE'] = path
+            app.config['ADMISSION_LIMITS'] = limits
+            planner.views.configure_db(app)
+            models.init_db()
+            work_orders = seed(app, args.tasks, args.work_orders)
+
+            server = planner.views.WSGIServer(('127.0.0.1', 0), app,
+                                              log = None)
+            server.start()
+            latencies, update_shed, served, shed = run(
+                server.server_port, work_orders, args.heavy, args.field,
+                args.duration)
+            assert not update_shed, '%d updates shed' % update_shed
+            print '%-10s %9d %9.1f %9.1f %12d %10d' % (
+                'on' if limits else 'off', len(latencies),
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000, served, shed)
+        finally:
+            if server is not None:
+                server.stop()
+            models.engine.dispose()
+            os.close(fd)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
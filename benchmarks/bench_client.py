@@ -0,0 +1,130 @@
+"""
+Wall-clock time to seed and report a large plan through the REST API, the
+way scripts did it (sequential calls on a new connection each, one
+resource per call) and with the planner console client (keep-alive
+connections, concurrent calls, batch and report endpoints).
+
+The service runs on a gevent WSGIServer in this process, against a fresh
+sqlite db per run.
+
+usage (with the planner package installed or on PYTHONPATH):
+    python benchmarks/bench_client.py [--tasks N] [--work-orders N]
+        [--concurrency N] [--no-batch] [--dir DIR]
+"""
+from gevent import monkey
+# Sockets only, the db pool runs SQLAlchemy on native threads
+monkey.patch_all(thread = False)
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import urllib2
+
+import planner.views
+from planner import client, models, utils
+
+
+def naive_call(base, method, path, payload = None):
+    request = urllib2.Request(base + path, json.dumps(payload)
+                              if payload is not None else None,
+                              {'Content-Type': 'application/json'})
+    request.get_method = lambda: method
+    return json.loads(urllib2.urlopen(request).read())
+
+
+def naive(base, prod_id, tasks, work_orders):
+    """
+    @return (seconds to seed, seconds to report)
+    """
+    start = time.time()
+    plan = naive_call(base, 'POST', '/plans', {'name': 'bench'})
+    for i in range(tasks):
+        task = naive_call(base, 'POST', '/plans/%d/tasks' % plan['id'],
+                          {'prod_id': prod_id, 'quantity': work_orders})
+        for j in range(work_orders):
+            naive_call(base, 'POST', '/tasks/%d/work_order' % task['id'],
+                       {'target_quantity': 1})
+    seeded = time.time()
+
+    rows = []
+    for task in naive_call(base, 'GET', '/plans/%d/tasks' % plan['id']):
+        wos = naive_call(base, 'GET', '/tasks/%d/work_orders' % task['id'])
+        rows.append((task['id'], task['target_quantity'],
+                     sum(wo['actual_quantity'] for wo in wos)))
+    naive_call(base, 'GET', '/inventory/%d' % prod_id)
+    return seeded - start, time.time() - seeded
+
+
+def with_client(base, prod_id, tasks, work_orders, concurrency, batch):
+    """
+    @return (seconds to seed, seconds to report)
+    """
+    planner_client = client.PlannerClient(base, concurrency)
+    planner_client.batch = planner_client.reports = batch
+    try:
+        start = time.time()
+        plan = planner_client.create_plan(
+            'bench', [{'prod_id': prod_id, 'quantity': work_orders,
+                       'work_orders': [1] * work_orders}] * tasks)
+        seeded = time.time()
+        planner_client.report(plan['id'])
+        return seeded - start, time.time() - seeded
+    finally:
+        planner_client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+    parser.add_argument('--tasks', type = int, default = 200)
+    parser.add_argument('--work-orders', type = int, default = 10,
+                        help = 'work orders per task')
+    parser.add_argument('--concurrency', type = int, default = 8)
+    parser.add_argument('--no-batch', action = 'store_true',
+                        help = 'client without the batch and report '
+                        'endpoints')
+    parser.add_argument('--dir', default = None,
+                        help = 'directory of the benchmark db')
+    args = parser.parse_args()
+
+    app = planner.views.app
+    print '%-8s %10s %10s %10s' % ('mode', 'seed s', 'report s', 'total s')
+    for mode in ('naive', 'client'):
+        fd, path = tempfile.mkstemp(dir = args.dir)
+        server = None
+        try:
+            app.config['DATABASE'] = path
+            planner.views.configure_db(app)
+            models.init_db()
+            with utils.db_session() as session:
+                item = models.Inventory('bench', 10 ** 9)
+                session.add(item)
+                session.flush()
+                prod_id = item.id
+
+            server = planner.views.WSGIServer(('127.0.0.1', 0), app,
+                                              log = None)
+            server.start()
+            base = 'http://127.0.0.1:%d' % server.server_port
+            if mode == 'naive':
+                seed, report = naive(base, prod_id, args.tasks,
+                                     args.work_orders)
+            else:
+                seed, report = with_client(base, prod_id, args.tasks,
+                                           args.work_orders, args.concurrency,
+                                           not args.no_batch)
+            print '%-8s %10.2f %10.2f %10.2f' % (mode, seed, report,
+                                                 seed + report)
+        finally:
+            if server is not None:
+                server.stop()
+            models.engine.dispose()
+            os.close(fd)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""
+Benchmark every planner endpoint against a synthetic dataset.
+
+The dataset (plans x tasks x work orders, products) is seeded into a fresh
+sqlite db. Every route is then driven through the Flask test client and
+through a gevent WSGIServer with concurrent greenlet clients. Throughput
+and p50/p95/p99 latency are reported per endpoint and saved as JSON, which
+a later run can be compared against to catch regressions.
+
+usage (with the planner package installed or on PYTHONPATH):
+    python benchmarks/bench_endpoints.py [--plans N] [--tasks N]
+        [--work-orders N] [--products N] [--requests N] [--concurrency N]
+        [--mode client|server|both] [--group-commit] [--output FILE]
+        [--compare FILE]
+"""
+from gevent import monkey
+# Sockets only, the db pool runs SQLAlchemy on native threads
+monkey.patch_all(thread = False)
+
+import argparse
+import gevent
+import gevent.pool
+import httplib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import planner.views
+from planner import models, utils
+
+
+def percentile(latencies, pct):
+    """
+    @param latencies sorted list
+    """
+    if not latencies:
+        return 0
+    index = int(round(pct / 100.0 * (len(latencies) - 1)))
+    return latencies[index]
+
+
+def summarize(latencies, elapsed, errors):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+class Client(object):
+    """
+    JSON calls through the Flask test client, used to seed the dataset
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def call(self, method, url, payload = None):
+        rv = self.client.open(url, method = method,
+                              data = json.dumps(payload),
+                              content_type = 'application/json')
+        if rv.status_code != 200:
+            raise RuntimeError('%s %s: %s %s' % (method, url, rv.status_code,
+                                                 rv.data))
+        return json.loads(rv.data)
+
+
+def seed(client, args):
+    """
+    Create the synthetic dataset
+
+    @return dict of the ids of the seeded products, plans, tasks and work
+    orders
+    """
+    lines = ['bench%d,%d' % (i, 10 ** 9) for i in range(args.products)]
+    utils.import_inventory(lines)
+    products = [item['id'] for item in client.call('GET', '/inventory')]
+
+    ctx = {'products': products, 'plans': [], 'tasks': [], 'work_orders': []}
+    for i in range(args.plans):
+        plan = client.call('POST', '/plans', {'name': 'bench %d' % i})
+        ctx['plans'].append(plan['id'])
+
+        payload = [{'prod_id': products[j % len(products)],
+                    'quantity': 10 ** 6,
+                    'work_orders': [{'target_quantity': 1}] * args.work_orders}
+                   for j in range(args.tasks)]
+        for task in client.call('POST', '/plans/%d/tasks/batch' % plan['id'],
+                                payload):
+            ctx['tasks'].append(task['id'])
+            ctx['work_orders'].extend(wo['id']
+                                      for wo in task.get('work_orders', []))
+    return ctx
+
+
+def endpoints(client, ctx, num_requests):
+    """
+    Every route of the service as (name, method, url(i), payload(i)).
+    Resources deleted by the benchmark are created up front.
+    """
+    def pick(key):
+        return lambda i: ctx[key][i % len(ctx[key])]
+
+    product, plan, task, wo = (pick('products'), pick('plans'),
+                               pick('tasks'), pick('work_orders'))
+
+    # Fresh resources for the delete endpoints
+    new_plans = [client.call('POST', '/plans', {'name': 'delete'})['id']
+                 for i in range(num_requests)]
+    new_tasks = [t['id'] for t in client.call(
+            'POST', '/plans/%d/tasks/batch' % ctx['plans'][0],
+            [{'prod_id': ctx['products'][0], 'quantity': 1}] * num_requests)]
+    new_wos = [client.call('POST', '/tasks/%d/work_order' % ctx['tasks'][0],
+                           {'target_quantity': 1})['id']
+               for i in range(num_requests)]
+    import_body = '\n'.join('bench%d,%d' % (i, 10 ** 9) for i in range(100))
+
+    return [
+        ('GET /inventory', 'GET', lambda i: '/inventory', None),
+        ('GET /inventory/<id>', 'GET',
+         lambda i: '/inventory/%d' % product(i), None),
+        ('GET /plans', 'GET', lambda i: '/plans', None),
+        ('GET /plans/<id>', 'GET', lambda i: '/plans/%d' % plan(i), None),
+        ('GET /plans/<id>/tasks', 'GET',
+         lambda i: '/plans/%d/tasks' % plan(i), None),
+        ('GET /tasks', 'GET', lambda i: '/tasks', None),
+        ('GET /tasks/<id>', 'GET', lambda i: '/tasks/%d' % task(i), None),
+        ('GET /tasks/<id>/work_orders', 'GET',
+         lambda i: '/tasks/%d/work_orders' % task(i), None),
+        ('GET /work_orders', 'GET', lambda i: '/work_orders', None),
+        ('GET /work_orders/<id>', 'GET',
+         lambda i: '/work_orders/%d' % wo(i), None),
+        ('GET /reports/plan/<id>', 'GET',
+         lambda i: '/reports/plan/%d' % plan(i), None),
+        ('GET /reports/plans', 'GET', lambda i: '/reports/plans', None),
+        ('POST /plans', 'POST', lambda i: '/plans',
+         lambda i: {'name': 'bench %d' % i}),
+        ('POST /plans/<id>/tasks', 'POST',
+         lambda i: '/plans/%d/tasks' % plan(i),
+         lambda i: {'prod_id': product(i), 'quantity': 10}),
+        ('POST /plans/<id>/tasks/batch', 'POST',
+         lambda i: '/plans/%d/tasks/batch' % plan(i),
+         lambda i: [{'prod_id': product(i), 'quantity': 10,
+                     'work_orders': [{'target_quantity': 1}] * 5}] * 10),
+        ('PUT /tasks/<id>', 'PUT', lambda i: '/tasks/%d' % task(i),
+         lambda i: {'target_quantity': 10 ** 6}),
+        ('POST /tasks/<id>/work_order', 'POST',
+         lambda i: '/tasks/%d/work_order' % task(i),
+         lambda i: {'target_quantity': 1}),
+        ('POST /tasks/<id>/work_orders/batch', 'POST',
+         lambda i: '/tasks/%d/work_orders/batch' % task(i),
+         lambda i: [{'target_quantity': 1}] * 10),
+        ('PUT /work_orders/<id>', 'PUT', lambda i: '/work_orders/%d' % wo(i),
+         lambda i: {'actual_quantity': 1 + i % 5}),
+        ('DELETE /work_orders/<id>', 'DELETE',
+         lambda i: '/work_orders/%d' % new_wos[i], None),
+        ('DELETE /tasks/<id>', 'DELETE',
+         lambda i: '/tasks/%d' % new_tasks[i], None),
+        ('DELETE /plans/<id>', 'DELETE',
+         lambda i: '/plans/%d' % new_plans[i], None),
+        ('POST /inventory/import', 'POST', lambda i: '/inventory/import',
+         lambda i: import_body),
+    ]
+
+
+def encode(payload):
+    if payload is None or isinstance(payload, str):
+        return payload
+    return json.dumps(payload)
+
+
+def run_client(app, spec, num_requests):
+    """
+    Drive one endpoint sequentially through the Flask test client
+    """
+    name, method, url, payload = spec
+    client = app.test_client()
+    latencies = []
+    errors = 0
+
+    start = time.time()
+    for i in range(num_requests):
+        req_start = time.time()
+        rv = client.open(url(i), method = method,
+                         data = encode(payload(i) if payload else None),
+                         content_type = 'application/json')
+        latencies.append(time.time() - req_start)
+        if rv.status_code >= 400:
+            errors += 1
+    return summarize(latencies, time.time() - start, errors)
+
+
+def run_server(port, spec, num_requests, concurrency):
+    """
+    Drive one endpoint through the WSGI server from concurrent greenlets,
+    each reusing a keep-alive connection
+    """
+    name, method, url, payload = spec
+    latencies = []
+    errors = [0]
+    requests = iter(range(num_requests))
+
+    def worker():
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        for i in requests:
+            req_start = time.time()
+            conn.request(method, url(i),
+                         body = encode(payload(i) if payload else None),
+                         headers = {'Content-Type': 'application/json'})
+            res = conn.getresponse()
+            res.read()
+            latencies.append(time.time() - req_start)
+            if res.status >= 400:
+                errors[0] += 1
+        conn.close()
+
+    pool = gevent.pool.Pool(concurrency)
+    start = time.time()
+    for i in range(concurrency):
+        pool.spawn(worker)
+    pool.join(raise_error = True)
+    return summarize(latencies, time.time() - start, errors[0])
+
+
+def compare(results, baseline, threshold):
+    """
+    Report endpoints whose throughput dropped or p95 latency grew by more
+    than threshold against a baseline run
+
+    @return list of regression messages
+    """
+    regressions = []
+    for mode, endpoints in results.items():
+        for name, stats in endpoints.items():
+            base = baseline.get('results', {}).get(mode, {}).get(name)
+            if not base:
+                continue
+            if stats['throughput'] < base['throughput'] * (1 - threshold):
+                regressions.append('%s %s: throughput %.1f -> %.1f req/s' % (
+                        mode, name, base['throughput'], stats['throughput']))
+            if stats['p95_ms'] > base['p95_ms'] * (1 + threshold):
+                regressions.append('%s %s: p95 %.2f -> %.2f ms' % (
+                        mode, name, base['p95_ms'], stats['p95_ms']))
+    return regressions
+
+
+def run_mode(app, mode, args):
+    """
+    Seed a fresh db and benchmark every endpoint in one mode
+
+    @return {endpoint name: stats}
+    """
+    fd, path = tempfile.mkstemp(dir = args.dir)
+    server = None
+    try:
+        app.config['DATABASE'] = path
+        app.config['SQLITE_PRAGMAS'] = args.sqlite_pragmas
+        app.config['GROUP_COMMIT'] = args.group_commit
+        app.config['RESPONSE_CACHE_SIZE'] = args.response_cache_size
+        planner.views.configure_db(app)
+        models.init_db()
+
+        client = Client(app)
+        ctx = seed(client, args)
+        specs = endpoints(client, ctx, args.requests)
+
+        if mode == 'server':
+            server = planner.views.WSGIServer(('127.0.0.1', 0), app,
+                                              log = None)
+            server.start()
+
+        ret = {}
+        for spec in specs:
+            if mode == 'server':
+                stats = run_server(server.server_port, spec, args.requests,
+                                   args.concurrency)
+            else:
+                stats = run_client(app, spec, args.requests)
+            ret[spec[0]] = stats
+            print '%-7s %-36s %9.1f %9.2f %9.2f %9.2f %6d' % (
+                mode, spec[0], stats['throughput'], stats['p50_ms'],
+                stats['p95_ms'], stats['p99_ms'], stats['errors'])
+        return ret
+    finally:
+        if server is not None:
+            server.stop()
+        models.engine.dispose()
+        os.close(fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = __doc__.strip().split('\n\n')[0])
+    parser.add_argument('--plans', type = int, default = 10)
+    parser.add_argument('--tasks', type = int, default = 50,
+                        help = 'tasks per plan')
+    parser.add_argument('--work-orders', type = int, default = 5,
+                        help = 'work orders per task')
+    parser.add_argument('--products', type = int, default = 20)
+    parser.add_argument('--requests', type = int, default = 200,
+                        help = 'requests per endpoint')
+    parser.add_argument('--concurrency', type = int, default = 20,
+                        help = 'greenlet clients in server mode')
+    parser.add_argument('--mode', choices = ('client', 'server', 'both'),
+                        default = 'both')
+    parser.add_argument('--sqlite-pragmas', action = 'store_true')
+    parser.add_argument('--group-commit', action = 'store_true',
+                        help = 'queue writes to the group commit writer')
+    parser.add_argument('--response-cache-size', type = int, default = 1024)
+    parser.add_argument('--dir', default = None,
+                        help = 'directory of the benchmark db')
+    parser.add_argument('--output', default = None,
+                        help = 'save the results as JSON')
+    parser.add_argument('--compare', default = None,
+                        help = 'JSON results of a baseline run')
+    parser.add_argument('--threshold', type = float, default = 0.2,
+                        help = 'relative change flagged as a regression')
+    args = parser.parse_args()
+
+    app = planner.views.app
+    modes = ('client', 'server') if args.mode == 'both' else (args.mode,)
+
+    print '%-7s %-36s %9s %9s %9s %9s %6s' % (
+        'mode', 'endpoint', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors')
+    results = {}
+    for mode in modes:
+        results[mode] = run_mode(app, mode, args)
+
+    if args.output:
+        with open(args.output, 'w') as fobj:
+            json.dump({'timestamp': time.time(), 'args': vars(args),
+                       'results': results}, fobj, indent = 2, sort_keys = True)
+
+    if args.compare:
+        with open(args.compare) as fobj:
+            regressions = compare(results, json.load(fobj), args.threshold)
+        for regression in regressions:
+            print 'REGRESSION %s' % regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
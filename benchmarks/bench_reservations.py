@@ -0,0 +1,128 @@
+"""
+Work order update throughput on a single hot product, with the single
+work_order_inventory row and with striped reservations (RESERVATION_STRIPES),
+as the number of concurrent clients grows.
+
+Every client updates the actual quantity of its own work orders, all of
+them tasks of the same product, through the Flask test client from its own
+greenlet. The db work runs on the db pool as in the server.
+
+usage (with the planner package installed or on PYTHONPATH):
+    python benchmarks/bench_reservations.py [--stripes N] [--requests N]
+        [--concurrency 1,4,16] [--quantity N] [--threads N]
+        [--group-commit] [--dir DIR]
+"""
+import argparse
+import gevent
+import json
+import os
+import random
+import tempfile
+import time
+
+import planner.views
+from planner import models, reservations, utils
+
+
+def seed(client, clients, quantity):
+    """
+    One product of quantity, one task and 10 work orders per client
+
+    @return list of the work order ids of every client
+    """
+    def call(url, payload):
+        rv = client.post(url, data = json.dumps(payload),
+                         content_type = 'application/json')
+        assert rv.status_code == 200, rv.data
+        return json.loads(rv.data)
+
+    with utils.db_session() as session:
+        item = models.Inventory('hot product', quantity)
+        session.add(item)
+        session.flush()
+        prod_id = item.id
+
+    plan = call('/plans', {'name': 'bench'})
+    tasks = call('/plans/%d/tasks/batch' % plan['id'],
+                 [{'prod_id': prod_id, 'quantity': 100,
+                   'work_orders': [{'target_quantity': 10}] * 10}] * clients)
+    return [[wo['id'] for wo in task['work_orders']] for task in tasks]
+
+
+def run(app, clients, num_requests, quantity):
+    """
+    @return (updates/sec, rejected updates)
+    """
+    work_orders = seed(app.test_client(), clients, quantity)
+    rejected = []
+
+    def worker(ids):
+        client = app.test_client()
+        for i in range(num_requests // clients):
+            rv = client.put('/work_orders/%d' % random.choice(ids),
+                            data = json.dumps({'actual_quantity':
+                                               random.randint(1, 10)}),
+                            content_type = 'application/json')
+            if rv.status_code == 403:
+                rejected.append(rv)
+            else:
+                assert rv.status_code == 200, rv.data
+
+    start = time.time()
+    gevent.joinall([gevent.spawn(worker, ids) for ids in work_orders],
+                   raise_error = True)
+    elapsed = time.time() - start
+
+    with utils.db_session() as session:
+        problems = reservations.check_reservations(session)
+    assert not problems, problems
+
+    updates = (num_requests // clients) * clients
+    return updates / elapsed, len(rejected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+    parser.add_argument('--stripes', type = int, default = 8)
+    parser.add_argument('--requests', type = int, default = 1000)
+    parser.add_argument('--concurrency', default = '1,2,4,8,16,32',
+                        help = 'comma separated numbers of clients')
+    parser.add_argument('--quantity', type = int, default = 10 ** 6,
+                        help = 'central quantity of the product. Near 50 '
+                        'per client the stripes run dry and rebalance')
+    parser.add_argument('--threads', type = int, default = 4,
+                        help = 'DATABASE_THREADS')
+    parser.add_argument('--group-commit', action = 'store_true')
+    parser.add_argument('--dir', default = None,
+                        help = 'directory of the benchmark db. Use a real '
+                        'disk, fsync is nearly free on tmpfs')
+    args = parser.parse_args()
+
+    app = planner.views.app
+    app.config['DATABASE_THREADS'] = args.threads
+    app.config['GROUP_COMMIT'] = args.group_commit
+    print '%-8s %8s %12s %10s' % ('stripes', 'clients', 'updates/sec',
+                                  'rejected')
+    for clients in [int(n) for n in args.concurrency.split(',')]:
+        for stripes in (0, args.stripes):
+            fd, path = tempfile.mkstemp(dir = args.dir)
+            try:
+                app.config['DATABASE'] = path
+                app.config['RESERVATION_STRIPES'] = stripes
+                planner.views.configure_db(app)
+                models.init_db()
+
+                throughput, rejected = run(app, clients, args.requests,
+                                           args.quantity)
+                print '%-8d %8d %12.1f %10d' % (stripes, clients, throughput,
+                                                rejected)
+            finally:
+                models.engine.dispose()
+                os.close(fd)
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.unlink(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
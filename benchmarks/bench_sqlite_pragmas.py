@@ -0,0 +1,89 @@
+"""
+Compare the request throughput of the planner with and without the sqlite
+performance pragmas (SQLITE_PRAGMAS).
+
+usage (with the planner package installed or on PYTHONPATH):
+    python benchmarks/bench_sqlite_pragmas.py [--requests N] [--dir DIR]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import planner.views
+from planner import models, utils
+
+
+def run(app, num_requests):
+    """
+    Time a mixed write/read workload through the Flask test client
+
+    @return (write requests/sec, read requests/sec)
+    """
+    client = app.test_client()
+
+    def call(method, url, payload = None):
+        rv = getattr(client, method)(url, data = json.dumps(payload),
+                                     content_type = 'application/json')
+        assert rv.status_code == 200, rv.data
+        return json.loads(rv.data)
+
+    with utils.db_session() as session:
+        item = models.Inventory('corn', 10 ** 9)
+        session.add(item)
+        session.flush()
+        prod_id = item.id
+
+    plan = call('post', '/plans', {'name': 'bench'})
+
+    write_time = 0
+    read_time = 0
+    for i in range(num_requests / 4):
+        start = time.time()
+        task = call('post', '/plans/%d/tasks' % plan['id'],
+                    {'prod_id': prod_id, 'quantity': 10})
+        wo = call('post', '/tasks/%d/work_order' % task['id'],
+                  {'target_quantity': 10})
+        call('put', '/work_orders/%d' % wo['id'], {'actual_quantity': 5})
+        write_time += time.time() - start
+
+        start = time.time()
+        call('get', '/tasks/%d' % task['id'])
+        read_time += time.time() - start
+
+    num_writes = 3 * (num_requests / 4)
+    num_reads = num_requests / 4
+    return num_writes / write_time, num_reads / read_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+    parser.add_argument('--requests', type = int, default = 2000)
+    parser.add_argument('--dir', default = None,
+                        help = 'directory of the benchmark db. Use a real '
+                        'disk, fsync is nearly free on tmpfs')
+    args = parser.parse_args()
+
+    app = planner.views.app
+    print '%-10s %12s %12s' % ('pragmas', 'writes/sec', 'reads/sec')
+    for pragmas in (False, True):
+        fd, path = tempfile.mkstemp(dir = args.dir)
+        try:
+            app.config['DATABASE'] = path
+            app.config['SQLITE_PRAGMAS'] = pragmas
+            planner.views.configure_db(app)
+            models.init_db()
+
+            writes, reads = run(app, args.requests)
+            print '%-10s %12.1f %12.1f' % (pragmas, writes, reads)
+        finally:
+            models.engine.dispose()
+            os.close(fd)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Admission control: concurrency limits and bounded wait queues per route
+class, shedding the requests that do not fit with 503
+"""
+from flask import Response, g, request
+import gevent.lock
+import json
+import metrics
+
+# Route classes of the endpoints not classified by method
+REPORT_ENDPOINTS = ('get_report',)
+EXPORT_ENDPOINTS = ('get_export',)
+# Monitoring and long lived streams are never limited
+EXEMPT_ENDPOINTS = ('get_metrics', 'get_events', 'static')
+
+
+def route_class(endpoint, method):
+    """
+    @return 'report', 'export', 'read' or 'write', None for the exempt
+    endpoints
+    """
+    if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+        return None
+    if endpoint in REPORT_ENDPOINTS:
+        return 'report'
+    if endpoint in EXPORT_ENDPOINTS:
+        return 'export'
+    if method in ('GET', 'HEAD'):
+        return 'read'
+    return 'write'
+
+
+class Limiter(object):
+    """
+    At most concurrency requests of a route class at a time, up to queue
+    more waiting for their turn
+    """
+
+    def __init__(self, name, concurrency, queue):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.slots = gevent.lock.Semaphore(concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {'queue_full': 0, 'timeout': 0}
+
+    def acquire(self, timeout):
+        """
+        Wait up to timeout seconds for a slot, unless the queue is full
+
+        @return None once admitted, else the reason of the rejection
+        """
+        if not self.slots.acquire(blocking = False):
+            if self.waiting >= self.queue:
+                self.rejected['queue_full'] += 1
+                return 'queue_full'
+
+            self.waiting += 1
+            try:
+                acquired = self.slots.acquire(timeout = timeout)
+            finally:
+                self.waiting -= 1
+            if not acquired:
+                self.rejected['timeout'] += 1
+                return 'timeout'
+
+        self.active += 1
+        self.admitted += 1
+        return None
+
+    def release(self):
+        self.active -= 1
+        self.slots.release()
+
+
+class AdmissionControl(object):
+    """
+    Limits the requests of each route class served at a time by the
+    process. Requests beyond a limit wait in a bounded queue for at most
+    timeout seconds. Requests finding the queue full or timing out are
+    answered at once with 503 and a Retry-After header, so the requests
+    admitted keep their latency under overload. Disabled until configured
+    with limits.
+
+    Limits count requests, not db work: a write class of its own keeps
+    work order updates from waiting behind report and list traffic.
+    """
+
+    def __init__(self):
+        self.limiters = {}
+        self.timeout = 1.0
+        self.retry_after = 1
+
+    def configure(self, limits, timeout = 1.0, retry_after = 1):
+        """
+        @param limits dict of route class: (concurrency, queue). Classes
+        left out or with a concurrency of 0 are not limited.
+        @param timeout seconds a request waits in the queue
+        @param retry_after seconds clients are told to wait once rejected
+        """
+        self.limiters = dict((name, Limiter(name, concurrency, queue))
+                             for name, (concurrency, queue) in limits.items()
+                             if concurrency > 0)
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+    def admit(self):
+        """
+        Before request hook, waits for a slot of the route class of the
+        request
+
+        @return 503 response when rejected
+        """
+        limiter = self.limiters.get(route_class(request.endpoint,
+                                                request.method))
+        if limiter is None:
+            return None
+
+        reason = limiter.acquire(self.timeout)
+        if reason is not None:
+            response = Response(
+                json.dumps({'message': 'Too many %s requests, retry later'
+                            % limiter.name}),
+                status = 503, mimetype = 'application/json')
+            response.headers['Retry-After'] = str(self.retry_after)
+            return response
+
+        g.admission = limiter
+        return None
+
+    def release(self, exc):
+        """
+        Teardown request hook, frees the slot of an admitted request
+        """
+        limiter = g.pop('admission', None)
+        if limiter is not None:
+            limiter.release()
+
+    def collect(self):
+        limiters = sorted(self.limiters.items())
+        return [
+            ('planner_admission_active', 'gauge',
+             'Requests admitted and being served',
+             [({'class': name}, limiter.active) for name, limiter in limiters]),
+            ('planner_admission_queued', 'gauge',
+             'Requests waiting for admission',
+             [({'class': name}, limiter.waiting) for name, limiter in limiters]),
+            ('planner_admission_admitted_total', 'counter',
+             'Requests admitted',
+             [({'class': name}, limiter.admitted)
+              for name, limiter in limiters]),
+            ('planner_admission_rejected_total', 'counter',
+             'Requests rejected with 503',
+             [({'class': name, 'reason': reason}, count)
+              for name, limiter in limiters
+              for reason, count in sorted(limiter.rejected.items())])]
+
+
+admission_control = AdmissionControl()
+metrics.registry.add_collector(admission_control.collect)
+
+configure = admission_control.configure
+
+
+def init_app(app):
+    """
+    Apply the admission control to every request served by app
+    """
+    app.before_request(admission_control.admit)
+    app.teardown_request(admission_control.release)
@@ -0,0 +1,119 @@
+"""
+Table version counters, ETags and the response cache of the read endpoints
+"""
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, current_app, make_response, request
+import ctypes
+import hashlib
+import multiprocessing
+import os
+import threading
+import models
+import utils
+
+
+class TableVersions(object):
+    """
+    Version counter per table, bumped by every committed transaction that
+    wrote to the table. The counters live in shared memory created before
+    the workers of the pre-fork server are forked, so a commit in one
+    worker changes the ETags and cache keys of all of them.
+    """
+
+    def __init__(self, tables):
+        # Responses of a previous server must not match. Workers share it.
+        self.nonce = os.urandom(8).encode('hex')
+        self.slots = dict((table, i) for i, table in enumerate(tables))
+        self.versions = multiprocessing.RawArray(ctypes.c_ulong, len(tables))
+        self.lock = multiprocessing.Lock()
+
+    def bump(self, changes):
+        """
+        Bump the versions of the tables written in a models.ChangeSet
+        """
+        with self.lock:
+            for table in changes.rows:
+                self.versions[self.slots[table]] += 1
+
+    def get(self, tables):
+        return tuple(self.versions[self.slots[table]] for table in tables)
+
+
+class ResponseCache(object):
+    """
+    LRU cache of response (body, status, headers) holding at most
+    max_size entries
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def set(self, key, entry, max_size):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > max_size:
+                self.entries.popitem(last = False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+table_versions = TableVersions(models.Base.metadata.tables)
+response_cache = ResponseCache()
+utils.on_commit(table_versions.bump)
+
+
+def cached_view(*tables):
+    """
+    Decorator for read endpoints depending on the given tables. The ETag of
+    the response is derived from the route, its arguments and the table
+    versions, so If-None-Match is answered with 304 without touching the
+    db. Other responses are served from the response cache when the tables
+    did not change. RESPONSE_CACHE_SIZE caps the cached responses, 0
+    disables the cache.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (request.endpoint,
+                   tuple(sorted(request.view_args.items())),
+                   tuple(sorted(request.args.items(multi = True))),
+                   table_versions.get(tables))
+            etag = hashlib.sha1(table_versions.nonce + repr(key)).hexdigest()
+
+            if request.if_none_match.contains(etag):
+                response = Response(status = 304)
+                response.set_etag(etag)
+                return response
+
+            entry = response_cache.get(key)
+            if entry is not None:
+                return Response(*entry)
+
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+            response.set_etag(etag)
+            max_size = current_app.config['RESPONSE_CACHE_SIZE']
+            if max_size > 0 and not response.is_streamed:
+                response_cache.set(key, (response.get_data(),
+                                         response.status_code,
+                                         response.headers.to_wsgi_list()),
+                                   max_size)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,471 @@
+"""
+Console client of the planner service
+"""
+import argparse
+import errno
+import gevent
+import gevent.lock
+import gevent.pool
+import gevent.queue
+import gevent.socket
+import httplib
+import json
+import socket
+import sys
+import time
+import urlparse
+
+# Tasks per POST /plans/<id>/tasks/batch request
+TASK_BATCH_SIZE = 50
+
+
+class ClientError(Exception):
+    """
+    Error response of the planner service
+
+    @param missing True when the server has no such endpoint, rather than
+    a service error about the resource
+    """
+
+    def __init__(self, status, message, missing = False):
+        Exception.__init__(self, '%d %s' % (status, message))
+        self.status = status
+        self.message = message
+        self.missing = missing
+
+
+class Connection(httplib.HTTPConnection):
+    """
+    HTTP/1.1 connection on a gevent socket, kept alive between requests
+    """
+
+    def connect(self):
+        self.sock = gevent.socket.create_connection((self.host, self.port),
+                                                    self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def _stale(error):
+    """
+    @return True for the errors of a keep-alive connection the server
+    closed before the request, which it then never processed: a reset or
+    broken pipe, or the connection closed without a status line
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        # Raised with the line read when a status line came back, with a
+        # message when none did
+        return not str(error.line).startswith('HTTP/')
+    return isinstance(error, socket.error) and \
+        error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
+class ConnectionPool(object):
+    """
+    Up to size keep-alive connections to the service, each used by one
+    greenlet at a time. A request finding its reused connection closed by
+    the server is sent again on a new connection. Other errors, e.g. a
+    timeout after the server got the request, are raised: resending could
+    create a plan or task twice.
+    """
+
+    def __init__(self, host, port, size, timeout = 60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle = gevent.queue.LifoQueue()
+        self.slots = gevent.lock.BoundedSemaphore(size)
+
+    def request(self, method, path, body = None, headers = {}):
+        """
+        @return (status, response body)
+        """
+        with self.slots:
+            try:
+                conn = self.idle.get_nowait()
+                reused = True
+            except gevent.queue.Empty:
+                conn = Connection(self.host, self.port, timeout = self.timeout)
+                reused = False
+
+            try:
+                try:
+                    ret = self._send(conn, method, path, body, headers)
+                except (httplib.HTTPException, socket.error) as e:
+                    conn.close()
+                    if not reused or not _stale(e):
+                        raise
+                    ret = self._send(conn, method, path, body, headers)
+            except:
+                conn.close()
+                raise
+
+            self.idle.put(conn)
+            return ret
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        rv = conn.getresponse()
+        return rv.status, rv.read()
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().close()
+
+
+class PlannerClient(object):
+    """
+    Calls of the planner REST API. Independent calls run concurrently, at
+    most concurrency at a time over as many keep-alive connections. The
+    batch and report endpoints are used when the server has them, with a
+    fallback to the single resource endpoints otherwise.
+    """
+
+    def __init__(self, url = 'http://localhost:8088', concurrency = 8):
+        parts = urlparse.urlparse(url)
+        self.pool = ConnectionPool(parts.hostname, parts.port or 80,
+                                   concurrency)
+        self.prefix = parts.path.rstrip('/')
+        self.concurrency = concurrency
+        self.batch = True
+        self.reports = True
+
+    def call(self, method, path, payload = None):
+        """
+        @return decoded JSON response
+
+        @raise ClientError on an error response
+        """
+        headers = {}
+        body = None
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+
+        status, data = self.pool.request(method, self.prefix + path, body,
+                                         headers)
+        if status >= 400:
+            try:
+                message = json.loads(data)['message']
+            except (ValueError, KeyError, TypeError):
+                # Not an error of the service, an unknown route
+                raise ClientError(status, data.strip(),
+                                  missing = status in (404, 405))
+            raise ClientError(status, message)
+        return json.loads(data) if data else None
+
+    def map(self, func, items):
+        """
+        @return [func(item) for item in items], run concurrently
+        """
+        return gevent.pool.Pool(self.concurrency).map(func, items)
+
+    def create_plan(self, name, tasks):
+        """
+        Create a plan with its tasks and their work orders
+
+        @param tasks list of {'prod_id', 'quantity', 'work_orders': list of
+        target quantities}
+
+        @return plan, with the created tasks and their work orders. Tasks
+        are created TASK_BATCH_SIZE per request, a chunk failing leaves the
+        other chunks created.
+        """
+        plan = self.call('POST', '/plans', {'name': name})
+        payload = [{'prod_id': task['prod_id'], 'quantity': task['quantity'],
+                    'work_orders': [{'target_quantity': target}
+                                    for target in task.get('work_orders', [])]}
+                   for task in tasks]
+
+        plan['tasks'] = []
+        if self.batch and payload:
+            url = '/plans/%d/tasks/batch' % plan['id']
+            chunks = [payload[i:i + TASK_BATCH_SIZE]
+                      for i in range(0, len(payload), TASK_BATCH_SIZE)]
+            try:
+                # The first chunk finds out whether the server has batches
+                created = [self.call('POST', url, chunks[0])]
+            except ClientError as e:
+                if not e.missing:
+                    raise
+                self.batch = False
+            else:
+                created += self.map(lambda chunk: self.call('POST', url, chunk),
+                                    chunks[1:])
+                for chunk in created:
+                    plan['tasks'].extend(chunk)
+                return plan
+
+        plan['tasks'] = self.map(lambda task: self._create_task(plan['id'],
+                                                                task), payload)
+        return plan
+
+    def _create_task(self, plan_id, payload):
+        task = self.call('POST', '/plans/%d/tasks' % plan_id,
+                         {'prod_id': payload['prod_id'],
+                          'quantity': payload['quantity']})
+        task['work_orders'] = self.create_work_orders(
+            task['id'], [wo['target_quantity'] for wo in payload['work_orders']])
+        return task
+
+    def create_work_orders(self, task_id, targets):
+        """
+        @return list of the work orders created for a task
+        """
+        if not targets:
+            return []
+        if self.batch:
+            try:
+                return self.call('POST', '/tasks/%d/work_orders/batch' % task_id,
+                                 [{'target_quantity': target}
+                                  for target in targets])
+            except ClientError as e:
+                if not e.missing:
+                    raise
+                self.batch = False
+
+        return self.map(lambda target: self.call(
+                'POST', '/tasks/%d/work_order' % task_id,
+                {'target_quantity': target}), targets)
+
+    def update_work_orders(self, updates):
+        """
+        @param updates list of (work order id, changes)
+
+        @return list of the updated work orders
+        """
+        return self.map(lambda update: self.call(
+                'PUT', '/work_orders/%d' % update[0], update[1]), updates)
+
+    def delete_plan(self, plan_id):
+        """
+        Delete a plan with its tasks, and so their work orders. The server
+        only deletes plans without tasks and tasks not started: a started
+        task fails the call with 403, leaving the plan and started tasks.
+        """
+        tasks = self.call('GET', '/plans/%d/tasks' % plan_id)
+        self.map(lambda task: self.call('DELETE', '/tasks/%d' % task['id']),
+                 tasks)
+        self.call('DELETE', '/plans/%d' % plan_id)
+
+    def report(self, plan_id = None):
+        """
+        @return planned vs actual report of a plan, or of every plan, in
+        the format of GET /reports/plan/<id>
+        """
+        if self.reports:
+            path = '/reports/plans' if plan_id is None \
+                else '/reports/plan/%d' % plan_id
+            try:
+                return self.call('GET', path)
+            except ClientError as e:
+                if not e.missing:
+                    raise
+                self.reports = False
+
+        return self._build_report(plan_id)
+
+    def _build_report(self, plan_id):
+        """
+        The report from the plan, task and inventory endpoints
+        """
+        if plan_id is None:
+            plans, tasks, inventory = self.map(
+                lambda path: self.call('GET', path),
+                ['/plans', '/tasks', '/inventory'])
+        else:
+            plan, tasks, inventory = self.map(
+                lambda path: self.call('GET', path),
+                ['/plans/%d' % plan_id, '/plans/%d/tasks' % plan_id,
+                 '/inventory'])
+            plans = [plan]
+
+        names = dict((item['id'], item) for item in inventory)
+        ret = {'plans': [], 'inventory': []}
+        used = set()
+        for plan in sorted(plans, key = lambda plan: plan['id']):
+            entry = {'id': plan['id'], 'name': plan['name'], 'tasks': [],
+                     'planned_quantity': 0, 'actual_quantity': 0}
+            products = {}
+            for task in sorted(tasks, key = lambda task: task['id']):
+                if task['plan_id'] != plan['id']:
+                    continue
+                product_id = task['product_id']
+                name = names.get(product_id, {}).get('product_name')
+                entry['tasks'].append({
+                        'id': task['id'], 'status': task['status'],
+                        'product_id': product_id, 'product_name': name,
+                        'planned_quantity': task['target_quantity'],
+                        'work_order_quantity': task['wo_target_quantity'],
+                        'actual_quantity': task['wo_actual_quantity']})
+                entry['planned_quantity'] += task['target_quantity']
+                entry['actual_quantity'] += task['wo_actual_quantity']
+                product = products.setdefault(product_id, {
+                        'product_id': product_id, 'product_name': name,
+                        'planned_quantity': 0, 'actual_quantity': 0})
+                product['planned_quantity'] += task['target_quantity']
+                product['actual_quantity'] += task['wo_actual_quantity']
+                used.add(product_id)
+            entry['products'] = sorted(products.values(),
+                                       key = lambda p: p['product_id'])
+            ret['plans'].append(entry)
+
+        if plan_id is None:
+            # The report of every plan has every product
+            used = set(names)
+        ret['inventory'] = [{'product_id': product_id,
+                             'product_name': names[product_id]['product_name'],
+                             'quantity': names[product_id]['quantity']}
+                            for product_id in sorted(used) if product_id in names]
+        return ret
+
+    def close(self):
+        self.pool.close()
+
+
+def print_table(header, rows):
+    widths = [max(len(str(value)) for value in column)
+              for column in zip(header, *rows)]
+    line = '  '.join('%%-%ds' % width for width in widths)
+    print line % tuple(header)
+    for row in rows:
+        print line % tuple(row)
+
+
+def print_report(report):
+    for plan in report['plans']:
+        print 'Plan %d %s: planned %d, actual %d' % (
+            plan['id'], plan['name'], plan['planned_quantity'],
+            plan['actual_quantity'])
+        print_table(('task', 'status', 'product', 'planned', 'work orders',
+                     'actual'),
+                    [(task['id'], task['status'], task['product_name'],
+                      task['planned_quantity'], task['work_order_quantity'],
+                      task['actual_quantity']) for task in plan['tasks']])
+        print
+    print 'Inventory balance'
+    print_table(('product', 'name', 'quantity'),
+                [(item['product_id'], item['product_name'], item['quantity'])
+                 for item in report['inventory']])
+
+
+def inventory(client, args):
+    """
+    List the central inventory
+    """
+    print_table(('id', 'product', 'quantity'),
+                [(item['id'], item['product_name'], item['quantity'])
+                 for item in client.call('GET', '/inventory')])
+    return 0
+
+
+def plans(client, args):
+    """
+    List the plans
+    """
+    print_table(('id', 'name', 'created'),
+                [(plan['id'], plan['name'], plan['created_date'])
+                 for plan in client.call('GET', '/plans')])
+    return 0
+
+
+def create_plan(client, args):
+    """
+    Create a plan of N tasks of M work orders each
+    """
+    tasks = [{'prod_id': args.product, 'quantity': args.quantity,
+              'work_orders': [args.quantity // max(args.work_orders, 1)]
+              * args.work_orders}
+             for i in range(args.tasks)]
+    start = time.time()
+    plan = client.create_plan(args.name, tasks)
+    print 'plan %d created with %d tasks and %d work orders in %.2f seconds' \
+        % (plan['id'], len(plan['tasks']),
+           sum(len(task.get('work_orders', [])) for task in plan['tasks']),
+           time.time() - start)
+    return 0
+
+
+def update_work_order(client, args):
+    """
+    Set the actual quantity of work orders
+    """
+    changes = {'actual_quantity': args.actual}
+    if args.completed:
+        changes['completed'] = True
+    client.update_work_orders([(work_id, changes) for work_id in args.ids])
+    print '%d work orders updated' % len(args.ids)
+    return 0
+
+
+def delete_plan(client, args):
+    """
+    Delete plans with their tasks and work orders, none of them started
+    """
+    client.map(client.delete_plan, args.ids)
+    print '%d plans deleted' % len(args.ids)
+    return 0
+
+
+def report(client, args):
+    """
+    Print the planned vs actual quantities of a plan, or of every plan
+    """
+    print_report(client.report(args.plan_id))
+    return 0
+
+
+def main(argv = None):
+    """
+    Entry function of the planner command
+    """
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+    parser.add_argument('--url', default = 'http://localhost:8088')
+    parser.add_argument('--concurrency', type = int, default = 8,
+                        help = 'concurrent requests and connections')
+    commands = parser.add_subparsers()
+
+    cmd = commands.add_parser('inventory', help = inventory.__doc__.strip())
+    cmd.set_defaults(func = inventory)
+
+    cmd = commands.add_parser('plans', help = plans.__doc__.strip())
+    cmd.set_defaults(func = plans)
+
+    cmd = commands.add_parser('create-plan', help = create_plan.__doc__.strip())
+    cmd.add_argument('name')
+    cmd.add_argument('--product', type = int, required = True,
+                     help = 'inventory id of the product of the tasks')
+    cmd.add_argument('--quantity', type = int, default = 100,
+                     help = 'target quantity of every task')
+    cmd.add_argument('--tasks', type = int, default = 1)
+    cmd.add_argument('--work-orders', type = int, default = 0,
+                     help = 'work orders per task, splitting its quantity')
+    cmd.set_defaults(func = create_plan)
+
+    cmd = commands.add_parser('update-work-order',
+                              help = update_work_order.__doc__.strip())
+    cmd.add_argument('ids', type = int, nargs = '+')
+    cmd.add_argument('--actual', type = int, required = True)
+    cmd.add_argument('--completed', action = 'store_true')
+    cmd.set_defaults(func = update_work_order)
+
+    cmd = commands.add_parser('delete-plan', help = delete_plan.__doc__.strip())
+    cmd.add_argument('ids', type = int, nargs = '+')
+    cmd.set_defaults(func = delete_plan)
+
+    cmd = commands.add_parser('report', help = report.__doc__.strip())
+    cmd.add_argument('plan_id', type = int, nargs = '?')
+    cmd.set_defaults(func = report)
+
+    args = parser.parse_args(argv)
+    client = PlannerClient(args.url, args.concurrency)
+    try:
+        return args.func(client, args)
+    except ClientError as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
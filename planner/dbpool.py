@@ -0,0 +1,155 @@
+"""
+Bounded thread pool running the blocking db work of requests off the gevent
+hub
+"""
+from flask import _app_ctx_stack, _request_ctx_stack, has_request_context
+from flask import request
+from functools import wraps
+from gevent import monkey
+import gevent.threadpool
+import threading
+import time
+import warnings
+import metrics
+
+
+class DBPool(object):
+    """
+    Runs functions doing db work on a gevent thread pool of at most size
+    threads, so the hub keeps serving other greenlets while sqlite blocks.
+    Calls beyond size wait in the pool queue. The app and request contexts
+    of the caller are pushed in the worker thread, so flask.g, request and
+    url_for work there as in the view. With size 0 the functions run in the
+    calling greenlet.
+
+    The threading module must not be monkey patched: the locks of the
+    SQLAlchemy connection pool would be gevent locks shared between
+    threads, which deadlock. The functions run in the calling greenlet then.
+    """
+
+    def __init__(self, size = 4):
+        self.size = size
+        self.pool = None
+        self.worker = threading.local()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.tasks = 0
+        self.wait_time = 0.0
+
+    def configure(self, size):
+        """
+        Set the number of threads. The pool is created on first use, by the
+        hub that then waits on it.
+        """
+        if size != self.size and self.pool is not None:
+            self.pool.kill()
+            self.pool = None
+        self.size = size
+
+    def _call(self, queued_at, app_ctx, request_ctx, func, args, kwargs):
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+            self.wait_time += time.time() - queued_at
+
+        self.worker.running = True
+        if app_ctx is not None:
+            app_ctx.push()
+        if request_ctx is not None:
+            request_ctx.push()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # Not the context managers: a request context preserved on an
+            # exception would stay pushed on the worker thread
+            if request_ctx is not None:
+                request_ctx.pop()
+            if app_ctx is not None:
+                app_ctx.pop()
+            self.worker.running = False
+            with self.lock:
+                self.active -= 1
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) on the pool and wait for its result
+        cooperatively. Exceptions raised by func are raised here.
+        """
+        if self.size <= 0 or getattr(self.worker, 'running', False):
+            return func(*args, **kwargs)
+
+        if self.pool is None:
+            if monkey.is_module_patched('threading'):
+                warnings.warn('threading is monkey patched, running db '
+                              'calls on the hub')
+                self.size = 0
+                return func(*args, **kwargs)
+            self.pool = gevent.threadpool.ThreadPool(self.size)
+
+        with self.lock:
+            self.queued += 1
+            self.tasks += 1
+        return self.pool.apply(self._call, (time.time(), _app_ctx_stack.top,
+                                            _request_ctx_stack.top, func,
+                                            args, kwargs))
+
+    def stream(self, iterable):
+        """
+        Iterate over iterable with every step run on the pool. Used for
+        streamed responses, the generator producing the body resumes on a
+        worker thread for each chunk.
+        """
+        iterator = iter(iterable)
+        # A sentinel, not StopIteration: gevent reports exceptions leaving a
+        # pool thread as failed tasks
+        end = object()
+        try:
+            while True:
+                item = self.run(next, iterator, end)
+                if item is end:
+                    return
+                yield item
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                self.run(close)
+
+    def offload(self, func):
+        """
+        Decorator running a view on the pool. The request body is read
+        first, the client socket belongs to the hub.
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if has_request_context():
+                request.get_data()
+            return self.run(func, *args, **kwargs)
+
+        return wrapper
+
+    def collect(self):
+        with self.lock:
+            samples = [
+                ('planner_db_pool_threads', 'gauge',
+                 'Threads of the db pool', self.size),
+                ('planner_db_pool_queued', 'gauge',
+                 'Db calls waiting for a pool thread', self.queued),
+                ('planner_db_pool_active', 'gauge',
+                 'Db calls running on a pool thread', self.active),
+                ('planner_db_pool_tasks_total', 'counter',
+                 'Db calls run on the pool', self.tasks),
+                ('planner_db_pool_wait_seconds_total', 'counter',
+                 'Time db calls waited for a pool thread',
+                 '%f' % self.wait_time)]
+        return [(name, metric_type, help_text, [({}, value)])
+                for name, metric_type, help_text, value in samples]
+
+
+db_pool = DBPool()
+metrics.registry.add_collector(db_pool.collect)
+
+configure = db_pool.configure
+run = db_pool.run
+stream = db_pool.stream
+offload = db_pool.offload
@@ -0,0 +1,299 @@
+"""
+Feed of the task, work order and inventory changes as server-sent events
+"""
+from collections import deque
+from sqlalchemy import select
+from models import Inventory, Task, WorkOrder
+import ctypes
+import gevent
+import gevent.event
+import json
+import multiprocessing
+import os
+import threading
+import metrics
+import utils
+
+# Ids per IN clause of the lookups of the changed rows
+LOOKUP_CHUNK_SIZE = 500
+
+
+def _lookup(session, columns, key, ids):
+    """
+    @return {key: row} of the rows whose key is in ids
+    """
+    ids = sorted(ids)
+    ret = {}
+    for i in range(0, len(ids), LOOKUP_CHUNK_SIZE):
+        for row in session.execute(
+                select(columns)
+                .where(key.in_(ids[i:i + LOOKUP_CHUNK_SIZE]))):
+            ret[row[0]] = row
+    return ret
+
+
+def _format(event_id, name, data):
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (event_id, name,
+                                                json.dumps(data))
+
+
+class EventFeed(object):
+    """
+    Ring buffer of the last size change events, filled by a commit listener
+    while clients are subscribed. Every event is formatted once and streamed to
+    the subscribers it matches. Subscribers are greenlets waiting on one
+    gevent event, woken from the committing threads through an async
+    watcher of the hub, so idle subscribers cost a greenlet each.
+
+    Event ids are <nonce>-<n> with n counting the events of the process. A
+    subscriber resuming from an id this process does not have anymore gets
+    a reset event and should reload what it displays.
+
+    Without subscribers in any worker, commits are only counted, the rows
+    they changed are not looked up. The next subscription of a worker that
+    missed commits adds a gap to its buffer: resuming across it gets a
+    reset event.
+
+    In the pre-fork server each worker has its own feed. Events are sent to
+    the other workers through relay(rows) and added there with add(). A
+    worker killed with subscribers leaves them counted.
+    """
+
+    def __init__(self, size = 10000):
+        self.events = deque(maxlen = size)
+        self.lock = threading.Lock()
+        # Subscribers of every worker, and the commits none was there for
+        self.active = multiprocessing.Value(ctypes.c_int, 0)
+        self.skipped = multiprocessing.RawValue(ctypes.c_long, 0)
+        self.relay = None
+        self.subscribers = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new feed, run in a newly forked worker
+        """
+        with self.lock:
+            self.nonce = os.urandom(4).encode('hex')
+            self.events.clear()
+            self.last_id = 0
+            self.seen_skipped = self.skipped.value
+        self.watcher = None
+        self.arrived = gevent.event.Event()
+
+    def configure(self, size):
+        with self.lock:
+            self.events = deque(self.events, maxlen = size)
+
+    def _wake(self):
+        arrived, self.arrived = self.arrived, gevent.event.Event()
+        arrived.set()
+
+    def _changed_rows(self, changes):
+        """
+        @return [(event name, plan_id, task_id, data)] of the changes
+        """
+        tasks = changes.rows.get(Task.__tablename__, {})
+        work_orders = changes.rows.get(WorkOrder.__tablename__, {})
+        inventory = changes.rows.get(Inventory.__tablename__, {})
+
+        task_ids = set(tasks)
+        task_ids.update(row.get('task_id') for row in work_orders.values())
+        task_ids.discard(None)
+        with utils.db_session() as session:
+            task_rows = _lookup(session, [Task.id, Task.plan_id, Task.status],
+                                Task.id, task_ids)
+            wo_rows = _lookup(session, [WorkOrder.id, WorkOrder.task_id,
+                                        WorkOrder.status,
+                                        WorkOrder.actual_quantity],
+                              WorkOrder.id, work_orders)
+            inventory_rows = _lookup(session, [Inventory.id,
+                                               Inventory.quantity],
+                                     Inventory.id,
+                                     [pk for pk in inventory if pk is not None])
+
+        ret = []
+        for pk, change in sorted(tasks.items()):
+            data = {'id': pk, 'op': change['op'],
+                    'plan_id': change.get('plan_id')}
+            if pk in task_rows:
+                data['plan_id'] = task_rows[pk].plan_id
+                data['status'] = task_rows[pk].status
+            ret.append(('task', data['plan_id'], pk, data))
+
+        for pk, change in sorted(work_orders.items()):
+            data = {'id': pk, 'op': change['op'],
+                    'task_id': change.get('task_id')}
+            if pk in wo_rows:
+                data['task_id'] = wo_rows[pk].task_id
+                data['status'] = wo_rows[pk].status
+                data['actual_quantity'] = wo_rows[pk].actual_quantity
+            task = task_rows.get(data['task_id'])
+            data['plan_id'] = task.plan_id if task is not None else None
+            ret.append(('work_order', data['plan_id'], data['task_id'], data))
+
+        for pk, change in sorted(inventory.items()):
+            data = {'id': pk, 'op': change['op']}
+            if pk in inventory_rows:
+                data['quantity'] = inventory_rows[pk].quantity
+            ret.append(('inventory', None, None, data))
+
+        return ret
+
+    def publish(self, changes):
+        """
+        Commit listener adding the events of a models.ChangeSet, called from
+        any thread. Only counted without subscribers.
+        """
+        # Checked and counted under the lock _join reads the count under,
+        # no skipped commit goes unnoticed by a new subscriber
+        with self.active.get_lock():
+            if not self.active.value:
+                self.skipped.value += 1
+                return
+
+        rows = self._changed_rows(changes)
+        if not rows:
+            return
+
+        self.add(rows)
+        if self.relay is not None:
+            self.relay(rows)
+
+    def add(self, rows):
+        """
+        Add events of (name, plan_id, task_id, data), called from any thread
+        """
+        if self.watcher is None:
+            return
+
+        with self.lock:
+            for name, plan_id, task_id, data in rows:
+                self.last_id += 1
+                event_id = '%s-%d' % (self.nonce, self.last_id)
+                self.events.append((self.last_id, plan_id, task_id,
+                                    _format(event_id, name, data)))
+        self.watcher.send()
+
+    def _since(self, last):
+        """
+        @return (events after the event number last, False if events after
+        it were dropped from the buffer)
+        """
+        ret = []
+        with self.lock:
+            for event in reversed(self.events):
+                if event[0] <= last:
+                    break
+                ret.append(event)
+            complete = not ret or ret[-1][0] == last + 1
+        ret.reverse()
+        return ret, complete
+
+    def subscribe(self, last_event_id = None, plans = (), tasks = (),
+                  heartbeat = 15):
+        """
+        Start delivering change events. Must be called on the hub serving
+        the subscriber.
+
+        @param last_event_id resume after this event id
+        @param plans plan ids, tasks task ids whose task and work order
+        events are delivered. Without any, every event is delivered.
+        @param heartbeat seconds between keepalive comments on idle streams
+
+        @return generator of the server-sent event stream
+        """
+        if self.watcher is None:
+            self.watcher = gevent.get_hub().loop.async_()
+            self.watcher.start(self._wake)
+
+        return self._stream(last_event_id, set(plans), set(tasks), heartbeat)
+
+    def _join(self):
+        """
+        Count a subscriber, marking the commits missed since the last one
+
+        @return number of the last event
+        """
+        with self.active.get_lock():
+            self.active.value += 1
+            skipped = self.skipped.value
+        with self.lock:
+            if skipped != self.seen_skipped:
+                self.seen_skipped = skipped
+                self.last_id += 1
+                self.events.append((self.last_id, None, None, None))
+            return self.last_id
+
+    def _leave(self):
+        with self.active.get_lock():
+            self.active.value -= 1
+
+    def _stream(self, last_event_id, plans, tasks, heartbeat):
+        # Counted once streaming, a response closed before its first chunk
+        # never runs the finally clause
+        current = self._join()
+        self.subscribers += 1
+        try:
+            last = None
+            if last_event_id:
+                nonce, _, number = last_event_id.partition('-')
+                if nonce == self.nonce and number.isdigit() \
+                        and int(number) <= current:
+                    last = int(number)
+
+            if last is None:
+                last = current
+                yield _format('%s-%d' % (self.nonce, last), 'reset', {})
+            else:
+                yield ': resumed\n\n'
+
+            while True:
+                # Taken before reading the buffer, no wakeup is missed
+                arrived = self.arrived
+                events, complete = self._since(last)
+                if not complete:
+                    yield _format('%s-%d' % (self.nonce, events[0][0] - 1),
+                                  'reset', {})
+
+                for number, plan_id, task_id, text in events:
+                    last = number
+                    if text is None:
+                        # Commits went by without subscribers
+                        yield _format('%s-%d' % (self.nonce, number), 'reset',
+                                      {})
+                    elif (not plans and not tasks) or plan_id in plans \
+                            or task_id in tasks \
+                            or (plan_id is None and task_id is None):
+                        # Inventory events, and those of deleted rows of
+                        # an unknown plan and task, are not filtered
+                        yield text
+
+                if not events and not arrived.wait(heartbeat):
+                    yield ': keepalive\n\n'
+        finally:
+            self.subscribers -= 1
+            self._leave()
+
+    def collect(self):
+        with self.lock:
+            published = self.last_id
+            buffered = len(self.events)
+        return [
+            ('planner_events_subscribers', 'gauge',
+             'Clients subscribed to the change event stream',
+             [({}, self.subscribers)]),
+            ('planner_events_buffered', 'gauge',
+             'Change events kept for resuming subscribers',
+             [({}, buffered)]),
+            ('planner_events_total', 'counter',
+             'Change events published',
+             [({}, published)])]
+
+
+event_feed = EventFeed()
+utils.on_commit(event_feed.publish)
+metrics.registry.add_collector(event_feed.collect)
+
+configure = event_feed.configure
+subscribe = event_feed.subscribe
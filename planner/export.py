@@ -0,0 +1,182 @@
+"""
+Bulk export of the planner tables as NDJSON or CSV, optionally gzipped
+"""
+from cStringIO import StringIO
+from sqlalchemy import func, select
+from models import Inventory, Plan, Task, WorkOrder
+import csv
+import datetime
+import json
+import zlib
+import utils
+
+# Rows per query, each in its own transaction
+EXPORT_CHUNK_SIZE = 5000
+
+TABLES = dict((model.__tablename__, model)
+              for model in (Inventory, Plan, Task, WorkOrder))
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def parse_since(value):
+    """
+    @param value id, or created date as YYYY-MM-DD[THH:MM:SS] in UTC
+
+    @return (id, None) or (None, datetime)
+
+    @raise ValueError if value is neither
+    """
+    if value.isdigit():
+        return int(value), None
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return None, datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Invalid since %s, expected an id or a date' % value)
+
+
+class Export(object):
+    """
+    Rows of a table after a watermark, read in id order EXPORT_CHUNK_SIZE
+    rows per query. Every query runs in a transaction of its own, so a long
+    export never holds the db lock writers wait for, and only one chunk is
+    in memory at a time. The rows inserted after the export started are
+    left for the next export: it ends at the last id at its start, its
+    watermark.
+
+    @param since_id export the rows of a greater id
+    @param since_date export the rows created at or after it, the plan,
+    task and work order tables only
+    """
+
+    def __init__(self, model, since_id = None, since_date = None,
+                 chunk_size = EXPORT_CHUNK_SIZE):
+        self.model = model
+        self.serializer = model.serializer
+        self.criteria = []
+        if since_id is not None:
+            self.criteria.append(model.id > since_id)
+        if since_date is not None:
+            if not hasattr(model, 'created_date'):
+                raise ValueError('%s has no created date'
+                                 % model.__tablename__)
+            self.criteria.append(model.created_date >= since_date)
+        self.chunk_size = chunk_size
+        self.watermark = None
+        self.rows = 0
+
+    def start(self):
+        """
+        Look up the watermark
+
+        @return last id the export reaches, None for an empty export
+        """
+        query = select([func.max(self.model.id)])
+        for criterion in self.criteria:
+            query = query.where(criterion)
+        with utils.db_session() as session:
+            self.watermark = session.execute(query).scalar()
+        return self.watermark
+
+    def chunks(self):
+        """
+        @return generator of lists of rows of the serializer columns
+        """
+        if self.watermark is None:
+            return
+
+        last = None
+        while True:
+            query = select(self.serializer.columns)\
+                .where(self.model.id <= self.watermark)
+            for criterion in self.criteria:
+                query = query.where(criterion)
+            if last is not None:
+                query = query.where(self.model.id > last)
+            query = query.order_by(self.model.id).limit(self.chunk_size)
+
+            with utils.db_session() as session:
+                rows = session.execute(query).fetchall()
+            if not rows:
+                return
+            self.rows += len(rows)
+            yield rows
+            last = rows[-1][0]
+            if len(rows) < self.chunk_size:
+                return
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def format_chunks(serializer, chunks, fmt):
+    """
+    @return generator of the text of each chunk of rows in fmt, ndjson or
+    csv with a header line
+    """
+    if fmt == 'ndjson':
+        for rows in chunks:
+            yield ''.join(json.dumps(serializer.to_dict(row)) + '\n'
+                          for row in rows)
+        return
+
+    buf = StringIO()
+    writer = csv.writer(buf, lineterminator = '\n')
+    writer.writerow(serializer.names)
+    for rows in chunks:
+        for row in rows:
+            row = list(row)
+            for i in serializer.datetimes:
+                if row[i] is not None:
+                    row[i] = str(row[i])
+            writer.writerow([_csv_value(value) for value in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def gzip_chunks(chunks, level = 6):
+    """
+    @return generator of the gzip stream of the chunks
+    """
+    # wbits 16 + 15 writes the gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(table, fmt = 'ndjson', since = None, compress = False,
+           chunk_size = EXPORT_CHUNK_SIZE):
+    """
+    Export a table
+
+    @param since watermark of the previous export, id or created date
+    @return (Export, generator of the output chunks). The watermark is
+    looked up before the first chunk.
+
+    @raise KeyError for an unknown table, ValueError for an unknown format
+    or invalid since
+    """
+    model = TABLES[table]
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format %s' % fmt)
+    since_id, since_date = parse_since(since) if since else (None, None)
+
+    ret = Export(model, since_id, since_date, chunk_size)
+    ret.start()
+    output = format_chunks(model.serializer, ret.chunks(), fmt)
+    if compress:
+        output = gzip_chunks(output)
+    return ret, output
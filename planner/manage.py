@@ -0,0 +1,151 @@
+"""
+Administrative commands for the planner database
+"""
+import argparse
+import sys
+import export
+import migrations
+import models
+import reservations
+import utils
+import views
+
+
+def migrate(args):
+    """
+    Migrate the db to the current schema version
+    """
+    with utils.db_session() as session:
+        version = migrations.get_version(session.connection())
+
+    print 'schema version %d' % version
+    return 0
+
+
+def check_rollups(args):
+    """
+    Report tasks whose rollup columns do not match their work orders
+    """
+    with utils.db_session() as session:
+        mismatches = utils.check_task_rollups(session)
+
+    for task_id, stored, expected in mismatches:
+        print 'task %d: stored %s expected %s' % (task_id, stored, expected)
+    print '%d task rollups inconsistent' % len(mismatches)
+    return 1 if mismatches else 0
+
+
+def rebuild_rollups(args):
+    """
+    Recompute the task rollup columns from the work orders
+    """
+    with utils.db_session() as session:
+        mismatches = utils.rebuild_task_rollups(session)
+
+    print '%d task rollups rebuilt' % len(mismatches)
+    return 0
+
+
+def check_reservations(args):
+    """
+    Report products whose reservations do not match their work orders or
+    exceed the central inventory
+    """
+    with utils.db_session() as session:
+        problems = reservations.check_reservations(session)
+
+    for product_id, problem in problems:
+        print 'product %d: %s' % (product_id, problem)
+    print '%d reservation problems' % len(problems)
+    return 1 if problems else 0
+
+
+def import_inventory(args):
+    """
+    Import inventory csv lines of product name and quantity
+    """
+    if args.file == '-':
+        fobj = sys.stdin
+    else:
+        fobj = open(args.file)
+
+    with fobj:
+        ret = utils.import_inventory(fobj, chunk_size = args.chunk_size,
+                                     commit_every = args.commit_every)
+
+    print '%d rows imported (%d inserted, %d updated) at %.0f rows/sec' \
+        % (ret['rows'], ret['inserted'], ret['updated'], ret['rows_per_sec'])
+    print '%d lines rejected' % ret['rejected']
+    for line in ret['rejected_lines']:
+        print '  %s' % line
+    return 1 if ret['rejected'] else 0
+
+
+def export_table(args):
+    """
+    Export a table as NDJSON or CSV
+    """
+    result, output = export.export(args.table, args.format, args.since,
+                                   args.gzip, args.chunk_size)
+    fobj = sys.stdout if args.output == '-' else open(args.output, 'wb')
+    try:
+        for chunk in output:
+            fobj.write(chunk)
+    finally:
+        if fobj is not sys.stdout:
+            fobj.close()
+
+    # The rows go to stdout
+    sys.stderr.write('%d rows exported, watermark %s\n'
+                     % (result.rows, result.watermark))
+    return 0
+
+
+def main(argv = None):
+    """
+    Entry function of the planner-admin command
+    """
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+    commands = parser.add_subparsers()
+
+    cmd = commands.add_parser('migrate', help = migrate.__doc__.strip())
+    cmd.set_defaults(func = migrate)
+
+    cmd = commands.add_parser('check-rollups', help = check_rollups.__doc__.strip())
+    cmd.set_defaults(func = check_rollups)
+
+    cmd = commands.add_parser('rebuild-rollups', help = rebuild_rollups.__doc__.strip())
+    cmd.set_defaults(func = rebuild_rollups)
+
+    cmd = commands.add_parser('check-reservations', help = check_reservations.__doc__.strip())
+    cmd.set_defaults(func = check_reservations)
+
+    cmd = commands.add_parser('import-inventory', help = import_inventory.__doc__.strip())
+    cmd.add_argument('file', help = 'csv file, - for stdin')
+    cmd.add_argument('--chunk-size', type = int,
+                     default = views.app.config['IMPORT_CHUNK_SIZE'])
+    cmd.add_argument('--commit-every', type = int,
+                     default = views.app.config['IMPORT_COMMIT_EVERY'])
+    cmd.set_defaults(func = import_inventory)
+
+    cmd = commands.add_parser('export', help = export_table.__doc__.strip())
+    cmd.add_argument('table', choices = sorted(export.TABLES))
+    cmd.add_argument('--format', choices = sorted(export.FORMATS),
+                     default = 'ndjson')
+    cmd.add_argument('--since', help = 'watermark of the previous export, '
+                     'id or created date YYYY-MM-DD[THH:MM:SS]')
+    cmd.add_argument('--gzip', action = 'store_true')
+    cmd.add_argument('--output', default = '-', help = 'file, - for stdout')
+    cmd.add_argument('--chunk-size', type = int,
+                     default = views.app.config['EXPORT_CHUNK_SIZE'])
+    cmd.set_defaults(func = export_table)
+
+    args = parser.parse_args(argv)
+    views.configure_db(views.app)
+    for version in models.init_db():
+        print 'applied schema migration %d' % version
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""
+Per endpoint request and SQL metrics in the Prometheus text format
+"""
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+import threading
+import time
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class EndpointStats(object):
+    """
+    Counters of one endpoint
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency = 0.0
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+
+
+class Registry(object):
+    """
+    Metrics of every endpoint served by the process
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        self.collectors = []
+
+    def add_collector(self, collector):
+        """
+        Add metrics kept outside of the registry. collector() returns a list
+        of (name, type, help, [(labels dict, value)]).
+        """
+        self.collectors.append(collector)
+
+    def record(self, endpoint, latency, statements, db_time, rows):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+
+            stats.requests += 1
+            stats.latency += latency
+            stats.statements += statements
+            stats.db_time += db_time
+            stats.rows += rows
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.buckets[i] += 1
+
+    def render(self):
+        """
+        @return metrics in the Prometheus text exposition format
+        """
+        lines = []
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in samples:
+                if not labels:
+                    lines.append('%s %s' % (name, value))
+                    continue
+                label_text = ','.join('%s="%s"' % item
+                                      for item in sorted(labels.items()))
+                lines.append('%s{%s} %s' % (name, label_text, value))
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            metric('planner_requests_total', 'counter',
+                   'Requests served per endpoint',
+                   [({'endpoint': name}, stats.requests)
+                    for name, stats in endpoints])
+
+            lines.append('# HELP planner_request_latency_seconds Request latency per endpoint')
+            lines.append('# TYPE planner_request_latency_seconds histogram')
+            for name, stats in endpoints:
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    lines.append('planner_request_latency_seconds_bucket{endpoint="%s",le="%s"} %d'
+                                 % (name, bound, count))
+                lines.append('planner_request_latency_seconds_bucket{endpoint="%s",le="+Inf"} %d'
+                             % (name, stats.requests))
+                lines.append('planner_request_latency_seconds_sum{endpoint="%s"} %f'
+                             % (name, stats.latency))
+                lines.append('planner_request_latency_seconds_count{endpoint="%s"} %d'
+                             % (name, stats.requests))
+
+            metric('planner_db_statements_total', 'counter',
+                   'SQL statements executed per endpoint',
+                   [({'endpoint': name}, stats.statements)
+                    for name, stats in endpoints])
+            metric('planner_db_seconds_total', 'counter',
+                   'Time spent executing SQL per endpoint',
+                   [({'endpoint': name}, '%f' % stats.db_time)
+                    for name, stats in endpoints])
+            metric('planner_db_rows_total', 'counter',
+                   'ORM rows loaded and rows written by DML per endpoint',
+                   [({'endpoint': name}, stats.rows)
+                    for name, stats in endpoints])
+
+        for collector in self.collectors:
+            for name, metric_type, help_text, samples in collector():
+                metric(name, metric_type, help_text, samples)
+
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self.lock:
+            self.endpoints.clear()
+
+
+registry = Registry()
+
+
+def _request_stats():
+    """
+    SQL counters of the current request, None outside of requests
+    """
+    if has_app_context():
+        return g.get('metrics')
+    return None
+
+
+def add_rows(count):
+    """
+    Count rows returned by the current request that were not loaded as ORM
+    objects, e.g. rows of column queries
+    """
+    stats = _request_stats()
+    if stats is not None:
+        stats['rows'] += count
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('metrics_start', []).append(time.time())
+    if context is not None:
+        context.metrics_started = True
+
+
+def _statement_done(conn, context, rowcount):
+    if context is not None:
+        context.metrics_started = False
+    elapsed = time.time() - conn.info['metrics_start'].pop()
+    stats = _request_stats()
+    if stats is not None:
+        stats['statements'] += 1
+        stats['db_time'] += elapsed
+        if rowcount > 0:
+            stats['rows'] += rowcount
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    _statement_done(conn, context, cursor.rowcount)
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    # A failing statement, e.g. on a lock conflict, gets no
+    # after_cursor_execute: pop its start time off the pooled connection
+    execution = context.execution_context
+    if getattr(execution, 'metrics_started', False):
+        _statement_done(context.connection, execution, 0)
+
+
+@event.listens_for(Session, 'loaded_as_persistent')
+def loaded_as_persistent(session, instance):
+    stats = _request_stats()
+    if stats is not None:
+        stats['rows'] += 1
+
+
+def init_app(app):
+    """
+    Record the metrics of every request served by app
+    """
+    @app.before_request
+    def start_request_metrics():
+        g.metrics = {'start': time.time(), 'statements': 0, 'db_time': 0.0,
+                     'rows': 0}
+
+    @app.teardown_request
+    def record_request_metrics(exc):
+        stats = g.pop('metrics', None)
+        if stats is None:
+            return
+
+        registry.record(request.endpoint or 'none',
+                        time.time() - stats['start'], stats['statements'],
+                        stats['db_time'], stats['rows'])
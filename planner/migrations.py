@@ -0,0 +1,135 @@
+"""
+Versioned schema migrations of the planner database
+"""
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, select
+from models import Base, Inventory, Task, WorkOrder, ROLLUP_COLUMNS
+from models import session_factory
+import utils
+
+# Schema version of the db, kept apart from the models
+schema_metadata = MetaData()
+schema_version = Table('schema_version', schema_metadata,
+                       Column('version', Integer, nullable = False))
+
+
+def _create_tables(conn):
+    """
+    Tables added since the first schema
+    """
+    Base.metadata.create_all(conn)
+
+
+def _add_task_rollups(conn):
+    """
+    Task status and rollup columns, computed from the work orders
+    """
+    existing = set(column['name']
+                   for column in inspect(conn).get_columns(Task.__tablename__))
+    task = Task.__table__
+
+    if 'status' not in existing:
+        conn.execute('ALTER TABLE task ADD COLUMN status %s'
+                     % task.c.status.type.compile(dialect = conn.dialect))
+    for name in ROLLUP_COLUMNS:
+        if name not in existing:
+            conn.execute('ALTER TABLE task ADD COLUMN %s INTEGER NOT NULL '
+                         'DEFAULT 0' % name)
+
+    session = session_factory(bind = conn)
+    try:
+        utils.rebuild_task_rollups(session)
+        session.commit()
+    finally:
+        session.close()
+
+
+def _create_indexes(conn):
+    """
+    Indexes of the task and work order joins and of the rollup aggregates
+    """
+    names = ('ix_central_inventory_product_name', 'ix_task_plan_id',
+             'ix_work_order_task_status')
+    inspector = inspect(conn)
+    for table in (Inventory.__table__, Task.__table__, WorkOrder.__table__):
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in names and index.name not in existing:
+                index.create(conn)
+
+
+# (version, migration) in order. A db at a version has had every migration
+# up to it applied. Append new migrations, never change applied ones.
+MIGRATIONS = [
+    (1, _create_tables),
+    (2, _add_task_rollups),
+    (3, _create_indexes),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+class SchemaVersionError(Exception):
+    """
+    The db was migrated by a newer planner
+    """
+
+
+def get_version(conn):
+    """
+    @return schema version of the db, 0 for a db created before versioning
+    and None for an empty db
+    """
+    if conn.dialect.has_table(conn, schema_version.name):
+        return conn.execute(select([schema_version.c.version])).scalar() or 0
+    if conn.dialect.has_table(conn, Task.__tablename__):
+        return 0
+    return None
+
+
+def _check_version(version):
+    if version > SCHEMA_VERSION:
+        raise SchemaVersionError('db schema version %d is newer than %d'
+                                 % (version, SCHEMA_VERSION))
+
+
+def upgrade(engine):
+    """
+    Create the tables of an empty db at the current schema version, or
+    apply the migrations past the version of an existing db, in one
+    transaction. A db already at the current version is only read.
+
+    @return list of the versions applied
+    """
+    conn = engine.connect()
+    try:
+        version = get_version(conn)
+    finally:
+        conn.close()
+    if version == SCHEMA_VERSION:
+        return []
+    _check_version(version)
+
+    conn = engine.connect().execution_options(sqlite_begin = 'IMMEDIATE')
+    try:
+        with conn.begin():
+            version = get_version(conn)
+            _check_version(version)
+            applied = []
+            if version is None:
+                Base.metadata.create_all(conn)
+            else:
+                for number, migration in MIGRATIONS:
+                    if number > version:
+                        migration(conn)
+                        applied.append(number)
+
+            if version != SCHEMA_VERSION:
+                schema_metadata.create_all(conn)
+                conn.execute(schema_version.delete())
+                conn.execute(schema_version.insert(),
+                             {'version': SCHEMA_VERSION})
+    finally:
+        conn.close()
+
+    return applied
@@ -1,13 +1,88 @@
 from sqlalchemy import create_engine
 from sqlalchemy import event
 from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Enum
+from sqlalchemy import and_, bindparam, case, select
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy.schema import CheckConstraint
+from sqlalchemy.orm import relationship, sessionmaker, Session, attributes
+from sqlalchemy.orm import object_mapper
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CheckConstraint, Index
 import datetime
+import operator
 
 Base = declarative_base()
-engine = create_engine('sqlite:///planner.db', echo=True)
+engine = None
+
+# Shared session factory, bound by configure_engine
+session_factory = sessionmaker()
+
+
+def configure_engine(url = 'sqlite:///planner.db', echo = False,
+                     pool_size = 5, pool_timeout = 30, sqlite_pragmas = False,
+                     sqlite_cache_size = 64000, sqlite_mmap_size = 268435456):
+    """
+    Create the db engine and bind the session factory to it. Replaces any
+    previously configured engine.
+
+    @param url database url
+    @param echo log every statement
+    @param pool_size connections kept open by the pool
+    @param pool_timeout seconds to wait for a connection from the pool
+    @param sqlite_pragmas use WAL journaling, synchronous=NORMAL, a larger
+    page cache and memory mapped io on every sqlite connection
+    @param sqlite_cache_size page cache size in KiB
+    @param sqlite_mmap_size bytes of the db file to memory map
+
+    @return engine
+    """
+    global engine
+
+    kwargs = {
+        'echo': echo,
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'pool_timeout': pool_timeout,
+    }
+    is_sqlite = url.startswith('sqlite')
+    if is_sqlite:
+        # Pooled connections are handed out to any thread
+        kwargs['connect_args'] = {'check_same_thread': False}
+
+    if engine is not None:
+        engine.dispose()
+    engine = create_engine(url, **kwargs)
+
+    if is_sqlite:
+        # pysqlite only emits BEGIN ahead of DML, so the reads of a
+        # transaction are not isolated from concurrent writers. Let
+        # sqlalchemy emit BEGIN itself at the start of every transaction.
+        # The sqlite_begin execution option selects BEGIN IMMEDIATE for
+        # transactions taking the write lock up front.
+        @event.listens_for(engine, 'connect')
+        def disable_pysqlite_begin(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def emit_begin(conn):
+            mode = conn.get_execution_options().get('sqlite_begin', 'DEFERRED')
+            conn.execute('BEGIN %s' % mode)
+
+    if is_sqlite and sqlite_pragmas:
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA cache_size=%d' % -sqlite_cache_size)
+            cursor.execute('PRAGMA mmap_size=%d' % sqlite_mmap_size)
+            cursor.close()
+
+    session_factory.configure(bind = engine)
+    return engine
+
+
+configure_engine()
 
 class Status(object):
     NOTSTARTED = 'not started'
@@ -18,13 +93,63 @@ class Status(object):
 STATUS_ENUM = Enum(Status.NOTSTARTED, Status.INPROGRESS, Status.COMPLETED)   
 
 
+class Serializer(object):
+    """
+    Converts rows of a model to dicts. The column names, the columns to
+    query and the datetime converters are resolved once from the table
+    instead of on every row.
+    """
+
+    def __init__(self, model, names = None):
+        table_columns = [col for col in model.__table__.columns
+                         if names is None or col.name in names]
+        self.model = model
+        self.names = tuple(col.name for col in table_columns)
+        # Select these to serialize rows without loading the objects
+        self.columns = tuple(getattr(model, name) for name in self.names)
+        self.datetimes = tuple(i for i, col in enumerate(table_columns)
+                               if type(col.type) == DateTime)
+        self.values = operator.attrgetter(*self.names)
+        if len(self.names) == 1:
+            # attrgetter of one name returns the value, not a tuple
+            getter = self.values
+            self.values = lambda obj: (getter(obj),)
+        self.projections = {}
+
+    def project(self, names):
+        """
+        Serializer of the named columns only, in table order. Built once
+        per set of names.
+        """
+        key = frozenset(names)
+        ret = self.projections.get(key)
+        if ret is None:
+            ret = self.projections[key] = Serializer(self.model, key)
+        return ret
+
+    def to_dict(self, row, link = None):
+        """
+        @param row tuple of the values of self.columns
+        @param link added to the dict when set
+        """
+        if self.datetimes:
+            row = list(row)
+            for i in self.datetimes:
+                row[i] = str(row[i])
+        ret = dict(zip(self.names, row))
+        if link:
+            ret['link'] = link
+
+        return ret
+
+
 class Inventory(Base):
     """
     Table for central inventory
     """
     __tablename__ = 'central_inventory'
     id = Column(Integer, primary_key = True)
-    product_name = Column(String)
+    product_name = Column(String, index = True)
     quantity = Column(Integer, CheckConstraint('quantity >= 0'))
     work_order_inventory = relationship('WorkOrderInventory', backref = 'inventory', uselist = False)
 
@@ -37,11 +162,7 @@ class Inventory(Base):
         self.quantity = int(quantity)
 
     def as_dict(self, link = None):
-        ret = {c.name: getattr(self, c.name) for c in self.__table__.columns}
-        if link:
-            ret['link'] = link
-
-        return ret
+        return self.serializer.to_dict(self.serializer.values(self), link)
 
 
 class Plan(Base):
@@ -63,14 +184,7 @@ class Plan(Base):
         self.name = name
 
     def as_dict(self, link = None, task_base = None):
-        ret = {}
-        for col in self.__table__.columns:
-            if type(col.type) == DateTime:
-                ret[col.name] = str(getattr(self, col.name))
-            else:
-                ret[col.name] = getattr(self, col.name)
-        if link:
-            ret['link'] = link
+        ret = self.serializer.to_dict(self.serializer.values(self), link)
 
         if task_base:
             tasks = []
@@ -90,10 +204,19 @@ class Task(Base):
     __tablename__ = 'task'
     id = Column(Integer, primary_key = True)
     created_date = Column(DateTime, default = datetime.datetime.utcnow)
-    plan_id = Column(Integer, ForeignKey('plan.id'), nullable = False)
+    plan_id = Column(Integer, ForeignKey('plan.id'), nullable = False, index = True)
     product_id = Column(Integer, nullable = False)
     target_quantity = Column(Integer, nullable = False)
-#    status = Column(STATUS_ENUM, default = Status.NOTSTARTED)
+
+    # Rollups of the work orders of the task. Maintained incrementally by
+    # update_task_rollups on every flush of work order changes
+    status = Column(STATUS_ENUM, default = Status.NOTSTARTED)
+    wo_not_started = Column(Integer, default = 0, nullable = False)
+    wo_in_progress = Column(Integer, default = 0, nullable = False)
+    wo_completed = Column(Integer, default = 0, nullable = False)
+    wo_target_quantity = Column(Integer, default = 0, nullable = False)
+    wo_actual_quantity = Column(Integer, default = 0, nullable = False)
+
     work_order = relationship('WorkOrder', backref = 'task', cascade = 'all, delete, delete-orphan')
 
 
@@ -102,17 +225,11 @@ class Task(Base):
         self.product_id = product_id
         self.target_quantity = quantity
 
-    def get_status(self):
-        complete_wo = 0
-        not_started_wo = 0
-
-        for wo in self.work_order:
-            if wo.status == Status.COMPLETED:
-                complete_wo += 1
-            elif wo.status == Status.NOTSTARTED:
-                not_started_wo += 1
-
-        num_wo = len(self.work_order)
+    @staticmethod
+    def compute_status(num_wo, complete_wo, not_started_wo):
+        """
+        Derive the task status from the work order counts of the task
+        """
         if num_wo > 0 and num_wo == complete_wo:
             return Status.COMPLETED
         elif num_wo == not_started_wo:
@@ -120,24 +237,27 @@ class Task(Base):
         else:
             return Status.INPROGRESS
 
-    def get_total_actual(self):
-        wo_actual_quantity = 0
-        for wo in self.work_order:
-            wo_actual_quantity += wo.actual_quantity
+    def get_status(self):
+        return self.status
 
-        return wo_actual_quantity
+    def get_num_work_orders(self):
+        return self.wo_not_started + self.wo_in_progress + self.wo_completed
+
+    def get_total_actual(self):
+        return self.wo_actual_quantity
 
     def as_dict(self, include_wo = False, link = None):
-        ret = {}
-        for col in self.__table__.columns:
-            if type(col.type) == DateTime:
-                ret[col.name] = str(getattr(self, col.name))
-            else:
-                ret[col.name] = getattr(self, col.name)
-
-        ret['status'] = self.get_status()
+        return self.row_as_dict(self.serializer.values(self), include_wo,
+                                link)
+
+    @classmethod
+    def row_as_dict(cls, row, include_wo = False, link = None):
+        """
+        Serialize a tuple of the values of serializer.columns like as_dict
+        """
+        ret = cls.serializer.to_dict(row)
         if include_wo:
-            ret['actual_quantity'] = self.get_total_actual()
+            ret['actual_quantity'] = ret['wo_actual_quantity']
         if link:
             ret['link'] = link
 
@@ -150,6 +270,9 @@ class WorkOrder(Base):
     """
 
     __tablename__ = 'work_order'
+    # Covers the work orders of a task and the rollup aggregates over them
+    __table_args__ = (Index('ix_work_order_task_status', 'task_id', 'status',
+                            'target_quantity', 'actual_quantity'),)
     id = Column(Integer, primary_key = True)
     created_date = Column(DateTime, default = datetime.datetime.utcnow)
     task_id = Column(Integer, ForeignKey('task.id'), nullable = False)
@@ -158,15 +281,7 @@ class WorkOrder(Base):
     actual_quantity = Column(Integer, default = 0)
 
     def as_dict(self, link = None):
-        ret = {}
-        for col in self.__table__.columns:
-            if type(col.type) == DateTime:
-                ret[col.name] = str(getattr(self, col.name))
-            else:
-                ret[col.name] = getattr(self, col.name)
-        if link:
-            ret['link'] = link
-        return ret
+        return self.serializer.to_dict(self.serializer.values(self), link)
 
 
 class WorkOrderInventory(Base):
@@ -187,18 +302,254 @@ class WorkOrderInventory(Base):
         self.active_inventory = 0
 
 
-# @event.listens_for(WorkOrder.status, 'set')
-# def wo_updated(target, value, old_value, initiator):
-#     print "::: in event handler", value
-#     with utils.db_session() as session:
-#         query_res = session.query(Task).get(target.task_id)
-#         assert(query_res)
-            
-#         query_res.status = value
-#         session.flush()
+class ReservationStripe(Base):
+    """
+    Table of striped work order reservations, used instead of
+    WorkOrderInventory when RESERVATION_STRIPES is set. The reservations of
+    a product are spread over several rows so concurrent work orders of a
+    hot product update different rows. Each stripe reserves from its own
+    allotment of the central inventory, the allotments of a product never
+    exceed its central quantity.
+    """
+
+    __tablename__ = 'reservation_stripe'
+    product_id = Column(Integer, ForeignKey('central_inventory.id'), primary_key = True)
+    stripe = Column(Integer, primary_key = True, autoincrement = False)
+    allotted = Column(Integer, default = 0, nullable = False)
+    active = Column(Integer, default = 0, nullable = False)
+
+
+for _model in (Inventory, Plan, Task, WorkOrder):
+    _model.serializer = Serializer(_model)
+
+
+# Task rollup column counting the work orders of each status
+STATUS_ROLLUP = {
+    Status.NOTSTARTED: 'wo_not_started',
+    Status.INPROGRESS: 'wo_in_progress',
+    Status.COMPLETED: 'wo_completed',
+}
+
+ROLLUP_COLUMNS = ('wo_not_started', 'wo_in_progress', 'wo_completed',
+                  'wo_target_quantity', 'wo_actual_quantity')
+
+
+def _committed_value(obj, key):
+    """
+    Value of an attribute before the changes being flushed
+    """
+    history = attributes.get_history(obj, key)
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(obj, key)
+
+
+def _add_rollup(deltas, task_id, status, target, actual, sign):
+    if task_id is None:
+        return
+
+    delta = deltas.setdefault(task_id, dict.fromkeys(ROLLUP_COLUMNS, 0))
+    delta[STATUS_ROLLUP[status or Status.NOTSTARTED]] += sign
+    delta['wo_target_quantity'] += sign * (target or 0)
+    delta['wo_actual_quantity'] += sign * (actual or 0)
+
+
+# Compiled forms of the statements run through execute_cached
+compiled_cache = {}
+
+
+def execute_cached(session, stmt, params):
+    """
+    Execute a statement built once with bind parameters in the transaction
+    of session. It is compiled on first use only.
+    """
+    return session.connection()\
+        .execution_options(compiled_cache = compiled_cache)\
+        .execute(stmt, params)
+
+
+def task_rollup_values():
+    """
+    Values for an UPDATE of the task table applying the rollup deltas,
+    bound as d_<rollup column>. The status is derived from the updated
+    counts in the same statement.
+    """
+    task = Task.__table__
+    values = {}
+    for name in ROLLUP_COLUMNS:
+        values[name] = task.c[name] + bindparam('d_' + name, type_ = Integer)
+
+    not_started = values['wo_not_started']
+    completed = values['wo_completed']
+    num_wo = not_started + values['wo_in_progress'] + completed
+    values['status'] = case([
+            (and_(num_wo > 0, completed == num_wo), Status.COMPLETED),
+            (not_started == num_wo, Status.NOTSTARTED)],
+            else_ = Status.INPROGRESS)
+    return values
+
+
+TASK_ROLLUP_UPDATE = Task.__table__.update()\
+    .where(Task.__table__.c.id == bindparam('task_id'))\
+    .values(task_rollup_values())
+
+
+@event.listens_for(Session, 'after_flush')
+def update_task_rollups(session, flush_context):
+    """
+    Apply the work orders created, updated or deleted by the flush to the
+    rollup columns of their tasks, in the same transaction.
+    """
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, WorkOrder):
+            _add_rollup(deltas, obj.task_id, obj.status,
+                        obj.target_quantity, obj.actual_quantity, 1)
+
+    for obj in session.deleted:
+        if isinstance(obj, WorkOrder):
+            _add_rollup(deltas, _committed_value(obj, 'task_id'),
+                        _committed_value(obj, 'status'),
+                        _committed_value(obj, 'target_quantity'),
+                        _committed_value(obj, 'actual_quantity'), -1)
+
+    for obj in session.dirty:
+        if isinstance(obj, WorkOrder) and session.is_modified(obj):
+            _add_rollup(deltas, _committed_value(obj, 'task_id'),
+                        _committed_value(obj, 'status'),
+                        _committed_value(obj, 'target_quantity'),
+                        _committed_value(obj, 'actual_quantity'), -1)
+            _add_rollup(deltas, obj.task_id, obj.status,
+                        obj.target_quantity, obj.actual_quantity, 1)
+
+    for task_id, delta in deltas.items():
+        if not any(delta.values()):
+            continue
+
+        params = dict(('d_' + name, value) for name, value in delta.items())
+        params['task_id'] = task_id
+        execute_cached(session, TASK_ROLLUP_UPDATE, params)
+        session.info.setdefault('rollup_tasks', set()).add(task_id)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def expire_task_rollups(session, flush_context):
+    """
+    Reload the rollups of tasks already in the session on next access
+    """
+    for task_id in session.info.pop('rollup_tasks', ()):
+        task = session.identity_map.get(identity_key(Task, task_id))
+        if task is not None and task in session:
+            session.expire(task, ('status',) + ROLLUP_COLUMNS)
+
+
+class ChangeSet(object):
+    """
+    Rows written by the transaction of a session. utils.db_session hands it
+    to the commit listeners once the transaction commits.
+    """
+
+    def __init__(self):
+        # table name -> {primary key: {'op': insert/update/delete, ...}}
+        self.rows = {}
+        # plans whose tasks or work orders changed, or that changed
+        self.plans = set()
+
+    def __nonzero__(self):
+        return bool(self.rows)
+
+    def add(self, table, pk, op, **attrs):
+        row = self.rows.setdefault(table, {}).setdefault(pk, {})
+        if op == 'delete' or 'op' not in row:
+            row['op'] = op
+        row.update(attrs)
+
+    def ids(self, table):
+        return set(self.rows.get(table, ()))
+
+
+def get_changes(session):
+    """
+    ChangeSet of the current transaction of a session
+    """
+    return session.info.setdefault('changes', ChangeSet())
+
+
+def record_change(session, table, pk, op = 'update', plan_id = None, **attrs):
+    """
+    Record a row written with a core statement, which bypasses the flush
+    """
+    changes = get_changes(session)
+    changes.add(table, pk, op, **attrs)
+    if plan_id is not None:
+        changes.plans.add(plan_id)
+
+
+@event.listens_for(Session, 'after_flush')
+def record_changes(session, flush_context):
+    """
+    Record the rows written by the flush in the ChangeSet of the session
+    """
+    changes = get_changes(session)
+    task_ids = set(session.info.get('rollup_tasks', ()))
+
+    for objs, op in ((session.new, 'insert'), (session.dirty, 'update'),
+                     (session.deleted, 'delete')):
+        for obj in objs:
+            if op == 'update' and not session.is_modified(obj):
+                continue
+
+            pk = object_mapper(obj).primary_key_from_instance(obj)[0]
+            if isinstance(obj, Plan):
+                changes.plans.add(pk)
+            elif isinstance(obj, Task):
+                changes.plans.add(obj.plan_id)
+                changes.plans.add(_committed_value(obj, 'plan_id'))
+                changes.add(obj.__tablename__, pk, op, plan_id = obj.plan_id)
+                continue
+            elif isinstance(obj, WorkOrder):
+                task_ids.add(obj.task_id)
+                task_ids.add(_committed_value(obj, 'task_id'))
+                changes.add(obj.__tablename__, pk, op, task_id = obj.task_id)
+                continue
+
+            changes.add(obj.__tablename__, pk, op)
+
+    # Plans of the tasks whose work orders changed
+    unresolved = []
+    for task_id in task_ids:
+        if task_id is None:
+            continue
+        if task_id in session.info.get('rollup_tasks', ()):
+            changes.add(Task.__tablename__, task_id, 'update')
+
+        task = session.identity_map.get(identity_key(Task, task_id))
+        plan_id = None
+        if task is not None:
+            plan_id = attributes.instance_dict(task).get('plan_id')
+        if plan_id is None:
+            unresolved.append(task_id)
+        else:
+            changes.plans.add(plan_id)
+
+    if unresolved:
+        task = Task.__table__
+        for plan_id, in session.execute(
+                select([task.c.plan_id]).where(task.c.id.in_(unresolved))):
+            changes.plans.add(plan_id)
+
+    changes.plans.discard(None)
+
 
 def init_db():
     """
-    Create the db tables
+    Create the db tables, or migrate the tables of an existing db to the
+    current schema
+
+    @return list of the migrations applied
     """
-    Base.metadata.create_all(engine)
+    # migrations builds on the models
+    import migrations
+    return migrations.upgrade(engine)
@@ -0,0 +1,252 @@
+"""
+Pre-fork server: worker processes serving one inherited listen socket,
+supervised by the master process
+"""
+from gevent.pywsgi import WSGIServer
+import errno
+import gevent
+import gevent.socket
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+import events
+import models
+import reports
+
+# Seconds between the heartbeats of a worker
+HEARTBEAT_INTERVAL = 1.0
+# Change events per relayed message, one datagram each
+RELAY_BATCH = 100
+MAX_MESSAGE = 262144
+
+
+def _log(message):
+    sys.stderr.write('[%d] %s\n' % (os.getpid(), message))
+
+
+def _recv_all(channel):
+    """
+    @return the datagrams waiting on channel
+    """
+    messages = []
+    while True:
+        try:
+            messages.append(channel.recv(MAX_MESSAGE, socket.MSG_DONTWAIT))
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return messages
+            raise
+
+
+class Worker(object):
+    """
+    Master side of a worker process
+    """
+
+    def __init__(self, pid, channel):
+        self.pid = pid
+        self.channel = channel
+        self.seen = time.time()
+
+
+class PreforkServer(object):
+    """
+    Serves app from workers forked by the master, sharing the listen socket
+    the master bound. Each worker runs the gevent WSGIServer with its own
+    db engine, db pool and caches. The master restarts workers that exit or
+    miss their heartbeats for timeout seconds, and relays the change events
+    of every worker to the others over unix datagram sockets. SIGTERM or
+    SIGINT stops the workers gracefully: they stop accepting and finish the
+    requests in flight within shutdown_timeout seconds.
+
+    @param setup called in every worker after the fork to create the db
+    engine, no connection of the master is used by the workers
+    @param server_class gevent WSGIServer class run by the workers
+    @param ready called once the listen socket is bound
+    """
+
+    def __init__(self, app, address, workers, setup, timeout = 30,
+                 shutdown_timeout = 10, server_class = WSGIServer,
+                 ready = None):
+        self.app = app
+        self.ready = ready
+        self.server_class = server_class
+        self.address = address
+        self.num_workers = workers
+        self.setup = setup
+        self.timeout = timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.workers = {}
+        self.listener = None
+        self.stopping = False
+
+    def serve_forever(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.address)
+        self.listener.listen(1024)
+        models.engine.dispose()
+        if self.ready is not None:
+            self.ready()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        try:
+            while not self.stopping:
+                while len(self.workers) < self.num_workers:
+                    self._spawn()
+                self._supervise(HEARTBEAT_INTERVAL)
+        finally:
+            self._shutdown()
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _spawn(self):
+        master_end, worker_end = socket.socketpair(socket.AF_UNIX,
+                                                   socket.SOCK_DGRAM)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                master_end.close()
+                for worker in self.workers.values():
+                    worker.channel.close()
+                self._run_worker(worker_end)
+                status = 0
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+
+        worker_end.close()
+        master_end.setblocking(False)
+        self.workers[pid] = Worker(pid, master_end)
+        _log('started worker %d' % pid)
+
+    def _supervise(self, wait):
+        channels = dict((worker.channel, worker)
+                        for worker in self.workers.values())
+        try:
+            readable = select.select(list(channels), [], [], wait)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+
+        now = time.time()
+        for channel in readable:
+            worker = channels[channel]
+            worker.seen = now
+            for message in _recv_all(channel):
+                if not message.startswith('events '):
+                    continue
+                for other in self.workers.values():
+                    if other is worker:
+                        continue
+                    try:
+                        other.channel.send(message)
+                    except socket.error:
+                        # Not reading, its heartbeat times out
+                        pass
+
+        self._reap()
+        for worker in self.workers.values():
+            if now - worker.seen > self.timeout:
+                _log('worker %d missed its heartbeats, killing it'
+                     % worker.pid)
+                os.kill(worker.pid, signal.SIGKILL)
+                worker.seen = now
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+
+            worker = self.workers.pop(pid, None)
+            if worker is not None:
+                worker.channel.close()
+                if not self.stopping:
+                    _log('worker %d exited with status %d' % (pid, status))
+
+    def _shutdown(self):
+        for worker in self.workers.values():
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        deadline = time.time() + self.shutdown_timeout + 5
+        while self.workers and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for worker in self.workers.values():
+            _log('worker %d did not stop, killing it' % worker.pid)
+            os.kill(worker.pid, signal.SIGKILL)
+            os.waitpid(worker.pid, 0)
+        self.workers.clear()
+        self.listener.close()
+
+    def _run_worker(self, channel):
+        gevent.reinit()
+        # The master stops the workers, also on Ctrl-C
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        self.setup()
+        events.event_feed.reset()
+        events.event_feed.relay = lambda rows: self._relay(channel, rows)
+        reports.report_cache.shared = True
+
+        listener = gevent.socket.fromfd(self.listener.fileno(),
+                                        socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.close()
+        server = self.server_class(listener, self.app)
+
+        def stop():
+            if not self.stopping:
+                self.stopping = True
+                gevent.spawn(server.stop, timeout = self.shutdown_timeout)
+
+        gevent.signal_handler(signal.SIGTERM, stop)
+        gevent.spawn(self._heartbeat, channel)
+        gevent.spawn(self._receive, channel)
+        server.serve_forever()
+
+    def _heartbeat(self, channel):
+        while True:
+            try:
+                channel.send('ping', socket.MSG_DONTWAIT)
+            except socket.error:
+                pass
+            gevent.sleep(HEARTBEAT_INTERVAL)
+
+    def _receive(self, channel):
+        while True:
+            gevent.socket.wait_read(channel.fileno())
+            for message in _recv_all(channel):
+                if message.startswith('events '):
+                    events.event_feed.add(json.loads(message[len('events '):]))
+
+    def _relay(self, channel, rows):
+        """
+        Send change events to the master for the other workers, called
+        from any thread
+        """
+        for i in range(0, len(rows), RELAY_BATCH):
+            try:
+                channel.send('events ' + json.dumps(rows[i:i + RELAY_BATCH]))
+            except socket.error as e:
+                _log('change events not relayed: %s' % e)
+                return
@@ -0,0 +1,166 @@
+"""
+Planned vs actual quantity reports
+"""
+import threading
+from models import Inventory, Plan, Task
+from cache import table_versions
+import utils
+
+# Tables a report is built from
+REPORT_TABLES = ('plan', 'task', 'central_inventory')
+
+
+def query_report(session, plan_id = None):
+    """
+    One query over plan, task and central_inventory returning a row per
+    task of the plans. The actual quantities come from the rollup columns
+    of the tasks, so work_order does not need to be scanned.
+
+    @return query of (plan_id, plan_name, task_id, status, product_id,
+                      product_name, balance, planned, work order target,
+                      actual)
+    """
+    query_res = session.query(
+        Plan.id, Plan.name, Task.id, Task.status, Task.product_id,
+        Inventory.product_name, Inventory.quantity, Task.target_quantity,
+        Task.wo_target_quantity, Task.wo_actual_quantity)\
+        .outerjoin(Task)\
+        .outerjoin(Inventory, Inventory.id == Task.product_id)\
+        .order_by(Plan.id, Task.id)
+
+    if plan_id is not None:
+        query_res = query_res.filter(Plan.id == plan_id)
+    return query_res
+
+
+def build_report(session, plan_id = None):
+    """
+    Build the planned vs actual report of a plan, or of every plan. Each
+    plan lists its tasks and the planned and actual quantities rolled up per
+    product. The current inventory balance is reported too: of the products
+    the plan uses for a plan, of every product for every plan.
+
+    @return report dict, ids of the products in the report, None when it
+    has every product
+    """
+    plans = []
+    plan = None
+    products = {}
+    inventory = {}
+
+    for (row_plan_id, name, task_id, status, product_id, product_name,
+         balance, planned, wo_target, actual) in query_report(session, plan_id):
+        if plan is None or plan['id'] != row_plan_id:
+            plan = {'id': row_plan_id, 'name': name, 'tasks': [],
+                    'planned_quantity': 0, 'actual_quantity': 0}
+            plans.append(plan)
+            products = {}
+            plan['products'] = products
+
+        if task_id is None:
+            continue
+
+        plan['tasks'].append({'id': task_id, 'status': status,
+                              'product_id': product_id,
+                              'product_name': product_name,
+                              'planned_quantity': planned,
+                              'work_order_quantity': wo_target,
+                              'actual_quantity': actual})
+        plan['planned_quantity'] += planned
+        plan['actual_quantity'] += actual
+
+        product = products.setdefault(product_id, {
+                'product_id': product_id, 'product_name': product_name,
+                'planned_quantity': 0, 'actual_quantity': 0})
+        product['planned_quantity'] += planned
+        product['actual_quantity'] += actual
+
+        inventory[product_id] = {'product_id': product_id,
+                                 'product_name': product_name,
+                                 'quantity': balance}
+
+    for plan in plans:
+        plan['products'] = sorted(plan['products'].values(),
+                                  key = lambda product: product['product_id'])
+
+    products = set(inventory)
+    if plan_id is None:
+        # Products no task uses yet included
+        products = None
+        inventory = dict(
+            (product_id, {'product_id': product_id,
+                          'product_name': product_name,
+                          'quantity': quantity})
+            for product_id, product_name, quantity in session.query(
+                Inventory.id, Inventory.product_name, Inventory.quantity))
+
+    ret = {'plans': plans,
+           'inventory': sorted(inventory.values(),
+                               key = lambda product: product['product_id'])}
+    return ret, products
+
+
+class ReportCache(object):
+    """
+    In-process cache of reports keyed by plan id (None for every plan).
+    Entries are dropped when a transaction changing their plan or the
+    inventory of one of their products commits, the report of every plan
+    on any plan or inventory change.
+    """
+
+    def __init__(self):
+        self.reports = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+        # Set in the workers of the pre-fork server, which do not see the
+        # commits of the other workers. Reports are then also dropped when
+        # the shared versions of their tables change.
+        self.shared = False
+
+    def get(self, plan_id, build):
+        """
+        Get the report of plan_id, building it with build() on a miss. The
+        empty report of an unknown plan is not cached, nothing would drop
+        the entries of ids requested at random.
+
+        @return report dict
+        """
+        versions = table_versions.get(REPORT_TABLES) if self.shared else None
+        entry = self.reports.get(plan_id)
+        if entry is not None and entry[2] == versions:
+            return entry[0]
+
+        generation = self.generation
+        report, products = build()
+        with self.lock:
+            # Do not cache a report that a commit may have made stale
+            # while it was being built
+            if generation == self.generation and \
+                    (plan_id is None or report['plans']):
+                self.reports[plan_id] = (report, products, versions)
+        return report
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.reports.clear()
+
+    def invalidate(self, changes):
+        """
+        Drop the reports affected by a models.ChangeSet
+        """
+        products = changes.ids(Inventory.__tablename__)
+        if not changes.plans and not products:
+            return
+
+        with self.lock:
+            self.generation += 1
+            for plan_id, (report, report_products, versions) \
+                    in self.reports.items():
+                if plan_id is None or plan_id in changes.plans or \
+                        report_products & products:
+                    del self.reports[plan_id]
+
+
+report_cache = ReportCache()
+utils.on_commit(report_cache.invalidate)
@@ -0,0 +1,237 @@
+"""
+Striped work order reservations of the central inventory
+"""
+from sqlalchemy import Integer, bindparam, func, or_, select
+from models import Inventory, ReservationStripe, Status, Task, WorkOrder
+from models import WorkOrderInventory, execute_cached, record_change
+
+
+def _take_statement():
+    """
+    Add b_quantity to the reservations of a stripe when its allotment has
+    room for it. Negative quantities release reservations.
+    """
+    stripes = ReservationStripe.__table__
+    quantity = bindparam('b_quantity', type_ = Integer)
+    return stripes.update()\
+        .where(stripes.c.product_id == bindparam('b_product_id',
+                                                 type_ = Integer))\
+        .where(stripes.c.stripe == bindparam('b_stripe', type_ = Integer))\
+        .where(stripes.c.active + quantity <= stripes.c.allotted)\
+        .where(stripes.c.active + quantity >= 0)\
+        .values(active = stripes.c.active + quantity)
+
+_TAKE = _take_statement()
+
+
+class StripedReservations(object):
+    """
+    Work order reservations of a product spread over stripes rows of
+    reservation_stripe. A work order always reserves on the stripe of its
+    id, which only reads and writes that row as long as its allotment
+    suffices. A stripe running dry rebalances the product: the central
+    quantity not reserved by any stripe is allotted again, the requesting
+    stripe first and the rest evenly. The allotments of a product never
+    exceed its central quantity, so neither do its reservations.
+
+    With 0 stripes the reservations are kept on the single
+    work_order_inventory row of each product. Change between 0 and a
+    number of stripes only without active reservations, the stripe count
+    itself can change at any time.
+    """
+
+    def __init__(self, stripes = 0):
+        self.stripes = stripes
+
+    def configure(self, stripes):
+        self.stripes = stripes
+
+    def reserve(self, session, product_id, quantity, key = 0):
+        """
+        Reserve quantity of a product on the stripe of key, or release it
+        when quantity is negative
+
+        @return True if the reservation was made
+        """
+        stripe = key % self.stripes
+        params = {'b_product_id': product_id, 'b_stripe': stripe,
+                  'b_quantity': quantity}
+        if execute_cached(session, _TAKE, params).rowcount == 1:
+            record_change(session, ReservationStripe.__tablename__, product_id)
+            return True
+
+        return self.rebalance(session, product_id, stripe, quantity)
+
+    def debit(self, session, product_id, quantity):
+        """
+        Debit quantity from the central inventory and release as much of
+        the reservations of the product
+
+        @return True if the central inventory had enough product
+        """
+        central = Inventory.__table__
+        res = session.execute(central.update()
+                              .where(central.c.id == product_id)
+                              .where(central.c.quantity >= quantity)
+                              .values(quantity = central.c.quantity - quantity))
+        if res.rowcount != 1:
+            return False
+
+        record_change(session, central.name, product_id)
+        return self.rebalance(session, product_id, 0, -quantity)
+
+    def rebalance(self, session, product_id, stripe = 0, quantity = 0):
+        """
+        Apply quantity to stripe and spread the unreserved central quantity
+        over the allotments of the stripes of a product. Releases that do
+        not fit the stripe, reserved under another stripe count, are taken
+        from the other stripes. Locks the rows of the product.
+
+        @return False if the product does not exist or has not enough
+        unreserved quantity
+        """
+        central = Inventory.__table__
+        wo_inventory = WorkOrderInventory.__table__
+        stripes = ReservationStripe.__table__
+
+        available = session.execute(
+            select([central.c.quantity])
+            .where(central.c.id == product_id).with_for_update()).scalar()
+        if available is None:
+            return False
+        available -= session.execute(
+            select([wo_inventory.c.active_inventory])
+            .where(wo_inventory.c.product_id == product_id)).scalar() or 0
+
+        active = dict(session.execute(
+                select([stripes.c.stripe, stripes.c.active])
+                .where(stripes.c.product_id == product_id)
+                .with_for_update()).fetchall())
+        missing = [i for i in range(self.stripes) if i not in active]
+        for i in missing:
+            active[i] = 0
+
+        if quantity >= 0:
+            if sum(active.values()) + quantity > available:
+                return False
+            active[stripe] += quantity
+        else:
+            release = -quantity
+            for i in [stripe] + sorted(active):
+                taken = min(active[i], release)
+                active[i] -= taken
+                release -= taken
+            if release:
+                return False
+
+        free = max(available - sum(active.values()), 0)
+        share = free // self.stripes
+        allotted = {}
+        for i in active:
+            allotted[i] = active[i] + (share if i < self.stripes else 0)
+        allotted[stripe] += free - share * self.stripes
+
+        rows = [{'b_stripe': i, 'b_active': active[i],
+                 'b_allotted': allotted[i]} for i in sorted(active)]
+        if missing:
+            session.execute(stripes.insert(), [
+                    {'product_id': product_id, 'stripe': i, 'active': 0,
+                     'allotted': 0} for i in missing])
+        session.execute(stripes.update()
+                        .where(stripes.c.product_id == product_id)
+                        .where(stripes.c.stripe == bindparam('b_stripe'))
+                        .values(active = bindparam('b_active'),
+                                allotted = bindparam('b_allotted')), rows)
+        record_change(session, stripes.name, product_id)
+        return True
+
+
+def active_reservations(session, product_ids):
+    """
+    @return {product id: active reservations} over work_order_inventory and
+    the stripes
+    """
+    wo_inventory = WorkOrderInventory.__table__
+    stripes = ReservationStripe.__table__
+
+    ret = dict((product_id, 0) for product_id in product_ids)
+    if not ret:
+        return ret
+    for product_id, active in session.execute(
+            select([wo_inventory.c.product_id, wo_inventory.c.active_inventory])
+            .where(wo_inventory.c.product_id.in_(list(product_ids)))):
+        ret[product_id] += active or 0
+    for product_id, active in session.execute(
+            select([stripes.c.product_id, func.sum(stripes.c.active)])
+            .where(stripes.c.product_id.in_(list(product_ids)))
+            .group_by(stripes.c.product_id)):
+        ret[product_id] += active or 0
+    return ret
+
+
+def shrink_allotments(session, product_ids):
+    """
+    Take back the allotments not reserved, before lowering the central
+    quantity of products. The next reservation rebalances them.
+    """
+    stripes = ReservationStripe.__table__
+    product_ids = list(product_ids)
+    session.execute(stripes.update()
+                    .where(stripes.c.product_id.in_(product_ids))
+                    .where(stripes.c.allotted != stripes.c.active)
+                    .values(allotted = stripes.c.active))
+    for product_id in product_ids:
+        record_change(session, stripes.name, product_id)
+
+
+def check_reservations(session):
+    """
+    Compare the reservations of every product against the work orders of
+    its tasks that are not completed, whose actual quantity is reserved,
+    and check that the stripes stay within their allotments and the
+    allotments within the central quantity
+
+    @return list of (product_id, problem) found
+    """
+    central = Inventory.__table__
+    wo_inventory = WorkOrderInventory.__table__
+    stripes = ReservationStripe.__table__
+
+    expected = dict(session.query(Task.product_id,
+                                  func.sum(WorkOrder.actual_quantity))
+                    .join(WorkOrder)
+                    .filter(Task.status != Status.COMPLETED)
+                    .group_by(Task.product_id))
+    quantities = dict(session.execute(select([central.c.id,
+                                              central.c.quantity])).fetchall())
+    active = active_reservations(session, quantities)
+
+    committed = dict(session.execute(
+            select([wo_inventory.c.product_id,
+                    wo_inventory.c.active_inventory])).fetchall())
+    for product_id, allotted in session.execute(
+            select([stripes.c.product_id, func.sum(stripes.c.allotted)])
+            .group_by(stripes.c.product_id)):
+        committed[product_id] = committed.get(product_id, 0) + allotted
+
+    ret = []
+    for product_id, quantity in sorted(quantities.items()):
+        if active[product_id] != (expected.get(product_id) or 0):
+            ret.append((product_id, 'reserved %d, work orders hold %d'
+                        % (active[product_id], expected.get(product_id) or 0)))
+        if committed.get(product_id, 0) > quantity:
+            ret.append((product_id, 'allotted %d, central quantity %d'
+                        % (committed[product_id], quantity)))
+
+    for product_id, stripe in session.execute(
+            select([stripes.c.product_id, stripes.c.stripe])
+            .where(or_(stripes.c.active < 0,
+                       stripes.c.active > stripes.c.allotted))):
+        ret.append((product_id, 'stripe %d outside of its allotment' % stripe))
+
+    return ret
+
+
+striped_reservations = StripedReservations()
+
+configure = striped_reservations.configure
@@ -0,0 +1,238 @@
+"""
+In-memory store of the plans, tasks, work orders and inventory, serving
+reads without the db
+"""
+from sqlalchemy import select
+from models import Inventory, Plan, Task, WorkOrder
+import threading
+import utils
+
+# Ids per IN clause when reloading changed rows
+RELOAD_CHUNK_SIZE = 500
+
+
+class Record(object):
+    """
+    Row of a model, with a slot per column
+    """
+    __slots__ = ()
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+def _record_class(model):
+    return type('%sRecord' % model.__name__, (Record,),
+                {'__slots__': model.serializer.names})
+
+PlanRecord = _record_class(Plan)
+TaskRecord = _record_class(Task)
+WorkOrderRecord = _record_class(WorkOrder)
+InventoryRecord = _record_class(Inventory)
+
+# (model, record class, attribute of the parent id) per stored table
+TABLES = {
+    Plan.__tablename__: (Plan, PlanRecord, None),
+    Task.__tablename__: (Task, TaskRecord, 'plan_id'),
+    WorkOrder.__tablename__: (WorkOrder, WorkOrderRecord, 'task_id'),
+    Inventory.__tablename__: (Inventory, InventoryRecord, None),
+}
+
+
+def _load(session, model, ids = None):
+    """
+    @return {id: record} of the rows of model, of those with ids only when
+    set
+    """
+    record_class = TABLES[model.__tablename__][1]
+    columns = model.serializer.columns
+    if ids is None:
+        return dict((row[0], record_class(row))
+                    for row in session.execute(select(columns)))
+
+    ret = {}
+    ids = sorted(ids)
+    for i in range(0, len(ids), RELOAD_CHUNK_SIZE):
+        for row in session.execute(
+                select(columns)
+                .where(model.id.in_(ids[i:i + RELOAD_CHUNK_SIZE]))):
+            ret[row[0]] = record_class(row)
+    return ret
+
+
+class DomainStore(object):
+    """
+    Records of every plan, task, work order and inventory row, by id, with
+    the tasks of each plan and the work orders of each task. Tasks carry
+    the rollups of their work orders like their rows do.
+
+    The views write to the db as always. A commit listener, run before the
+    other listeners, reloads the rows the transaction changed, so reads
+    after a write return it. Records are replaced, never modified, and the
+    indexes only change under the lock.
+
+    Loaded by load() at startup. Writes of other processes, e.g. of other
+    pre-fork workers or of planner-admin, are not seen: verify() reports
+    the differences with the db.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Serializes reloads, each applies the rows it read last
+        self.reload_lock = threading.Lock()
+        self.loaded = False
+        self._reset()
+
+    def _reset(self):
+        self.records = dict((table, {}) for table in TABLES)
+        self.children = {Plan.__tablename__: {}, Task.__tablename__: {}}
+
+    def clear(self):
+        with self.lock:
+            self.loaded = False
+            self._reset()
+
+    def load(self):
+        """
+        Load every row of the stored tables
+        """
+        with self.reload_lock:
+            with utils.db_session() as session:
+                snapshot = dict((table, _load(session, model))
+                                for table, (model, _, _) in TABLES.items())
+            with self.lock:
+                self._reset()
+                for table, records in snapshot.items():
+                    self._apply(table, records, records)
+                self.loaded = True
+
+    def _apply(self, table, ids, records):
+        """
+        Replace the records of ids by records, removing the ids without a
+        record, and update the children indexes. Called under the lock.
+        """
+        stored = self.records[table]
+        parent_key = TABLES[table][2]
+        parents = None
+        if parent_key is not None:
+            parent_table = Plan.__tablename__ if table == Task.__tablename__ \
+                else Task.__tablename__
+            parents = self.children[parent_table]
+
+        for pk in ids:
+            old = stored.pop(pk, None)
+            new = records.get(pk)
+            if new is not None:
+                stored[pk] = new
+            if parents is None:
+                continue
+            if old is not None:
+                siblings = parents.get(getattr(old, parent_key))
+                if siblings is not None:
+                    siblings.discard(pk)
+            if new is not None:
+                parents.setdefault(getattr(new, parent_key), set()).add(pk)
+
+    def refresh(self, changes):
+        """
+        Commit listener reloading the rows of a models.ChangeSet. A table
+        written without row ids is reloaded whole.
+        """
+        if not self.loaded:
+            return
+
+        tables = [table for table in changes.rows if table in TABLES]
+        if not tables:
+            return
+
+        with self.reload_lock:
+            reloaded = []
+            with utils.db_session() as session:
+                for table in tables:
+                    model = TABLES[table][0]
+                    ids = changes.ids(table)
+                    if None in ids:
+                        records = _load(session, model)
+                        ids = None
+                    else:
+                        records = _load(session, model, ids)
+                    reloaded.append((table, ids, records))
+
+            with self.lock:
+                for table, ids, records in reloaded:
+                    if ids is None:
+                        # Whole table, the ids gone are dropped too
+                        ids = set(self.records[table]) | set(records)
+                    self._apply(table, ids, records)
+
+    def get(self, table, pk):
+        """
+        @return record of table, None if not found
+        """
+        return self.records[table].get(pk)
+
+    def children_of(self, table, pk):
+        """
+        @return records of the tasks of plan pk or of the work orders of
+        task pk, in id order
+        """
+        child_table = Task.__tablename__ if table == Plan.__tablename__ \
+            else WorkOrder.__tablename__
+        with self.lock:
+            ids = sorted(self.children[table].get(pk, ()))
+            records = self.records[child_table]
+            return [records[child] for child in ids]
+
+    def verify(self):
+        """
+        Compare the store against the db
+
+        @return list of (table, id, problem) found
+        """
+        with utils.db_session() as session:
+            snapshot = dict((table, _load(session, model))
+                            for table, (model, _, _) in TABLES.items())
+
+        ret = []
+        with self.lock:
+            for table, records in sorted(snapshot.items()):
+                stored = self.records[table]
+                for pk in sorted(set(stored) | set(records)):
+                    if pk not in stored:
+                        ret.append((table, pk, 'missing from the store'))
+                    elif pk not in records:
+                        ret.append((table, pk, 'deleted from the db'))
+                    elif stored[pk].values() != records[pk].values():
+                        ret.append((table, pk, 'stored %r, db %r'
+                                    % (stored[pk].values(),
+                                       records[pk].values())))
+
+            for parent_table, parent_key, child_table in (
+                    (Plan.__tablename__, 'plan_id', Task.__tablename__),
+                    (Task.__tablename__, 'task_id', WorkOrder.__tablename__)):
+                expected = {}
+                for pk, record in snapshot[child_table].items():
+                    expected.setdefault(getattr(record, parent_key),
+                                        set()).add(pk)
+                indexed = dict((pk, ids) for pk, ids
+                               in self.children[parent_table].items() if ids)
+                for pk in sorted(set(expected) | set(indexed)):
+                    if expected.get(pk, set()) != indexed.get(pk, set()):
+                        ret.append((parent_table, pk,
+                                    '%s index %s, db %s'
+                                    % (child_table,
+                                       sorted(indexed.get(pk, ())),
+                                       sorted(expected.get(pk, ())))))
+        return ret
+
+
+domain_store = DomainStore()
+utils.on_commit(domain_store.refresh, first = True)
+
+load = domain_store.load
+clear = domain_store.clear
+verify = domain_store.verify
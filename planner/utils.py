@@ -1,18 +1,61 @@
 from contextlib import contextmanager
-from sqlalchemy.orm import sessionmaker
-from models import engine, Inventory, Plan, Task, WorkOrder, WorkOrderInventory
+from functools import wraps
+from sqlalchemy import func, case, exists, literal, select, bindparam
+from sqlalchemy import Integer
+from sqlalchemy.exc import OperationalError
+from models import session_factory
+from models import Inventory, Plan, Task, WorkOrder, WorkOrderInventory
+from models import ReservationStripe
+from models import Status, ROLLUP_COLUMNS, record_change, execute_cached
+from reservations import striped_reservations, active_reservations
+from reservations import shrink_allotments
+import csv
+import gevent
+import itertools
+import os
+import random
+import time
+
+# Attempts of a transaction failing on a lock conflict
+CONFLICT_RETRIES = 10
+CONFLICT_BACKOFF = 0.01
+
+
+# Called with the models.ChangeSet of every committed write transaction
+_commit_listeners = []
+
+
+def on_commit(listener, first = False):
+    """
+    Register listener(changes) to be called after a db_session that wrote
+    to the db commits. Usable as a decorator.
+
+    @param first call it before the listeners registered without first,
+    for state the other listeners depend on
+    """
+    if first:
+        _commit_listeners.insert(0, listener)
+    else:
+        _commit_listeners.append(listener)
+    return listener
 
 
 @contextmanager
-def db_session():
+def db_session(write = False):
     """
     transactional scope for db operations
+
+    @param write take the write lock at the start of the transaction
+    instead of when first writing. Read-modify-write transactions do not
+    deadlock against each other this way.
     """
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    session = session_factory()
+    if write:
+        session.connection(execution_options = {'sqlite_begin': 'IMMEDIATE'})
     try:
         yield session
         session.commit()
+        changes = session.info.pop('changes', None)
 
     except:
         session.rollback()
@@ -21,19 +64,325 @@ def db_session():
     finally:
         session.close()
 
+    if changes:
+        for listener in _commit_listeners:
+            listener(changes)
+
+
+def is_conflict(error):
+    """
+    True if a db error is a lock conflict that succeeds when retried
+    """
+    message = str(error.orig).lower()
+    return 'locked' in message or 'busy' in message or 'deadlock' in message
+
+
+def retry_on_conflict(func):
+    """
+    Decorator running a function with its own db_session again, with a
+    randomized backoff, when its transaction fails on a lock conflict.
+    Gives up after CONFLICT_RETRIES attempts.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(CONFLICT_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_conflict(e) or attempt + 1 == CONFLICT_RETRIES:
+                    raise
+            gevent.sleep(random.uniform(0, CONFLICT_BACKOFF * 2 ** attempt))
+
+    return wrapper
+
+
+def _inventory_statements():
+    """
+    Statements of the inventory reservations, built once and bound with
+    b_product_id and b_quantity
+    """
+    wo_inventory = WorkOrderInventory.__table__
+    central = Inventory.__table__
+    product_id = bindparam('b_product_id', type_ = Integer)
+    quantity = bindparam('b_quantity', type_ = Integer)
+
+    release = wo_inventory.update()\
+        .where(wo_inventory.c.product_id == product_id)\
+        .values(active_inventory = wo_inventory.c.active_inventory + quantity)
+    available = select([central.c.quantity])\
+        .where(central.c.id == product_id).as_scalar()
+    reserve = release.where(
+        wo_inventory.c.active_inventory + quantity <= available)
+
+    row_exists = exists().where(wo_inventory.c.product_id == product_id)
+    create = wo_inventory.insert().from_select(
+        ['product_id', 'active_inventory'],
+        select([product_id, literal(0)])
+        .where(exists().where(central.c.id == product_id))
+        .where(~row_exists))
+
+    debit = central.update()\
+        .where(central.c.id == product_id)\
+        .where(central.c.quantity >= quantity)\
+        .values(quantity = central.c.quantity - quantity)
+
+    return reserve, release, create, debit
+
+_RESERVE, _RELEASE, _CREATE_RESERVATION, _DEBIT = _inventory_statements()
+
+
+def reserve_inventory(session, product_id, quantity, key = 0):
+    """
+    Atomically reserve quantity of a product for work orders, or release it
+    when negative. A single conditional UPDATE keeps the active reservations
+    of the product within the central inventory. With striped reservations
+    key, the work order id, selects the stripe.
+
+    @return True if the reservation was made
+    """
+    if striped_reservations.stripes > 0:
+        return striped_reservations.reserve(session, product_id, quantity,
+                                            key)
+
+    params = {'b_product_id': product_id, 'b_quantity': quantity}
+    stmt = _RESERVE if quantity > 0 else _RELEASE
+    if execute_cached(session, stmt, params).rowcount == 1:
+        record_change(session, WorkOrderInventory.__tablename__, product_id)
+        return True
+
+    #First reservation of the product, create its row and try again
+    execute_cached(session, _CREATE_RESERVATION, params)
+    if execute_cached(session, stmt, params).rowcount == 1:
+        record_change(session, WorkOrderInventory.__tablename__, product_id)
+        return True
+    return False
+
+
+def debit_inventory(session, product_id, quantity):
+    """
+    Atomically debit quantity of a product used by completed work orders
+    from the central inventory and release its reservation.
+
+    @return True if the central inventory had enough product
+    """
+    if striped_reservations.stripes > 0:
+        return striped_reservations.debit(session, product_id, quantity)
+
+    params = {'b_product_id': product_id, 'b_quantity': quantity}
+    if execute_cached(session, _DEBIT, params).rowcount != 1:
+        return False
+
+    params['b_quantity'] = -quantity
+    execute_cached(session, _RELEASE, params)
+    record_change(session, Inventory.__tablename__, product_id)
+    record_change(session, WorkOrderInventory.__tablename__, product_id)
+    return True
+
+
+def _parse_inventory(lines, rejected, max_rejected):
+    """
+    Parse inventory csv lines of product name and quantity incrementally.
+    Invalid lines are counted and the first max_rejected kept in rejected.
+
+    @return generator of (product name, quantity)
+    """
+    for line_no, row in enumerate(csv.reader(lines), 1):
+        if not row or (len(row) == 1 and not row[0].strip()):
+            continue
+
+        reason = None
+        if len(row) != 2 or not row[0].strip():
+            reason = 'Expected product name and quantity'
+        else:
+            try:
+                quantity = int(row[1])
+                if quantity < 0:
+                    reason = 'Negative quantity'
+            except ValueError:
+                reason = 'Invalid quantity'
+
+        if reason:
+            rejected['count'] += 1
+            if len(rejected['lines']) < max_rejected:
+                rejected['lines'].append({'line': line_no,
+                                          'content': ','.join(row),
+                                          'reason': reason})
+            continue
+
+        yield row[0].strip(), quantity
+
+
+def _upsert_inventory(session, chunk, rejected, max_rejected):
+    """
+    Insert or update a chunk of {product name: quantity} with one
+    executemany for the updates and one for the inserts
+
+    @return (inserted, updated)
+    """
+    central = Inventory.__table__
+
+    existing = dict(session.execute(
+            select([central.c.product_name, central.c.id])
+            .where(central.c.product_name.in_(list(chunk)))).fetchall())
+    active = active_reservations(session, existing.values()) \
+        if existing else {}
+
+    updates = []
+    inserts = []
+    for name, quantity in chunk.items():
+        product_id = existing.get(name)
+        if product_id is None:
+            inserts.append({'product_name': name, 'quantity': quantity})
+        elif quantity < active.get(product_id, 0):
+            rejected['count'] += 1
+            if len(rejected['lines']) < max_rejected:
+                rejected['lines'].append({'product_name': name,
+                                          'reason': 'Quantity below active work order reservations'})
+        else:
+            updates.append({'_id': product_id, 'quantity': quantity})
+            record_change(session, central.name, product_id)
+
+    if updates:
+        shrink_allotments(session, [row['_id'] for row in updates])
+        session.execute(central.update()
+                        .where(central.c.id == bindparam('_id'))
+                        .values(quantity = bindparam('quantity')), updates)
+    if inserts:
+        session.execute(central.insert(), inserts)
+        # Bulk inserted rows have no primary key at hand
+        record_change(session, central.name, None, 'insert')
+
+    return len(inserts), len(updates)
+
+
+def import_inventory(lines, chunk_size = 500, commit_every = 10000,
+                     max_rejected = 100):
+    """
+    Stream inventory csv lines (product name, quantity) into the central
+    inventory. New products are inserted and existing ones get the new
+    quantity, chunk_size rows per executemany, committing every
+    commit_every rows.
+
+    @param lines iterable of csv lines, such as a file object
+    @param max_rejected invalid lines to report in detail
+
+    @return dict with the rows imported, inserted, updated, rejected,
+    rows_per_sec and the first rejected_lines
+    """
+    start = time.time()
+    rejected = {'count': 0, 'lines': []}
+    ret = {'rows': 0, 'inserted': 0, 'updated': 0}
+
+    def chunks():
+        chunk = {}
+        for name, quantity in _parse_inventory(lines, rejected, max_rejected):
+            chunk[name] = quantity
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = {}
+        if chunk:
+            yield chunk
+
+    chunks = chunks()
+    chunks_per_commit = max(1, commit_every // chunk_size)
+    while True:
+        with db_session(write = True) as session:
+            num_chunks = 0
+            for chunk in itertools.islice(chunks, chunks_per_commit):
+                inserted, updated = _upsert_inventory(session, chunk,
+                                                      rejected, max_rejected)
+                ret['inserted'] += inserted
+                ret['updated'] += updated
+                num_chunks += 1
+
+        if num_chunks < chunks_per_commit:
+            break
+
+    elapsed = time.time() - start
+    ret['rows'] = ret['inserted'] + ret['updated']
+    ret['rows_per_sec'] = ret['rows'] / elapsed if elapsed else 0
+    ret['rejected'] = rejected['count']
+    ret['rejected_lines'] = rejected['lines']
+    return ret
+
 
 def populate_inventory():
     """
     populate db with inventory
     """
-    with open('inventory.txt') as fobj:
-        inventory = fobj.read().strip()
+    path = os.path.join(os.path.dirname(__file__), 'inventory.txt')
+    with open(path) as fobj:
+        return import_inventory(fobj)
+
+def query_task_rollups(session):
+    """
+    Recompute the task rollups from scratch with a grouped query over the
+    work orders
+
+    @return query of (task_id, not_started, in_progress, completed,
+                      total_target, total_actual)
+    """
+    def count_status(status):
+        return func.coalesce(func.sum(case(
+                    [(WorkOrder.status == status, 1)], else_ = 0)), 0)
+
+    return session.query(
+        Task.id,
+        count_status(Status.NOTSTARTED),
+        count_status(Status.INPROGRESS),
+        count_status(Status.COMPLETED),
+        func.coalesce(func.sum(WorkOrder.target_quantity), 0),
+        func.coalesce(func.sum(WorkOrder.actual_quantity), 0))\
+        .outerjoin(WorkOrder)\
+        .group_by(Task.id)
+
+
+def check_task_rollups(session):
+    """
+    Compare the stored task rollups against the work orders
+
+    @return list of (task_id, stored rollup, expected rollup) that differ
+    """
+    stored = {}
+    for row in session.query(Task.id, Task.status,
+                             *[getattr(Task, name) for name in ROLLUP_COLUMNS]):
+        stored[row[0]] = dict(zip(('status',) + ROLLUP_COLUMNS, row[1:]))
+
+    ret = []
+    for row in query_task_rollups(session):
+        expected = dict(zip(ROLLUP_COLUMNS, row[1:]))
+        not_started, in_progress, completed = row[1:4]
+        expected['status'] = Task.compute_status(
+            not_started + in_progress + completed, completed, not_started)
+
+        if stored.get(row[0]) != expected:
+            ret.append((row[0], stored.get(row[0]), expected))
+
+    return ret
+
+
+def rebuild_task_rollups(session):
+    """
+    Rewrite the task rollups that do not match the work orders
+
+    @return list of (task_id, stored rollup, expected rollup) rewritten
+    """
+    mismatches = check_task_rollups(session)
+    if not mismatches:
+        return mismatches
+
+    task = Task.__table__
+    plan_ids = dict(session.execute(select([task.c.id, task.c.plan_id]))
+                    .fetchall())
+    for task_id, stored, expected in mismatches:
+        session.execute(task.update()
+                        .where(task.c.id == task_id)
+                        .values(expected))
+        record_change(session, task.name, task_id,
+                      plan_id = plan_ids.get(task_id))
+
+    return mismatches
 
-    with db_session() as session:
-        for item in inventory.split('\n'):
-            item = item.split(',')
-            row = Inventory(product_name = item[0], quantity = item[1])
-            session.add(row)
 
 def sum_actual_quantity(task):
     sum = 0
@@ -56,3 +405,4 @@ def clear_dbs():
         session.query(Task).delete()
         session.query(WorkOrder).delete()
         session.query(WorkOrderInventory).delete()
+        session.query(ReservationStripe).delete()
@@ -1,17 +1,307 @@
 import gevent.pywsgi
-from sqlalchemy import func, case, literal_column
-from flask import Flask, request, abort, jsonify, url_for
+from flask import Flask, Response, request, abort, jsonify, url_for
+from flask import stream_with_context
 import json
-import utils, models
+import utils, models, reports, cache, metrics, dbpool, writer, reservations
+import events, migrations, admission, store, export
 from models import Status
+from sqlalchemy.orm import selectinload
 import gevent  # Use Cooperative threading
+import argparse
+import datetime
+import os
+import shutil
+import socket
+import sys
 import syslog
+import tempfile
+import time
 
 app = Flask(__name__)
+app.config.update(
+    DATABASE = 'planner.db',      # sqlite file name or database url
+    DATABASE_ECHO = False,
+    DATABASE_POOL_SIZE = 5,
+    DATABASE_POOL_TIMEOUT = 30,
+    DATABASE_THREADS = 4,         # threads running db work, 0 runs it inline
+    SQLITE_PRAGMAS = False,       # WAL, synchronous=NORMAL, cache and mmap
+    SQLITE_CACHE_SIZE = 64000,    # KiB
+    SQLITE_MMAP_SIZE = 268435456, # bytes
+    RESPONSE_CACHE_SIZE = 1024,   # cached read responses, 0 disables
+    IMPORT_CHUNK_SIZE = 500,      # inventory rows per executemany
+    IMPORT_COMMIT_EVERY = 10000,  # inventory rows per import transaction
+    GROUP_COMMIT = False,         # queue task and work order writes to the
+                                  # group commit writer
+    GROUP_COMMIT_MAX_BATCH = 64,  # writes per group commit transaction
+    GROUP_COMMIT_MAX_WAIT = 0.002, # seconds to wait for more writes
+    RESERVATION_STRIPES = 0,      # reservation rows per product, 0 keeps
+                                  # one work_order_inventory row
+    EVENTS_BUFFER_SIZE = 10000,   # change events kept for resuming clients
+    EVENTS_HEARTBEAT = 15,        # seconds between keepalives of /events
+    WORKERS = 1,                  # server processes, above 1 pre-forks
+    WORKER_TIMEOUT = 30,          # seconds without heartbeat before a
+                                  # worker is restarted
+    SHUTDOWN_TIMEOUT = 10,        # seconds to finish requests on SIGTERM
+    STARTUP_BUDGET = 2.0,         # seconds from process start to serving
+    ADMISSION_LIMITS = {},        # route class (read, write, report):
+                                  # (concurrency, queue), unlimited if absent
+    ADMISSION_TIMEOUT = 1.0,      # seconds a request waits for admission
+    ADMISSION_RETRY_AFTER = 1,    # Retry-After seconds of rejections
+    MEMORY_STORE = False,         # serve reads of single resources, plan
+                                  # trees and children from memory
+    EXPORT_CHUNK_SIZE = 5000,     # rows per query of /export
+)
+app.config.from_envvar('PLANNER_SETTINGS', silent = True)
+
+metrics.init_app(app)
+admission.init_app(app)
+
+# Rows fetched per round trip when streaming a collection
+STREAM_CHUNK_SIZE = 500
+
+
+def _paginate(query, id_col, limit):
+    """
+    Apply keyset pagination on the primary key. Rows after the ?after=<id>
+    argument are returned in id order.
+    """
+    after = request.args.get('after', type = int)
+    if after is not None:
+        query = query.filter(id_col > after)
+    query = query.order_by(id_col)
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query
+
+
+def _next_link(last_id, limit):
+    """
+    Link to the page following last_id
+    """
+    # Every value of repeated arguments, e.g. ?status=a&status=b
+    args = request.args.to_dict(flat = False)
+    args.update(request.view_args)
+    args['after'] = last_id
+    args['limit'] = limit
+    return '<%s>; rel="next"' % url_for(request.endpoint, **args)
+
+
+def _link_template(endpoint):
+    """
+    Format string of the links to the resources of a collection endpoint,
+    taking the resource id. Built once per response instead of calling
+    url_for on every row.
+    """
+    return url_for(endpoint) + '/%d'
+
+
+def _status(value):
+    if value not in models.STATUS_ENUM.enums:
+        raise ValueError(value)
+    return value
+
+
+def _date(value):
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+
+def _filters(columns, created_col = None):
+    """
+    SQL criteria of the collection filters in the query arguments, parsed
+    up front so invalid ones fail before a streamed response starts.
+    ?<name>=<value> matches the column of name in columns, repeated or
+    comma separated values match any of them. ?created_after=<date> and
+    ?created_before=<date> (YYYY-MM-DD[THH:MM:SS], UTC) bound created_col.
+
+    @param columns dict of argument name: (column, value converter)
+
+    @return list of criteria
+    """
+    criteria = []
+    for name, (column, convert) in sorted(columns.items()):
+        values = [value for arg in request.args.getlist(name)
+                  for value in arg.split(',') if value]
+        if not values:
+            continue
+        try:
+            values = [convert(value) for value in values]
+        except ValueError:
+            raise HTTPError(400, 'Invalid %s' % name)
+        if len(values) == 1:
+            criteria.append(column == values[0])
+        else:
+            criteria.append(column.in_(values))
+
+    if created_col is not None:
+        for name, compare in (('created_after', created_col.__ge__),
+                              ('created_before', created_col.__lt__)):
+            value = request.args.get(name)
+            if value is None:
+                continue
+            try:
+                criteria.append(compare(_date(value)))
+            except ValueError:
+                raise HTTPError(400, 'Invalid %s' % name)
+
+    return criteria
+
+
+def _projection(serializer, aliases = None):
+    """
+    Serializer of the columns named by ?fields=<name>,<name> and of the id,
+    which is always returned. Only those columns are selected.
+
+    @param aliases dict of the name of a computed field: column it is
+    computed from
+
+    @return (serializer, set of field names), None without ?fields
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+
+    aliases = aliases or {}
+    names = set(name for name in fields.split(',') if name)
+    unknown = names - set(serializer.names) - set(aliases)
+    if unknown:
+        raise HTTPError(400, 'Unknown fields: %s' % ', '.join(sorted(unknown)))
+
+    columns = set(aliases.get(name, name) for name in names)
+    columns.add('id')
+    return serializer.project(columns), names
+
+
+def _expand(allowed):
+    """
+    Relationships named by ?expand=<name>,<name>
+
+    @param allowed dict of name: names it requires
+
+    @return set of names, with the ones they require
+    """
+    names = set(name for arg in request.args.getlist('expand')
+                for name in arg.split(',') if name)
+    unknown = names - set(allowed)
+    if unknown:
+        raise HTTPError(400, 'Cannot expand: %s' % ', '.join(sorted(unknown)))
+
+    for name in list(names):
+        names.update(allowed[name])
+    return names
+
+
+def _list_response(build_query, id_col, to_dict):
+    """
+    Serialize a collection. Supports keyset pagination with
+    ?after=<id>&limit=N (next page in the Link header) and streaming of the
+    JSON array row by row with ?stream=true.
+
+    @param build_query callable returning the query for a session. Querying
+    the serializer columns of a model instead of the model skips loading
+    the ORM objects.
+    @param id_col primary key column used as the pagination key
+    @param to_dict callable serializing one row of the query
+
+    @return response
+    """
+    limit = request.args.get('limit', type = int)
+    if limit is not None and limit <= 0:
+        raise HTTPError(400, 'Invalid limit')
+
+    stream = request.args.get('stream', '').lower() in ('1', 'true')
+    headers = {}
+
+    if not stream:
+        def fetch():
+            ret = []
+            with utils.db_session() as session:
+                query_res = _paginate(build_query(session), id_col, limit)
+                for result in query_res:
+                    ret.append(to_dict(result))
+            metrics.add_rows(len(ret))
+            return ret
+
+        ret = dbpool.run(fetch)
+        if limit is not None and len(ret) == limit:
+            headers['Link'] = _next_link(ret[-1]['id'], limit)
+        return Response(json.dumps(ret), headers = headers)
+
+    if limit is not None:
+        # The headers go out before the rows, look up the last id of the
+        # page up front
+        def fetch_last_id():
+            with utils.db_session() as session:
+                return _paginate(build_query(session), id_col, None)\
+                    .with_entities(id_col).offset(limit - 1).limit(1).scalar()
+
+        last_id = dbpool.run(fetch_last_id)
+        if last_id is not None:
+            headers['Link'] = _next_link(last_id, limit)
+
+    def generate():
+        # Yields a chunk of rows at a time. Each chunk is fetched after the
+        # last id sent, in a transaction of its own on the db pool: no read
+        # transaction stays open, holding off writers, while the client
+        # reads.
+        sep = '['
+        rows = 0
+        last_id = None
+        while limit is None or rows < limit:
+            size = STREAM_CHUNK_SIZE if limit is None \
+                else min(STREAM_CHUNK_SIZE, limit - rows)
+            with utils.db_session() as session:
+                query = build_query(session)
+                if last_id is not None:
+                    query = query.filter(id_col > last_id)
+                chunk = [to_dict(result)
+                         for result in _paginate(query, id_col, size)]
+            if not chunk:
+                break
+
+            rows += len(chunk)
+            last_id = chunk[-1]['id']
+            yield sep + ', '.join(json.dumps(row) for row in chunk)
+            sep = ', '
+            if len(chunk) < size:
+                break
+
+        yield '[]' if sep == '[' else ']'
+        metrics.add_rows(rows)
+
+    return Response(stream_with_context(dbpool.stream(generate())),
+                    headers = headers, mimetype = 'application/json')
+
+
+@utils.retry_on_conflict
+def _write_transaction(op, *args):
+    def apply_op():
+        with utils.db_session(write = True) as session:
+            return op(session, *args)
+
+    return dbpool.run(apply_op)
+
+
+def _write(op, *args):
+    """
+    Apply op(session, *args). With GROUP_COMMIT it is queued to the group
+    commit writer, otherwise it runs in its own transaction on the db pool.
+
+    @return result of op
+    """
+    if app.config['GROUP_COMMIT']:
+        return writer.submit(op, *args)
+    return _write_transaction(op, *args)
 
 
 @app.route('/inventory/<int:inv_id>')
 @app.route('/inventory')
+@cache.cached_view('central_inventory')
 def get_inventory(inv_id = None):
     """
     Get the central inventory
@@ -19,24 +309,64 @@ def get_inventory(inv_id = None):
 
     @return inventory
     """
-    ret = None
-    with utils.db_session() as session:
-        if inv_id:
+    if not inv_id:
+        serializer = models.Inventory.serializer
+        projected = _projection(serializer)
+        if projected:
+            serializer = projected[0]
+
+        link = _link_template('get_inventory')
+        def to_dict(result):
+            return serializer.to_dict(result, link % result.id)
+
+        return _list_response(
+            lambda session: session.query(*serializer.columns),
+            models.Inventory.id, to_dict)
+
+    if store.domain_store.loaded:
+        item = store.domain_store.get('central_inventory', inv_id)
+        if item is None:
+            raise HTTPError(404, 'Inventory not found')
+        return json.dumps(models.Inventory.serializer.to_dict(item.values()))
+
+    def load():
+        with utils.db_session() as session:
             query_res = session.query(models.Inventory).get(inv_id)
             if not query_res:
                 raise HTTPError(404, 'Inventory not found')
-            ret = query_res.as_dict()
-        else:
-            query_res = session.query(models.Inventory).all()
-            ret = []
-            for result in query_res:
-                link = url_for('get_inventory', inv_id = result.id)
-                ret.append(result.as_dict(link = link))
+            return query_res.as_dict()
+
+    return json.dumps(dbpool.run(load))
+
 
+@app.route('/inventory/import', methods = ['POST'])
+def import_inventory():
+    """
+    Import inventory csv lines of product name and quantity, uploaded as
+    the file field of a form or as the request body. New products are
+    added and existing products get the new quantity.
+
+    @return import statistics
+    """
+    upload = request.files.get('file')
+    if upload:
+        lines = upload.stream
+    else:
+        # The client socket belongs to the hub, spool the body before
+        # importing it on the db pool
+        lines = tempfile.TemporaryFile()
+        shutil.copyfileobj(request.stream, lines)
+        lines.seek(0)
+
+    ret = dbpool.run(utils.import_inventory, lines,
+                     chunk_size = app.config['IMPORT_CHUNK_SIZE'],
+                     commit_every = app.config['IMPORT_COMMIT_EVERY'])
     return json.dumps(ret)
 
 
 @app.route('/plans', methods = ['POST'])
+@utils.retry_on_conflict
+@dbpool.offload
 def create_plan():
      """
      create a new plan
@@ -48,7 +378,7 @@ def create_plan():
      if name is None:
          raise HTTPError(400, 'Plan is missing a name')
 
-     with utils.db_session() as session:
+     with utils.db_session(write = True) as session:
          new_plan = models.Plan(name)
          session.add(new_plan)
          session.flush()
@@ -60,39 +390,116 @@ def create_plan():
 
 @app.route('/plans/<int:plan_id>')
 @app.route('/plans')
+@cache.cached_view('plan', 'task', 'work_order')
 def get_plans(plan_id = None):
     """
-    Get all the plans.
+    Get all the plans. A single plan lists the links of its tasks, or with
+    ?expand=tasks,work_orders its tasks and their work orders. The tree is
+    loaded with one query per level, IN batches of the parent ids.
     @param plan_id is pk of the plan table
 
     @return plans
     """
-    ret = None
-    with utils.db_session() as session:
-        if plan_id:
-            query_res = session.query(models.Plan).get(plan_id)
-            if not query_res:
+    if not plan_id:
+        serializer = models.Plan.serializer
+        projected = _projection(serializer)
+        if projected:
+            serializer = projected[0]
+        criteria = _filters({}, models.Plan.created_date)
+
+        link = _link_template('get_plans')
+        def to_dict(result):
+            return serializer.to_dict(result, link % result.id)
+
+        return _list_response(
+            lambda session: session.query(*serializer.columns)
+            .filter(*criteria),
+            models.Plan.id, to_dict)
+
+    expand = _expand({'tasks': (), 'work_orders': ('tasks',)})
+    if store.domain_store.loaded:
+        return json.dumps(_stored_plan(plan_id, expand))
+
+    if 'tasks' not in expand:
+        def load():
+            with utils.db_session() as session:
+                query_res = session.query(models.Plan).get(plan_id)
+                if not query_res:
+                    raise HTTPError(404, 'Plan not found')
+
+                task_base = url_for('get_tasks')
+                return query_res.as_dict(task_base = task_base)
+
+        return json.dumps(dbpool.run(load))
+
+    task_link = _link_template('get_tasks')
+    wo_link = _link_template('get_work_order')
+    loader = selectinload(models.Plan.tasks)
+    if 'work_orders' in expand:
+        loader = loader.selectinload(models.Task.work_order)
+
+    def load():
+        with utils.db_session() as session:
+            plan = session.query(models.Plan).options(loader)\
+                .filter(models.Plan.id == plan_id).first()
+            if not plan:
                 raise HTTPError(404, 'Plan not found')
 
-            task_base = url_for('get_tasks')
-            ret = query_res.as_dict(task_base = task_base)
+            ret = plan.as_dict()
+            ret['tasks'] = []
+            for task in sorted(plan.tasks, key = lambda task: task.id):
+                task_dict = task.as_dict(include_wo = True,
+                                         link = task_link % task.id)
+                if 'work_orders' in expand:
+                    task_dict['work_orders'] = [
+                        wo.as_dict(link = wo_link % wo.id)
+                        for wo in sorted(task.work_order,
+                                         key = lambda wo: wo.id)]
+                ret['tasks'].append(task_dict)
+            return ret
 
-        else:
-            query_res = session.query(models.Plan).all()
-            ret = []
-            for result in query_res:
-                link = url_for('get_plans', plan_id = result.id)
-                ret.append(result.as_dict(link = link))
+    return json.dumps(dbpool.run(load))
 
-    return json.dumps(ret)
+
+def _stored_plan(plan_id, expand):
+    """
+    A plan like get_plans, from the in-memory store
+    """
+    plan = store.domain_store.get('plan', plan_id)
+    if plan is None:
+        raise HTTPError(404, 'Plan not found')
+
+    ret = models.Plan.serializer.to_dict(plan.values())
+    tasks = store.domain_store.children_of('plan', plan_id)
+    if 'tasks' not in expand:
+        task_base = url_for('get_tasks')
+        ret['tasks'] = [{'task%d_link' % task.id: task_base + '/%d' % task.id}
+                        for task in tasks]
+        return ret
+
+    task_link = _link_template('get_tasks')
+    wo_link = _link_template('get_work_order')
+    ret['tasks'] = []
+    for task in tasks:
+        task_dict = models.Task.row_as_dict(task.values(), include_wo = True,
+                                            link = task_link % task.id)
+        if 'work_orders' in expand:
+            task_dict['work_orders'] = [
+                models.WorkOrder.serializer.to_dict(wo.values(),
+                                                    wo_link % wo.id)
+                for wo in store.domain_store.children_of('task', task.id)]
+        ret['tasks'].append(task_dict)
+    return ret
 
 
 @app.route('/plans/<int:plan_id>', methods = ['DELETE'])
+@utils.retry_on_conflict
+@dbpool.offload
 def delete_plans(plan_id):
     """
     Deletes a plan if specified plan has no tasks
     """
-    with utils.db_session() as session:
+    with utils.db_session(write = True) as session:
         plan = session.query(models.Plan).get(plan_id)
         if plan:
 #            num_tasks = session.query(models.Task)\
@@ -106,6 +513,29 @@ def delete_plans(plan_id):
     return json.dumps({'Success': True})
 
 
+def _create_task(session, plan_id, product, quantity):
+    """
+    Create a task in session
+
+    @return task dict
+    """
+    query_res = session.query(models.Plan).get(plan_id)
+    if not query_res:
+        raise HTTPError(404, 'Plan not found')
+
+    item = session.query(models.Inventory).get(product)
+    if not item:
+        raise HTTPError(400, 'Product does not exist')
+    if item.quantity < quantity:
+        raise HTTPError(400, 'Quantity of task exceeds central inventory')
+
+    new_task = models.Task(plan_id, product, quantity)
+    session.add(new_task)
+    session.flush()
+
+    return new_task.as_dict()
+
+
 @app.route('/plans/<int:plan_id>/tasks', methods = ['POST'])
 def create_task(plan_id):
     """
@@ -123,24 +553,126 @@ def create_task(plan_id):
             (not isinstance(quantity, int) and quantity > 0):
         raise HTTPError(400, 'Invalid parameters for task')
 
-    ret = None
-    with utils.db_session() as session:
+    ret = _write(_create_task, plan_id, product, quantity)
+    ret['link'] = url_for('get_tasks', task_id = ret['id'])
+    return json.dumps(ret)
+
+
+def _is_quantity(value):
+    return isinstance(value, int) and not isinstance(value, bool) \
+        and value > 0
+
+
+def _batch_targets(work_orders, what):
+    """
+    Validate a list of work order payloads of a batch
+
+    @return list of target quantities
+    """
+    if not isinstance(work_orders, list):
+        raise HTTPError(400, 'Expected a list of work orders for %s' % what)
+
+    targets = []
+    for i, content in enumerate(work_orders):
+        target_quantity = None
+        if isinstance(content, dict):
+            target_quantity = content.get('target_quantity', None)
+        if not _is_quantity(target_quantity):
+            raise HTTPError(400, 'Invalid parameters to work order %d of %s'
+                            % (i, what))
+        targets.append(target_quantity)
+
+    return targets
+
+
+@app.route('/plans/<int:plan_id>/tasks/batch', methods = ['POST'])
+@utils.retry_on_conflict
+@dbpool.offload
+def create_tasks_batch(plan_id):
+    """
+    Create tasks in bulk. The whole batch is validated up front, the tasks
+    are inserted in a single flush, their work orders with one executemany
+    and the batch is committed once.
+    @param: plan_id
+    @body: json list of objects with prod_id, quantity and optionally
+    work_orders, a list of objects with target_quantity
+
+    @returns: list of task resources (with their work orders) if successful
+    """
+    content = request.get_json()
+    if not isinstance(content, list):
+        raise HTTPError(400, 'Expected a list of tasks')
+
+    batch = []
+    for i, item in enumerate(content):
+        if not isinstance(item, dict) or \
+                not _is_quantity(item.get('prod_id', None)) or \
+                not _is_quantity(item.get('quantity', None)):
+            raise HTTPError(400, 'Invalid parameters for task %d' % i)
+
+        targets = _batch_targets(item.get('work_orders', []), 'task %d' % i)
+        if sum(targets) > item['quantity']:
+            raise HTTPError(403, 'Work order quantities of task %d greater than task total quantity' % i)
+        batch.append((item['prod_id'], item['quantity'], targets))
+
+    ret = []
+    with utils.db_session(write = True) as session:
         query_res = session.query(models.Plan).get(plan_id)
         if not query_res:
             raise HTTPError(404, 'Plan not found')
 
-        item = session.query(models.Inventory).get(product)
-        if not item:
-            raise HTTPError(400, 'Product does not exist')
-        if item.quantity < quantity:
-            raise HTTPError(400, 'Quantity of task exceeds central inventory')
-
-        new_task = models.Task(plan_id, product, quantity)
-        session.add(new_task)
+        products = set(product for product, quantity, targets in batch)
+        inventory = dict(session.query(models.Inventory.id,
+                                       models.Inventory.quantity)\
+                             .filter(models.Inventory.id.in_(products)))
+
+        new_tasks = []
+        for i, (product, quantity, targets) in enumerate(batch):
+            if product not in inventory:
+                raise HTTPError(400, 'Product of task %d does not exist' % i)
+            if inventory[product] < quantity:
+                raise HTTPError(400, 'Quantity of task %d exceeds central inventory' % i)
+
+            # The work orders are bulk inserted below without going through
+            # the flush, start the task with their rollups
+            new_task = models.Task(plan_id, product, quantity)
+            new_task.status = Status.NOTSTARTED
+            new_task.wo_not_started = len(targets)
+            new_task.wo_target_quantity = sum(targets)
+            new_tasks.append(new_task)
+
+        session.add_all(new_tasks)
         session.flush()
 
-        link = url_for('get_tasks', task_id = new_task.id)
-        ret = new_task.as_dict(link = link)
+        wo_rows = []
+        for new_task, (product, quantity, targets) in zip(new_tasks, batch):
+            for target in targets:
+                wo_rows.append({'task_id': new_task.id,
+                                'target_quantity': target})
+
+        work_orders = {}
+        if wo_rows:
+            session.execute(models.WorkOrder.__table__.insert(), wo_rows)
+
+            query_res = session.query(models.WorkOrder)\
+                .join(models.Task)\
+                .filter(models.Task.plan_id == plan_id,
+                        models.Task.id >= new_tasks[0].id)\
+                .order_by(models.WorkOrder.id)
+            for wo in query_res:
+                work_orders.setdefault(wo.task_id, []).append(wo)
+                models.record_change(session, wo.__tablename__, wo.id,
+                                     'insert', task_id = wo.task_id)
+
+        task_link = _link_template('get_tasks')
+        wo_link = _link_template('get_work_order')
+        for new_task, (product, quantity, targets) in zip(new_tasks, batch):
+            task_dict = new_task.as_dict(link = task_link % new_task.id)
+            if targets:
+                task_dict['work_orders'] = [
+                    wo.as_dict(link = wo_link % wo.id)
+                    for wo in work_orders[new_task.id]]
+            ret.append(task_dict)
 
     return json.dumps(ret)
 
@@ -148,6 +680,7 @@ def create_task(plan_id):
 @app.route('/tasks')
 @app.route('/tasks/<int:task_id>')
 @app.route('/plans/<int:plan_id>/tasks')
+@cache.cached_view('task')
 def get_tasks(plan_id = None, task_id = None):
     """
     Get tasks. Can retrieve a single task, all tasks, or all tasks given
@@ -159,33 +692,68 @@ def get_tasks(plan_id = None, task_id = None):
 
     @returns list of task/tasks
     """
-    ret = []
-    with utils.db_session() as session:
-        if task_id:
+    if not task_id and plan_id and store.domain_store.loaded \
+            and not request.args:
+        link = _link_template('get_tasks')
+        return json.dumps([
+                models.Task.row_as_dict(task.values(), include_wo = True,
+                                        link = link % task.id)
+                for task in store.domain_store.children_of('plan', plan_id)])
+
+    if not task_id:
+        serializer = models.Task.serializer
+        criteria = _filters({'status': (models.Task.status, _status),
+                             'product_id': (models.Task.product_id, int),
+                             'plan_id': (models.Task.plan_id, int)},
+                            models.Task.created_date)
+        projected = _projection(serializer,
+                                {'actual_quantity': 'wo_actual_quantity'})
+
+        def build_query(session):
+            query_res = session.query(*serializer.columns).filter(*criteria)
+            if plan_id:
+                query_res = query_res.filter(models.Task.plan_id == plan_id)
+            return query_res
+
+        link = _link_template('get_tasks')
+        if projected:
+            serializer, names = projected
+            def to_dict(result):
+                ret = serializer.to_dict(result)
+                if 'actual_quantity' in names:
+                    ret['actual_quantity'] = ret['wo_actual_quantity']
+                    if 'wo_actual_quantity' not in names:
+                        del ret['wo_actual_quantity']
+                ret['link'] = link % result.id
+                return ret
+        else:
+            def to_dict(result):
+                return models.Task.row_as_dict(result, include_wo = True,
+                                               link = link % result.id)
+
+        return _list_response(build_query, models.Task.id, to_dict)
+
+    if store.domain_store.loaded:
+        task = store.domain_store.get('task', task_id)
+        if task is None:
+            raise HTTPError(404, 'Task id not found')
+        return json.dumps(models.Task.row_as_dict(task.values(),
+                                                  include_wo = True))
+
+    def load():
+        with utils.db_session() as session:
             query_res = session.query(models.Task).get(task_id)
             if not query_res:
                 raise HTTPError(404, 'Task id not found')
 
-            ret = query_res.as_dict(include_wo = True)
-
-        elif plan_id:
-            query_res = session.query(models.Plan, models.Task)\
-                .filter(models.Plan.id == plan_id).join(models.Task)
+            return query_res.as_dict(include_wo = True)
 
-            for plan_res, result in query_res:
-                link = url_for('get_tasks', task_id = result.id)
-                ret.append(result.as_dict(include_wo = True, link = link))
-
-        else:
-            query_res = session.query(models.Task).all()
-            for result in query_res:
-                link = url_for('get_tasks', task_id = result.id)
-                ret.append(result.as_dict(include_wo = True, link = link))
-
-    return json.dumps(ret)
+    return json.dumps(dbpool.run(load))
 
 
 @app.route('/tasks/<int:task_id>', methods = ['DELETE'])
+@utils.retry_on_conflict
+@dbpool.offload
 def delete_task(task_id):
     """
     Deletes a specified task
@@ -194,7 +762,7 @@ def delete_task(task_id):
     @return success
     """
 
-    with utils.db_session() as session:
+    with utils.db_session(write = True) as session:
         task = session.query(models.Task).get(task_id)
         if task:
             if task.get_status() != Status.NOTSTARTED:
@@ -206,6 +774,8 @@ def delete_task(task_id):
 
 
 @app.route('/tasks/<int:task_id>', methods = ['PUT'])
+@utils.retry_on_conflict
+@dbpool.offload
 def update_tasks(task_id):
     """
     Updates a task. The follow operations are allowed by the client:
@@ -225,7 +795,7 @@ def update_tasks(task_id):
                                 or new_target_quantity <= 0):
         raise HTTPError(400, 'Invalid target quantity')
 
-    with utils.db_session() as session:
+    with utils.db_session(write = True) as session:
         task = session.query(models.Task).get(task_id)
         if not task:
             raise HTTPError(404, 'Task not found')
@@ -241,7 +811,7 @@ def update_tasks(task_id):
         else:
             if new_product_id:
                 #check if existing work orders
-                if len(task.work_order) > 0:
+                if task.get_num_work_orders() > 0:
                     raise HTTPError(403, 'Task has existing work orders. Cannot alter product')
 
                 task.product_id = new_product_id
@@ -268,6 +838,32 @@ def update_tasks(task_id):
         return json.dumps(ret)
 
 
+def _create_work_order(session, task_id, target_quantity):
+    """
+    Create a work order in session
+
+    @return work order dict
+    """
+    task = session.query(models.Task).get(task_id)
+    if not task:
+        raise HTTPError(404, 'Task not found')
+
+    if task.get_status() == Status.COMPLETED:
+        raise HTTPError(403, 'Task is already completed. Cannot add new work order')
+
+    if target_quantity + task.wo_target_quantity > task.target_quantity:
+        raise HTTPError(403, 'New work order quantity greater than task total quantity')
+
+    new_wo = models.WorkOrder()
+    new_wo.target_quantity = target_quantity
+    new_wo.task_id = task_id
+
+    session.add(new_wo)
+    session.flush()
+
+    return new_wo.as_dict()
+
+
 @app.route('/tasks/<int:task_id>/work_order', methods = ['POST'])
 def create_work_order(task_id):
     """
@@ -278,52 +874,102 @@ def create_work_order(task_id):
     @return work order    
     """
 
-    ret = []
     content = request.get_json()
     target_quantity = content.get('target_quantity', None)
     if not isinstance(target_quantity, int) and target_quantity <= 0:
         raise HTTPError(400, 'Invalid parameters to work order')
 
-    with utils.db_session() as session:
-        total_work = func.sum(models.WorkOrder.target_quantity)\
-            .label('total_wo_quantity')
-
-        query_res = session.query(\
-            models.Task, total_work)\
-            .outerjoin(models.WorkOrder)\
-            .filter(models.Task.id == task_id)
-#        query_res = session.query(\
-#            models.Task.target_quantity, models.Task.status, total_work)\
-#            .outerjoin(models.WorkOrder)\
-#            .filter(models.Task.id == task_id)
-
-        for result in query_res:
-            task, total_work = result
-#            task_target_quantity, task_status, total_work = result
-        if not total_work:
-            total_work = 0
+    ret = _write(_create_work_order, task_id, target_quantity)
+    ret['link'] = url_for('get_work_order', work_id = ret['id'])
+    return json.dumps(ret)
+
+
+@app.route('/tasks/<int:task_id>/work_orders/batch', methods = ['POST'])
+@utils.retry_on_conflict
+@dbpool.offload
+def create_work_orders_batch(task_id):
+    """
+    Creates work orders in bulk. The task quantity limit is checked once
+    for the whole batch, which is inserted in a single flush and committed
+    once.
+    @param: task_id (pk)
+    @body: json list of objects with target_quantity
+
+    @return list of work orders
+    """
+    targets = _batch_targets(request.get_json(), 'task %d' % task_id)
 
+    ret = []
+    with utils.db_session(write = True) as session:
+        task = session.query(models.Task).get(task_id)
         if not task:
             raise HTTPError(404, 'Task not found')
 
         if task.get_status() == Status.COMPLETED:
             raise HTTPError(403, 'Task is already completed. Cannot add new work order')
 
-        if target_quantity + total_work > task.target_quantity:
+        if sum(targets) + task.wo_target_quantity > task.target_quantity:
             raise HTTPError(403, 'New work order quantity greater than task total quantity')
-        
-        new_wo = models.WorkOrder()
-        new_wo.target_quantity = target_quantity
-        new_wo.task_id = task_id
 
-        session.add(new_wo)
+        new_wos = [models.WorkOrder(task_id = task_id, target_quantity = target)
+                   for target in targets]
+        session.add_all(new_wos)
         session.flush()
 
-        link = url_for('get_work_order', work_id = new_wo.id)
-        ret = new_wo.as_dict(link = link)
+        for new_wo in new_wos:
+            link = url_for('get_work_order', work_id = new_wo.id)
+            ret.append(new_wo.as_dict(link = link))
+
     return json.dumps(ret)
 
 
+def _update_work_order(session, work_id, quantity, completed):
+    """
+    Update the quantity and status of a work order in session
+
+    @return work order dict
+    """
+    wo = session.query(models.WorkOrder).get(work_id)
+    if not wo:
+        raise HTTPError(404, 'Work order not found')
+
+    task = wo.task
+    product_id = task.product_id
+    debited = 0
+    if task.get_status() == Status.COMPLETED:
+        debited = task.get_total_actual()
+
+    if quantity is not None:
+        #check if work order quantity can be updated / started
+        quantity_diff = quantity - wo.actual_quantity
+        if not utils.reserve_inventory(session, product_id, quantity_diff,
+                                       key = work_id):
+           raise HTTPError(403, 'Work order cannot be started because central inventory does not have enough product')
+
+        wo.actual_quantity = quantity
+
+    #Update the WO status. If it was NOTSTARTED before, mark as INPROGRESS
+    if wo.status == Status.NOTSTARTED:
+        wo.status = Status.INPROGRESS
+    if completed:
+        if wo.actual_quantity <= 0:
+            raise HTTPError(403, 'Cannot complete work order without any product applied')
+        wo.status = Status.COMPLETED
+
+    #Flushing updates the task rollups. Determine if all the WorkOrders
+    #are completed.
+    session.flush()
+    if task.get_status() == Status.COMPLETED:
+        #All WorkOrders are complete. Update Central Inventory with the
+        #quantity not debited yet
+        total_quantity = task.get_total_actual() - debited
+        if not utils.debit_inventory(session, product_id, total_quantity):
+            raise HTTPError(403, 'Central inventory does not have enough product to complete the task')
+
+    session.flush()
+    return wo.as_dict()
+
+
 @app.route('/work_orders/<int:work_id>', methods = ['PUT'])
 def update_work_order(work_id):
     """
@@ -331,7 +977,6 @@ def update_work_order(work_id):
 
     @return updated work order
     """
-    ret = []
     content = request.get_json()
     quantity = content.get('actual_quantity', None)
     completed = content.get('completed', False)
@@ -339,74 +984,20 @@ def update_work_order(work_id):
     if quantity and quantity <= 0:
         raise HTTPError(400, 'Invalid parameters to update work order')
 
-    with utils.db_session() as session:
-        wo = session.query(models.WorkOrder).get(work_id)
-        if not wo:
-            raise HTTPError(404, 'Work order not found')
-
-        query_res = session.query(\
-            models.Inventory,
-            models.WorkOrderInventory)\
-            .outerjoin(models.WorkOrderInventory)\
-            .filter(models.Inventory.id == wo.task.product_id)
-
-        wo_inventory = None
-        for result in query_res:
-            central_inventory, wo_inventory = result
-
-        if wo_inventory is None:
-            wo_inventory = models.WorkOrderInventory(wo.task.product_id)
-            session.add(wo_inventory)
-
-        if quantity is not None:
-            #check if work order quantity can be updated / started
-            quantity_diff = quantity - wo.actual_quantity
-
-            wo_inventory.active_inventory += quantity_diff
-            if wo_inventory.active_inventory > central_inventory.quantity:
-               raise HTTPError(403, 'Work order cannot be started because central inventory does not have enough product')
-
-            wo.actual_quantity = quantity
-
-        #Update the WO status. If it was NOTSTARTED before, mark as INPROGRESS
-        if wo.status == Status.NOTSTARTED:
-            wo.status = Status.INPROGRESS
-            wo.task.status = Status.INPROGRESS
-        if completed:
-            if wo.actual_quantity <= 0:
-                raise HTTPError(403, 'Cannot complete work order without any product applied')
-            wo.status = Status.COMPLETED
-
-        #Determine if all the WorkOrders are completed.
-        total_wo = func.count(models.WorkOrder.id)
-        total_completed = func.count(case(\
-                [((models.WorkOrder.status == Status.COMPLETED), models.WorkOrder.id)], else_ = literal_column("NULL"))).label("total_wo_complete")
-        sum_wo_quantity = func.sum(models.WorkOrder.actual_quantity)
-
-        query_res = session.query(total_completed, total_wo, sum_wo_quantity).filter(models.WorkOrder.task_id == wo.task.id)
-        for result in query_res:
-            num_complete, num_wo, total_quantity = result
-
-        if num_complete and num_wo and num_complete == num_wo:
-            #All WorkOrders are complete. Update Central Inventory
-#            wo.task.status = Status.COMPLETED
-            wo_inventory.active_inventory -= total_quantity
-            central_inventory.quantity -= total_quantity
-
-        session.flush()
-        link = url_for('get_work_order', work_id = work_id)
-        ret.append(wo.as_dict(link = link))
-
-    return json.dumps(ret)
+    ret = _write(_update_work_order, work_id, quantity, completed)
+    ret['link'] = url_for('get_work_order', work_id = work_id)
+    return json.dumps([ret])
 
 @app.route('/work_orders/<int:work_id>', methods = ['DELETE'])
+@utils.retry_on_conflict
+@dbpool.offload
 def delete_work_order(work_id):
     """
     Delete a specified work order. Can only delete if work order has
     status: NOTSTARTED
     """
 
-    with utils.db_session() as session:
+    with utils.db_session(write = True) as session:
         work_order = session.query(models.WorkOrder).get(work_id)
         if work_order:
             if work_order.status != Status.NOTSTARTED:
@@ -419,6 +1010,7 @@ def delete_work_order(work_id):
 @app.route('/work_orders')
 @app.route('/tasks/<int:task_id>/work_orders')
 @app.route('/work_orders/<int:work_id>')
+@cache.cached_view('work_order', 'task')
 def get_work_order(work_id = None, task_id = None):
     """
     Get a specified work order
@@ -426,28 +1018,153 @@ def get_work_order(work_id = None, task_id = None):
     @return request work orders
     """
 
-    ret = []
-    with utils.db_session() as session:
-        if work_id:
+    if not work_id and task_id and store.domain_store.loaded \
+            and not request.args:
+        link = _link_template('get_work_order')
+        return json.dumps([
+                models.WorkOrder.serializer.to_dict(wo.values(), link % wo.id)
+                for wo in store.domain_store.children_of('task', task_id)])
+
+    if not work_id:
+        serializer = models.WorkOrder.serializer
+        projected = _projection(serializer)
+        if projected:
+            serializer = projected[0]
+        criteria = _filters({'status': (models.WorkOrder.status, _status),
+                             'task_id': (models.WorkOrder.task_id, int)},
+                            models.WorkOrder.created_date)
+        task_criteria = _filters({'product_id': (models.Task.product_id, int),
+                                  'plan_id': (models.Task.plan_id, int)})
+
+        def build_query(session):
+            query_res = session.query(*serializer.columns).filter(*criteria)
+            if task_criteria:
+                query_res = query_res.join(models.Task)\
+                    .filter(*task_criteria)
+            if task_id:
+                query_res = query_res.filter(models.WorkOrder.task_id == task_id)
+            return query_res
+
+        link = _link_template('get_work_order')
+        def to_dict(result):
+            return serializer.to_dict(result, link % result.id)
+
+        return _list_response(build_query, models.WorkOrder.id, to_dict)
+
+    if store.domain_store.loaded:
+        work_order = store.domain_store.get('work_order', work_id)
+        if work_order is None:
+            raise HTTPError(404, 'Work Order not found')
+        return json.dumps(models.WorkOrder.serializer.to_dict(
+                work_order.values()))
+
+    def load():
+        with utils.db_session() as session:
             query_res = session.query(models.WorkOrder).get(work_id)
             if not query_res:
                 raise HTTPError(404, 'Work Order not found')
-            ret = query_res.as_dict()
-        elif task_id:
-            query_res = session.query(models.WorkOrder)\
-                .filter(models.Task.id == task_id).join(models.Task)
-            for result in query_res:
-                link = url_for('get_work_order', work_id = result.id)
-                ret.append(result.as_dict(link = link))
-        else:
-            query_res = session.query(models.WorkOrder).all()
-            for result in query_res:
-                link = url_for('get_work_order', work_id = result.id)
-                ret.append(result.as_dict(link = link))
+            return query_res.as_dict()
+
+    return json.dumps(dbpool.run(load))
+
+
+@app.route('/reports/plans')
+@app.route('/reports/plan/<int:plan_id>')
+@cache.cached_view('plan', 'task', 'central_inventory')
+def get_report(plan_id = None):
+    """
+    Planned vs actual quantities of each task of a plan, or of every plan,
+    rolled up per product and plan, with the current inventory balance of
+    the products. Served from the report cache.
+
+    @param plan_id pk of the plan table
+
+    @return report
+    """
+    def build():
+        with utils.db_session() as session:
+            return reports.build_report(session, plan_id)
+
+    ret = reports.report_cache.get(plan_id, lambda: dbpool.run(build))
+    if plan_id is not None and not ret['plans']:
+        raise HTTPError(404, 'Plan not found')
 
     return json.dumps(ret)
 
 
+@app.route('/export/<table>')
+def get_export(table):
+    """
+    Stream the rows of a table in id order, as NDJSON (?format=ndjson) or
+    CSV (?format=csv), gzipped for clients accepting it. ?since=<id or
+    created date> exports the rows after the watermark of a previous
+    export, returned in the X-Export-Watermark header. The rows are read a
+    chunk at a time on the db pool, each chunk in its own transaction.
+
+    @param table central_inventory, plan, task or work_order
+
+    @return rows
+    """
+    if table not in export.TABLES:
+        raise HTTPError(404, 'Unknown table')
+
+    fmt = request.args.get('format', 'ndjson')
+    compress = request.accept_encodings['gzip'] > 0
+    try:
+        result, output = dbpool.run(export.export, table, fmt,
+                                    request.args.get('since'), compress,
+                                    app.config['EXPORT_CHUNK_SIZE'])
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+    headers = {}
+    if result.watermark is not None:
+        headers['X-Export-Watermark'] = str(result.watermark)
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+
+    def generate():
+        for chunk in output:
+            yield chunk
+        metrics.add_rows(result.rows)
+
+    return Response(stream_with_context(dbpool.stream(generate())),
+                    headers = headers, mimetype = export.FORMATS[fmt])
+
+
+@app.route('/metrics')
+def get_metrics():
+    """
+    Request count, latency, SQL statements, db time and rows per endpoint
+
+    @return metrics in the Prometheus text format
+    """
+    return Response(metrics.registry.render(),
+                    mimetype = 'text/plain; version=0.0.4')
+
+
+@app.route('/events')
+def get_events():
+    """
+    Server-sent events of the task, work order and inventory changes as
+    they commit. ?plan_id=<id> and ?task_id=<id>, repeatable, only deliver
+    the task and work order events of those plans and tasks. Resumes after
+    the Last-Event-ID header or ?last_event_id=<id>.
+
+    @return text/event-stream response
+    """
+    last_event_id = request.headers.get('Last-Event-ID',
+                                        request.args.get('last_event_id'))
+    stream = events.subscribe(last_event_id,
+                              request.args.getlist('plan_id', type = int),
+                              request.args.getlist('task_id', type = int),
+                              app.config['EVENTS_HEARTBEAT'])
+    return Response(stream, mimetype = 'text/event-stream',
+                    headers = {'Cache-Control': 'no-cache',
+                               'X-Accel-Buffering': 'no'})
+
+
 class HTTPError(Exception):
     message = 'An error occurred'
     def __init__(self, status_code, message = None, payload = None):
@@ -471,20 +1188,150 @@ def handle_http_error(error):
     return response
 
 
-def main():
+class WSGIServer(gevent.pywsgi.WSGIServer):
     """
-    Main Entry function
+    gevent WSGI server disabling Nagle's algorithm on client connections.
+    pywsgi writes the status line and headers ahead of the body, and with
+    Nagle the body then waits for the client's delayed ACK, adding ~40ms
+    to every response on a keep-alive connection.
     """
-    # Initialize the DB and delete any existing data
-    models.init_db()
-    utils.clear_dbs()
 
-    utils.populate_inventory()
+    def handle(self, sock, address):
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return gevent.pywsgi.WSGIServer.handle(self, sock, address)
+
+
+def configure_db(app):
+    """
+    Create the db engine and size the db pool from the app configuration
+    """
+    dbpool.configure(app.config['DATABASE_THREADS'])
+    writer.configure(app.config['GROUP_COMMIT_MAX_BATCH'],
+                     app.config['GROUP_COMMIT_MAX_WAIT'])
+    reservations.configure(app.config['RESERVATION_STRIPES'])
+    events.configure(app.config['EVENTS_BUFFER_SIZE'])
+    admission.configure(app.config['ADMISSION_LIMITS'],
+                        app.config['ADMISSION_TIMEOUT'],
+                        app.config['ADMISSION_RETRY_AFTER'])
+    # Loaded from the new db by main
+    store.clear()
+
+    url = app.config['DATABASE']
+    if '://' not in url:
+        url = 'sqlite:///' + url
+
+    return models.configure_engine(
+        url,
+        echo = app.config['DATABASE_ECHO'],
+        pool_size = app.config['DATABASE_POOL_SIZE'],
+        pool_timeout = app.config['DATABASE_POOL_TIMEOUT'],
+        sqlite_pragmas = app.config['SQLITE_PRAGMAS'],
+        sqlite_cache_size = app.config['SQLITE_CACHE_SIZE'],
+        sqlite_mmap_size = app.config['SQLITE_MMAP_SIZE'])
+
+
+# Time this module was imported, the process start time where /proc is missing
+_IMPORTED = time.time()
+# Seconds from process start until the server listened, set by serve()
+startup_seconds = None
+
+
+def process_started():
+    """
+    @return time the process started
+    """
+    try:
+        with open('/proc/self/stat') as fobj:
+            # Fields after the command name, starttime is the 22nd field
+            ticks = int(fobj.read().rpartition(')')[2].split()[19])
+        with open('/proc/uptime') as fobj:
+            uptime = float(fobj.read().split()[0])
+    except (IOError, IndexError, ValueError):
+        return _IMPORTED
+
+    return time.time() - (uptime - ticks / float(os.sysconf('SC_CLK_TCK')))
+
+
+def collect_startup():
+    if startup_seconds is None:
+        return []
+    return [('planner_startup_seconds', 'gauge',
+             'Seconds from process start until the server listened',
+             [({}, startup_seconds)])]
+
+metrics.registry.add_collector(collect_startup)
+
+
+def main(argv = None):
+    """
+    Main Entry function. Serves the existing db, migrated to the current
+    schema, unless --reset is given.
+    """
+    parser = argparse.ArgumentParser(description = 'Planner service')
+    parser.add_argument('--reset', action = 'store_true',
+                        help = 'delete every plan, task, work order and '
+                        'product and load the sample inventory')
+    parser.add_argument('--host', default = '')
+    parser.add_argument('--port', type = int, default = 8088)
+    args = parser.parse_args(argv)
+
+    configure_db(app)
+    try:
+        models.init_db()
+    except migrations.SchemaVersionError as e:
+        sys.stderr.write('%s, upgrade the planner\n' % e)
+        return 1
+
+    if args.reset:
+        utils.clear_dbs()
+        utils.populate_inventory()
+
+    if app.config['MEMORY_STORE']:
+        if app.config['WORKERS'] > 1:
+            # Each worker would miss the writes of the others
+            sys.stderr.write('MEMORY_STORE ignored with WORKERS > 1\n')
+        else:
+            store.load()
 
-    # Gevent wsgi server with bottle as the wsgi app
     app.debug = True
-    gevent.pywsgi.WSGIServer(('', 8088), app).serve_forever()
+    serve(app, (args.host, args.port))
+    return 0
+
+
+def _ready(budget):
+    """
+    Report the startup time of the process once the server listens
+    """
+    global startup_seconds
+    startup_seconds = time.time() - process_started()
+    sys.stderr.write('planner ready in %.2f seconds\n' % startup_seconds)
+    if startup_seconds > budget:
+        sys.stderr.write('startup exceeded its budget of %.2f seconds\n'
+                         % budget)
+
+
+def serve(app, address):
+    """
+    Serve app on address with the gevent WSGI server, from WORKERS
+    pre-forked processes when above 1
+    """
+    if app.config['WORKERS'] > 1:
+        # Only loaded when forking
+        import prefork
+        prefork.PreforkServer(
+            app, address, app.config['WORKERS'],
+            setup = lambda: configure_db(app),
+            timeout = app.config['WORKER_TIMEOUT'],
+            shutdown_timeout = app.config['SHUTDOWN_TIMEOUT'],
+            server_class = WSGIServer,
+            ready = lambda: _ready(app.config['STARTUP_BUDGET'])).serve_forever()
+    else:
+        server = WSGIServer(address, app)
+        server.start()
+        _ready(app.config['STARTUP_BUDGET'])
+        server.serve_forever()
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Single writer group commit queue for write operations
+"""
+from sqlalchemy.exc import OperationalError
+import gevent
+import gevent.event
+import gevent.queue
+import sys
+import threading
+import time
+import dbpool
+import metrics
+import utils
+
+
+class GroupCommitWriter(object):
+    """
+    Applies queued write operations from one writer greenlet. Operations are
+    functions taking a session. Up to max_batch of them run in a single
+    write transaction, each within its own SAVEPOINT, so an operation that
+    fails is rolled back without affecting the others and the batch pays
+    for one commit. The writer waits at most max_wait seconds for more
+    operations after the first one of a batch.
+
+    Operations run on the db pool without the request context, they must
+    not use flask.request or url_for.
+    """
+
+    def __init__(self, max_batch = 64, max_wait = 0.002):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = gevent.queue.Queue()
+        self.greenlet = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+
+    def configure(self, max_batch, max_wait):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+    def submit(self, op, *args):
+        """
+        Queue op(session, *args) and wait for the batch holding it to commit
+
+        @return result of op. Exceptions raised by op, or by the commit of
+        its batch, are raised here.
+        """
+        result = gevent.event.AsyncResult()
+        self.queue.put((op, args, result))
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = gevent.spawn(self._run)
+        return result.get()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                if self.queue.qsize():
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(
+                            timeout = max(deadline - time.time(), 0)))
+            except gevent.queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                outcomes = self._commit(batch)
+            except Exception:
+                exc_info = sys.exc_info()
+                for op, args, result in batch:
+                    result.set_exception(exc_info[1], exc_info = exc_info)
+                continue
+
+            for (op, args, result), (value, exc_info) in zip(batch, outcomes):
+                if exc_info is None:
+                    result.set(value)
+                else:
+                    result.set_exception(exc_info[1], exc_info = exc_info)
+
+    @utils.retry_on_conflict
+    def _commit(self, batch):
+        """
+        Apply a batch in one transaction on the db pool. A lock conflict
+        fails the whole transaction, which is then retried.
+
+        @return (result, None) or (None, exc_info) per operation
+        """
+        def apply_batch():
+            outcomes = []
+            with utils.db_session(write = True) as session:
+                for op, args, result in batch:
+                    savepoint = session.begin_nested()
+                    try:
+                        value = op(session, *args)
+                        savepoint.commit()
+                        outcomes.append((value, None))
+                    except OperationalError as e:
+                        if utils.is_conflict(e):
+                            raise
+                        savepoint.rollback()
+                        outcomes.append((None, sys.exc_info()))
+                    except Exception:
+                        savepoint.rollback()
+                        outcomes.append((None, sys.exc_info()))
+
+            return outcomes
+
+        outcomes = dbpool.run(apply_batch)
+        with self.lock:
+            self.batches += 1
+            self.operations += len(batch)
+        return outcomes
+
+    def collect(self):
+        with self.lock:
+            batches, operations = self.batches, self.operations
+        return [
+            ('planner_writer_queued', 'gauge',
+             'Write operations waiting for the group commit writer',
+             [({}, self.queue.qsize())]),
+            ('planner_writer_batches_total', 'counter',
+             'Transactions committed by the group commit writer',
+             [({}, batches)]),
+            ('planner_writer_operations_total', 'counter',
+             'Write operations applied by the group commit writer',
+             [({}, operations)])]
+
+
+group_writer = GroupCommitWriter()
+metrics.registry.add_collector(group_writer.collect)
+
+configure = group_writer.configure
+submit = group_writer.submit
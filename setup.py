@@ -12,5 +12,12 @@ setup(
         'Flask',
         'sqlalchemy >= 0.9.0',
         'gevent'
-    ]
+    ],
+
+    entry_points={
+        'console_scripts': [
+            'planner = planner.client:main',
+            'planner-admin = planner.manage:main',
+        ]
+    }
 )
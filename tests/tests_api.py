@@ -1,22 +1,1202 @@
 import os
+import csv
+import errno
+import gzip
+import json
+import random
+import threading
+import planner.admission
+import planner.events
+import planner.client
+import planner.manage
+import planner.store
 import planner.views
 import unittest
 import tempfile
+import time
+import gevent
+import httplib
+import re
+import signal
+import socket
+import subprocess
+import sys
+import urllib2
+from cStringIO import StringIO
+from sqlalchemy import event, inspect
 
 class FlaskTestCase(unittest.TestCase):
 
     def setUp(self):
         self.db_fd, planner.views.app.config['DATABASE'] = tempfile.mkstemp()
         self.app = planner.views.app.test_client()
+        planner.views.configure_db(planner.views.app)
         planner.models.init_db()
+        planner.reports.report_cache.clear()
+        planner.cache.response_cache.clear()
+        planner.metrics.registry.clear()
 
     def tearDown(self):
+        planner.models.engine.dispose()
         os.close(self.db_fd)
         os.unlink(planner.views.app.config['DATABASE'])
 
+    def post_json(self, url, payload, method = 'post'):
+        rv = getattr(self.app, method)(url, data = json.dumps(payload),
+                                       content_type = 'application/json')
+        return json.loads(rv.data)
+
+    def create_plan(self, num_tasks, num_wo):
+        with planner.utils.db_session() as session:
+            item = planner.models.Inventory('corn', 15000)
+            session.add(item)
+            session.flush()
+            prod_id = item.id
+
+        plan = self.post_json('/plans', {'name': 'Plan 1'})
+        for i in range(num_tasks):
+            task = self.post_json('/plans/%d/tasks' % plan['id'],
+                                  {'prod_id': prod_id, 'quantity': 10})
+            for j in range(num_wo):
+                self.post_json('/tasks/%d/work_order' % task['id'],
+                               {'target_quantity': 1})
+        return plan
+
+    def count_queries(self, url):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(planner.models.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            rv = self.app.get(url)
+        finally:
+            event.remove(planner.models.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        return json.loads(rv.data), len(statements)
+
     def test_empty_db(self):
         rv = self.app.get('/inventory')
         print rv.data
 
+    def test_task_list_query_count(self):
+        plan = self.create_plan(2, 2)
+        tasks, small_count = self.count_queries('/tasks')
+        self.assertEqual(len(tasks), 2)
+        plan_tasks, small_plan_count = self.count_queries(
+            '/plans/%d/tasks' % plan['id'])
+        self.assertEqual(len(plan_tasks), 2)
+
+        plan = self.create_plan(10, 2)
+        tasks, large_count = self.count_queries('/tasks')
+        self.assertEqual(len(tasks), 12)
+        plan_tasks, large_plan_count = self.count_queries(
+            '/plans/%d/tasks' % plan['id'])
+        self.assertEqual(len(plan_tasks), 10)
+
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(small_plan_count, large_plan_count)
+        for task in plan_tasks:
+            self.assertEqual(task['status'], planner.models.Status.NOTSTARTED)
+            self.assertEqual(task['actual_quantity'], 0)
+
+        work_orders = json.loads(self.app.get(
+                '/tasks/%d/work_orders' % plan_tasks[0]['id']).data)
+        self.post_json('/work_orders/%d' % work_orders[0]['id'],
+                       {'actual_quantity': 1}, method = 'put')
+        plan_tasks, count = self.count_queries('/plans/%d/tasks' % plan['id'])
+        self.assertEqual(plan_tasks[0]['status'],
+                         planner.models.Status.INPROGRESS)
+        self.assertEqual(plan_tasks[0]['actual_quantity'], 1)
+
+    def test_expand_plan(self):
+        small = self.create_plan(2, 1)
+        large = self.create_plan(30, 3)
+        url = '/plans/%d?expand=tasks,work_orders'
+        tree, small_count = self.count_queries(url % small['id'])
+        tree, large_count = self.count_queries(url % large['id'])
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(len(tree['tasks']), 30)
+        self.assertEqual([len(task['work_orders']) for task in tree['tasks']],
+                         [3] * 30)
+        task = dict(tree['tasks'][0])
+        wo = task.pop('work_orders')[0]
+        self.assertEqual(task, dict(json.loads(self.app.get(task['link']).data),
+                                    link = task['link']))
+        self.assertEqual(wo, dict(json.loads(self.app.get(wo['link']).data),
+                                  link = wo['link']))
+
+        # work_orders implies tasks, tasks alone leaves out the work orders
+        self.post_json('/work_orders/%d' % wo['id'], {'actual_quantity': 1},
+                       method = 'put')
+        tree = json.loads(self.app.get('/plans/%d?expand=work_orders'
+                                       % large['id']).data)
+        self.assertEqual(tree['tasks'][0]['work_orders'][0]['actual_quantity'], 1)
+        self.assertEqual(tree['tasks'][0]['actual_quantity'], 1)
+        tree = json.loads(self.app.get('/plans/%d?expand=tasks'
+                                       % large['id']).data)
+        self.assertNotIn('work_orders', tree['tasks'][0])
+        self.assertEqual(self.app.get('/plans/%d?expand=products'
+                                      % large['id']).status_code, 400)
+        self.assertEqual(self.app.get(url % 1000).status_code, 404)
+
+    def test_memory_store(self):
+        domain_store = planner.store.domain_store
+        plan = self.create_plan(3, 2)
+        other = self.create_plan(1, 1)
+        planner.store.load()
+        tasks = json.loads(self.app.get('/plans/%d/tasks' % plan['id']).data)
+        wos = json.loads(self.app.get('/tasks/%d/work_orders'
+                                      % tasks[0]['id']).data)
+
+        def compare():
+            urls = ['/plans/%d' % plan['id'], '/plans/%d' % other['id'],
+                    '/plans/%d?expand=work_orders' % plan['id'],
+                    '/plans/%d?expand=tasks' % other['id'],
+                    '/plans/%d/tasks' % plan['id'],
+                    '/plans/%d/tasks' % other['id'], '/inventory/1',
+                    '/inventory/2', '/plans/1000', '/tasks/1000']
+            for task in tasks:
+                urls.extend(['/tasks/%d' % task['id'],
+                             '/tasks/%d/work_orders' % task['id']])
+            urls.extend('/work_orders/%d' % wo['id'] for wo in wos)
+
+            responses = []
+            for loaded in (True, False):
+                planner.cache.response_cache.clear()
+                domain_store.loaded = loaded
+                responses.append([(url, self.app.get(url).status_code,
+                                   self.app.get(url).data) for url in urls])
+            domain_store.loaded = True
+            for stored, queried in zip(*responses):
+                self.assertEqual(stored, queried)
+            self.assertEqual(planner.store.verify(), [])
+
+        compare()
+        _, count = self.count_queries('/plans/%d?expand=work_orders'
+                                      % plan['id'])
+        self.assertEqual(count, 0)
+
+        # Rollups, moves between plans, deletes and bulk imports are
+        # written through
+        self.post_json('/work_orders/%d' % wos[0]['id'],
+                       {'actual_quantity': 1, 'completed': True},
+                       method = 'put')
+        self.post_json('/tasks/%d' % tasks[1]['id'], {'plan_id': other['id']},
+                       method = 'put')
+        self.app.delete('/work_orders/%d' % wos[1]['id'])
+        self.app.delete('/tasks/%d' % tasks[2]['id'])
+        self.post_json('/tasks/%d/work_order' % tasks[0]['id'],
+                       {'target_quantity': 1})
+        self.app.post('/inventory/import', data = 'corn,5\nsorghum,7\n')
+        compare()
+
+        # Writes of other processes are reported
+        planner.models.engine.execute(
+            'UPDATE work_order SET actual_quantity = 9 WHERE id = %d'
+            % wos[0]['id'])
+        problems = planner.store.verify()
+        self.assertEqual([problem[:2] for problem in problems],
+                         [('work_order', wos[0]['id'])])
+        planner.store.clear()
+
+    def test_keyset_pagination(self):
+        self.create_plan(5, 1)
+        all_tasks = json.loads(self.app.get('/tasks').data)
+        self.assertEqual(len(all_tasks), 5)
+
+        rv = self.app.get('/tasks?limit=2')
+        page = json.loads(rv.data)
+        self.assertEqual([t['id'] for t in page],
+                         [t['id'] for t in all_tasks[:2]])
+        self.assertIn('after=%d' % page[-1]['id'], rv.headers['Link'])
+
+        seen = []
+        url = '/work_orders?limit=2'
+        while url:
+            rv = self.app.get(url)
+            seen.extend(json.loads(rv.data))
+            link = rv.headers.get('Link')
+            url = link[1:link.index('>')] if link else None
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(wo['id'] for wo in seen)), 5)
+
+        # The next links keep every value of repeated filters
+        for wo in json.loads(self.app.get('/work_orders').data)[:2]:
+            self.post_json('/work_orders/%d' % wo['id'],
+                           {'actual_quantity': 1, 'completed': wo['id'] % 2},
+                           method = 'put')
+        seen = []
+        url = '/work_orders?status=completed&status=in%20progress&limit=1'
+        while url:
+            rv = self.app.get(url)
+            seen.extend(json.loads(rv.data))
+            link = rv.headers.get('Link')
+            url = link[1:link.index('>')] if link else None
+        self.assertEqual(sorted(wo['status'] for wo in seen),
+                         ['completed', 'in progress'])
+
+    def test_stream_matches_list(self):
+        self.create_plan(3, 2)
+        for url in ('/inventory', '/plans', '/tasks', '/work_orders'):
+            rv = self.app.get(url)
+            streamed = self.app.get(url + '?stream=true')
+            self.assertEqual(rv.data, streamed.data)
+
+        streamed = self.app.get('/work_orders?stream=1&limit=4')
+        self.assertEqual(len(json.loads(streamed.data)), 4)
+        self.assertIn('rel="next"', streamed.headers['Link'])
+
+        # Streams are produced a chunk of rows at a time
+        chunk_size = planner.views.STREAM_CHUNK_SIZE
+        planner.views.STREAM_CHUNK_SIZE = 2
+        try:
+            for limit in (2, 3, 4, 6):
+                url = '/work_orders?limit=%d' % limit
+                self.assertEqual(self.app.get(url).data,
+                                 self.app.get(url + '&stream=true').data)
+
+            # No transaction is left open between chunks, writes go through
+            # while a stream is being read
+            streamed = self.app.get('/work_orders?stream=true',
+                                    buffered = False)
+            body = iter(streamed.response)
+            first = next(body)
+            plan = self.post_json('/plans', {'name': 'during stream'})
+            self.assertEqual(plan['name'], 'during stream')
+            self.assertEqual(json.loads(first + ''.join(body)),
+                             json.loads(self.app.get('/work_orders').data))
+            streamed.close()
+        finally:
+            planner.views.STREAM_CHUNK_SIZE = chunk_size
+
+    def test_task_rollups(self):
+        plan = self.create_plan(1, 3)
+        task = json.loads(self.app.get('/plans/%d/tasks' % plan['id']).data)[0]
+        self.assertEqual(task['wo_not_started'], 3)
+        self.assertEqual(task['wo_target_quantity'], 3)
+
+        work_orders = json.loads(self.app.get(
+                '/tasks/%d/work_orders' % task['id']).data)
+        self.app.delete('/work_orders/%d' % work_orders[2]['id'])
+        for wo in work_orders[:2]:
+            self.post_json('/work_orders/%d' % wo['id'],
+                           {'actual_quantity': 2, 'completed': True},
+                           method = 'put')
+
+        task = json.loads(self.app.get('/tasks/%d' % task['id']).data)
+        self.assertEqual(task['status'], planner.models.Status.COMPLETED)
+        self.assertEqual(task['wo_not_started'], 0)
+        self.assertEqual(task['wo_completed'], 2)
+        self.assertEqual(task['wo_target_quantity'], 2)
+        self.assertEqual(task['actual_quantity'], 4)
+
+        with planner.utils.db_session() as session:
+            self.assertEqual(planner.utils.check_task_rollups(session), [])
+            session.query(planner.models.Task)\
+                .update({'wo_completed': 0, 'status': 'in progress'})
+
+        # Cache the damaged rollups, the write above bypassed the listeners
+        planner.cache.response_cache.clear()
+        planner.reports.report_cache.clear()
+        url = '/tasks/%d' % task['id']
+        etag = self.app.get(url).headers['ETag']
+        report = json.loads(self.app.get('/reports/plan/%d' % plan['id']).data)
+        self.assertEqual(report['plans'][0]['tasks'][0]['status'],
+                         planner.models.Status.INPROGRESS)
+
+        with planner.utils.db_session() as session:
+            rebuilt = planner.utils.rebuild_task_rollups(session)
+            self.assertEqual([r[0] for r in rebuilt], [task['id']])
+
+        # The rebuild invalidates the ETags and cached reports
+        rv = self.app.get(url, headers = {'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data)['wo_completed'], 2)
+        report = json.loads(self.app.get('/reports/plan/%d' % plan['id']).data)
+        self.assertEqual(report['plans'][0]['tasks'][0]['status'],
+                         planner.models.Status.COMPLETED)
+
+        with planner.utils.db_session() as session:
+            self.assertEqual(planner.utils.check_task_rollups(session), [])
+
+    def test_batch_create(self):
+        plan = self.create_plan(0, 0)
+        payload = [{'prod_id': 1, 'quantity': 10,
+                    'work_orders': [{'target_quantity': 2}] * 3}
+                   for i in range(4)]
+        tasks = self.post_json('/plans/%d/tasks/batch' % plan['id'], payload)
+        self.assertEqual(len(tasks), 4)
+        for task in tasks:
+            self.assertEqual(task['wo_not_started'], 3)
+            self.assertEqual(task['wo_target_quantity'], 6)
+            self.assertEqual([wo['task_id'] for wo in task['work_orders']],
+                             [task['id']] * 3)
+
+        work_orders = self.post_json('/tasks/%d/work_orders/batch'
+                                     % tasks[0]['id'],
+                                     [{'target_quantity': 1}] * 4)
+        self.assertEqual(len(work_orders), 4)
+
+        # The task quantity limit rejects the whole batch
+        rv = self.app.post('/tasks/%d/work_orders/batch' % tasks[1]['id'],
+                           data = json.dumps([{'target_quantity': 2}] * 3),
+                           content_type = 'application/json')
+        self.assertEqual(rv.status_code, 403)
+        rv = self.app.post('/plans/%d/tasks/batch' % plan['id'],
+                           data = json.dumps([{'prod_id': 1, 'quantity': 1},
+                                              {'prod_id': 99, 'quantity': 1}]),
+                           content_type = 'application/json')
+        self.assertEqual(rv.status_code, 400)
+
+        self.assertEqual(len(json.loads(self.app.get('/tasks').data)), 4)
+        self.assertEqual(len(json.loads(self.app.get('/work_orders').data)),
+                         16)
+        with planner.utils.db_session() as session:
+            self.assertEqual(planner.utils.check_task_rollups(session), [])
+
+    def test_concurrent_reservations(self):
+        with planner.utils.db_session() as session:
+            item = planner.models.Inventory('herbicide1', 150)
+            session.add(item)
+            session.flush()
+            prod_id = item.id
+
+        plan = self.post_json('/plans', {'name': 'Plan 1'})
+        task = self.post_json('/plans/%d/tasks/batch' % plan['id'],
+                              [{'prod_id': prod_id, 'quantity': 150,
+                                'work_orders': [{'target_quantity': 1}] * 150}])
+        work_orders = [wo['id'] for wo in task[0]['work_orders']]
+
+        statuses = []
+        def hammer():
+            client = planner.views.app.test_client()
+            for i in range(20):
+                rv = client.put('/work_orders/%d' % random.choice(work_orders),
+                                data = json.dumps({'actual_quantity':
+                                                   random.randint(1, 10)}),
+                                content_type = 'application/json')
+                statuses.append(rv.status_code)
+
+        threads = [threading.Thread(target = hammer) for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(set(statuses), set([200, 403]))
+        with planner.utils.db_session() as session:
+            active = session.query(planner.models.WorkOrderInventory)\
+                .get(prod_id).active_inventory
+            actual = sum(wo.actual_quantity for wo in
+                         session.query(planner.models.WorkOrder))
+            self.assertEqual(active, actual)
+            self.assertTrue(active <= 150)
+
+        # Completing every work order debits the central inventory once.
+        # Release the largest reservations first.
+        work_orders = [wo['id'] for wo in sorted(
+                json.loads(self.app.get('/work_orders').data),
+                key = lambda wo: -wo['actual_quantity'])]
+        for wo_id in work_orders:
+            self.post_json('/work_orders/%d' % wo_id,
+                           {'actual_quantity': 1, 'completed': True},
+                           method = 'put')
+        self.post_json('/work_orders/%d' % work_orders[0],
+                       {'completed': True}, method = 'put')
+        with planner.utils.db_session() as session:
+            item = session.query(planner.models.Inventory).get(prod_id)
+            self.assertEqual(item.quantity, 0)
+            self.assertEqual(item.work_order_inventory.active_inventory, 0)
+
+    def test_striped_reservations(self):
+        planner.views.app.config['RESERVATION_STRIPES'] = 4
+        planner.views.configure_db(planner.views.app)
+        try:
+            with planner.utils.db_session() as session:
+                item = planner.models.Inventory('herbicide1', 100)
+                session.add(item)
+                session.flush()
+                prod_id = item.id
+
+            plan = self.post_json('/plans', {'name': 'Plan 1'})
+            task = self.post_json('/plans/%d/tasks/batch' % plan['id'],
+                                  [{'prod_id': prod_id, 'quantity': 100,
+                                    'work_orders': [{'target_quantity': 1}] * 100}])
+            work_orders = [wo['id'] for wo in task[0]['work_orders']]
+
+            statuses = []
+            def hammer():
+                client = planner.views.app.test_client()
+                for i in range(20):
+                    rv = client.put('/work_orders/%d' % random.choice(work_orders),
+                                    data = json.dumps({'actual_quantity':
+                                                       random.randint(1, 10)}),
+                                    content_type = 'application/json')
+                    statuses.append(rv.status_code)
+
+            threads = [threading.Thread(target = hammer) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(set(statuses), set([200, 403]))
+            with planner.utils.db_session() as session:
+                self.assertEqual(
+                    planner.reservations.check_reservations(session), [])
+                stripes = session.query(planner.models.ReservationStripe).all()
+                self.assertEqual(sorted(s.stripe for s in stripes), range(4))
+                self.assertTrue(sum(s.allotted for s in stripes) <= 100)
+
+            # Completing every work order debits the central inventory and
+            # releases the reservations of every stripe
+            work_orders = [wo['id'] for wo in sorted(
+                    json.loads(self.app.get('/work_orders').data),
+                    key = lambda wo: -wo['actual_quantity'])]
+            for wo_id in work_orders:
+                self.post_json('/work_orders/%d' % wo_id,
+                               {'actual_quantity': 1, 'completed': True},
+                               method = 'put')
+            with planner.utils.db_session() as session:
+                self.assertEqual(
+                    planner.reservations.check_reservations(session), [])
+                item = session.query(planner.models.Inventory).get(prod_id)
+                self.assertEqual(item.quantity, 0)
+                self.assertEqual(planner.reservations.active_reservations(
+                        session, [prod_id]), {prod_id: 0})
+        finally:
+            planner.views.app.config['RESERVATION_STRIPES'] = 0
+            planner.views.configure_db(planner.views.app)
+
+    def test_migrations(self):
+        # A db created by the first schema: no versions, task rollups or
+        # secondary indexes
+        engine = planner.models.engine
+        planner.models.Base.metadata.drop_all(engine)
+        planner.migrations.schema_version.drop(engine)
+        for statement in (
+                'CREATE TABLE central_inventory (id INTEGER PRIMARY KEY, '
+                'product_name VARCHAR, quantity INTEGER)',
+                'CREATE TABLE plan (id INTEGER PRIMARY KEY, name VARCHAR(32), '
+                'created_date DATETIME)',
+                'CREATE TABLE task (id INTEGER PRIMARY KEY, created_date DATETIME, '
+                'plan_id INTEGER NOT NULL, product_id INTEGER NOT NULL, '
+                'target_quantity INTEGER NOT NULL)',
+                'CREATE TABLE work_order (id INTEGER PRIMARY KEY, '
+                'created_date DATETIME, task_id INTEGER NOT NULL, '
+                'status VARCHAR(11), target_quantity INTEGER, '
+                'actual_quantity INTEGER)',
+                'CREATE TABLE work_order_inventory (product_id INTEGER PRIMARY KEY, '
+                'active_inventory INTEGER)',
+                "INSERT INTO central_inventory VALUES (1, 'corn', 100)",
+                "INSERT INTO plan VALUES (1, 'Plan 1', NULL)",
+                'INSERT INTO task VALUES (1, NULL, 1, 1, 10)',
+                'INSERT INTO task VALUES (2, NULL, 1, 1, 5)',
+                "INSERT INTO work_order VALUES (1, NULL, 1, 'completed', 2, 2)",
+                "INSERT INTO work_order VALUES (2, NULL, 1, 'in progress', 3, 1)"):
+            engine.execute(statement)
+
+        self.assertEqual(planner.models.init_db(), [1, 2, 3])
+        self.assertEqual(planner.models.init_db(), [])
+        with planner.utils.db_session() as session:
+            self.assertEqual(planner.migrations.get_version(session.connection()),
+                             planner.migrations.SCHEMA_VERSION)
+            self.assertEqual(planner.utils.check_task_rollups(session), [])
+
+        indexes = set(index['name'] for table in ('task', 'work_order')
+                      for index in inspect(engine).get_indexes(table))
+        self.assertEqual(indexes, set(['ix_task_plan_id',
+                                       'ix_work_order_task_status']))
+        task = json.loads(self.app.get('/tasks/1').data)
+        self.assertEqual(task['status'], planner.models.Status.INPROGRESS)
+        self.assertEqual(task['wo_completed'], 1)
+        self.assertEqual(task['actual_quantity'], 3)
+        task = json.loads(self.app.get('/tasks/2').data)
+        self.assertEqual((task['status'], task['wo_not_started'],
+                          task['wo_target_quantity']),
+                         (planner.models.Status.NOTSTARTED, 0, 0))
+
+    def test_prefork(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        script = (
+            'import sys, planner.views as views\n'
+            'views.app.config.update(DATABASE = sys.argv[1], WORKERS = 2, '
+            'WORKER_TIMEOUT = 5, SHUTDOWN_TIMEOUT = 2)\n'
+            'views.configure_db(views.app)\n'
+            'views.serve(views.app, ("127.0.0.1", int(sys.argv[2])))\n')
+        master = subprocess.Popen([sys.executable, '-c', script,
+                                   planner.views.app.config['DATABASE'],
+                                   str(port)])
+
+        def workers():
+            return set(int(pid) for pid in subprocess.Popen(
+                    ['pgrep', '-P', str(master.pid)],
+                    stdout = subprocess.PIPE).communicate()[0].split())
+
+        def get(url):
+            # A new connection per request, accepted by either worker
+            return json.loads(urllib2.urlopen('http://127.0.0.1:%d%s'
+                                              % (port, url)).read())
+
+        try:
+            for i in range(50):
+                if len(workers()) == 2:
+                    try:
+                        get('/plans')
+                        break
+                    except urllib2.URLError:
+                        pass
+                time.sleep(0.1)
+            started = workers()
+            self.assertEqual(len(started), 2)
+
+            # Every worker caches the plan list, a write through one of
+            # them is seen by all
+            for i in range(10):
+                self.assertEqual(get('/plans'), [])
+            request = urllib2.Request('http://127.0.0.1:%d/plans' % port,
+                                      json.dumps({'name': 'Plan 1'}),
+                                      {'Content-Type': 'application/json'})
+            plan = json.loads(urllib2.urlopen(request).read())
+            for i in range(10):
+                self.assertEqual([p['id'] for p in get('/plans')], [plan['id']])
+
+            # A killed worker is replaced
+            os.kill(min(started), signal.SIGKILL)
+            for i in range(50):
+                if len(workers() - started) == 1 and len(workers()) == 2:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(len(workers() - started), 1)
+            self.assertEqual(len(workers()), 2)
+            self.assertEqual(get('/plans/%d' % plan['id'])['name'], 'Plan 1')
+
+            master.send_signal(signal.SIGTERM)
+            for i in range(100):
+                if master.poll() is not None:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(master.poll(), 0)
+        finally:
+            if master.poll() is None:
+                master.kill()
+                master.wait()
+
+    def test_warm_startup(self):
+        plan = self.create_plan(1, 1)
+        planner.models.engine.dispose()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        settings = tempfile.NamedTemporaryFile(suffix = '.cfg')
+        settings.write('DATABASE = %r\n' % planner.views.app.config['DATABASE'])
+        settings.flush()
+        env = dict(os.environ, PLANNER_SETTINGS = settings.name)
+
+        # The existing data is served, not cleared and reseeded
+        start = time.time()
+        server = subprocess.Popen([sys.executable, '-m', 'planner.views',
+                                   '--host', '127.0.0.1', '--port', str(port)],
+                                  env = env)
+        try:
+            while True:
+                try:
+                    plans = json.loads(urllib2.urlopen(
+                            'http://127.0.0.1:%d/plans' % port).read())
+                    break
+                except urllib2.URLError:
+                    self.assertIsNone(server.poll())
+                    time.sleep(0.02)
+            elapsed = time.time() - start
+            self.assertEqual([p['id'] for p in plans], [plan['id']])
+            self.assertLess(elapsed, planner.views.app.config['STARTUP_BUDGET'])
+        finally:
+            server.terminate()
+            server.wait()
+
+        # A db of a newer schema is refused
+        planner.models.engine.execute(
+            planner.migrations.schema_version.update()
+            .values(version = planner.migrations.SCHEMA_VERSION + 1))
+        self.assertRaises(planner.migrations.SchemaVersionError,
+                          planner.models.init_db)
+        self.assertEqual(subprocess.call([sys.executable, '-m', 'planner.views',
+                                          '--port', str(port)], env = env), 1)
+
+    def test_client(self):
+        with planner.utils.db_session() as session:
+            item = planner.models.Inventory('corn', 15000)
+            session.add(item)
+            session.flush()
+            prod_id = item.id
+
+        server = planner.views.WSGIServer(('127.0.0.1', 0), planner.views.app,
+                                          log = None)
+        server.start()
+        client = planner.client.PlannerClient(
+            'http://127.0.0.1:%d' % server.server_port, concurrency = 4)
+        try:
+            tasks = [{'prod_id': prod_id, 'quantity': 10,
+                      'work_orders': [2] * 3}] * 120
+            plan = client.create_plan('Plan 1', tasks)
+            self.assertEqual(len(plan['tasks']), 120)
+            updates = [(wo['id'], {'actual_quantity': 1})
+                       for task in plan['tasks'][:5]
+                       for wo in task['work_orders']]
+            client.update_work_orders(updates)
+            report = client.report(plan['id'])
+            self.assertEqual(report['plans'][0]['actual_quantity'], 15)
+            # At most concurrency connections, kept alive
+            self.assertLessEqual(client.pool.idle.qsize(), 4)
+
+            # Without the batch and report endpoints
+            client.batch = client.reports = False
+            other = client.create_plan('Plan 2', tasks[:3])
+            self.assertEqual([len(task['work_orders'])
+                              for task in other['tasks']], [3, 3, 3])
+            self.assertEqual(client.report(plan['id']), report)
+            self.assertEqual(client.report(),
+                             json.loads(self.app.get('/reports/plans').data))
+
+            with self.assertRaises(planner.client.ClientError) as cm:
+                client.call('GET', '/plans/%d' % (other['id'] + 1))
+            self.assertEqual(cm.exception.status, 404)
+            self.assertFalse(cm.exception.missing)
+            with self.assertRaises(planner.client.ClientError) as cm:
+                client.call('GET', '/no_such_route')
+            self.assertTrue(cm.exception.missing)
+
+            # Plans are deleted with their tasks and work orders
+            client.delete_plan(other['id'])
+            self.assertEqual(self.app.get('/plans/%d' % other['id'])
+                             .status_code, 404)
+            self.assertEqual(len(json.loads(self.app.get('/tasks').data)), 120)
+            with self.assertRaises(planner.client.ClientError) as cm:
+                client.delete_plan(plan['id'])
+            self.assertEqual(cm.exception.status, 403)
+        finally:
+            client.close()
+            server.stop()
+
+        # Only requests the server never got are sent again
+        pool = planner.client.ConnectionPool('127.0.0.1', 1, 1)
+        sent = []
+        def send(conn, method, path, body, headers):
+            sent.append(method)
+            if len(sent) == 1:
+                raise errors.pop(0)
+            return 200, ''
+
+        pool._send = send
+        for error, resent in (
+                (httplib.BadStatusLine('No status line received'), True),
+                (socket.error(errno.ECONNRESET, 'reset'), True),
+                (socket.timeout('timed out'), False),
+                (httplib.BadStatusLine('HTTP/1.1 2000 OK'), False)):
+            errors = [error]
+            del sent[:]
+            pool.idle.put(planner.client.Connection('127.0.0.1', 1))
+            if resent:
+                self.assertEqual(pool.request('POST', '/plans'), (200, ''))
+            else:
+                self.assertRaises(type(error), pool.request, 'POST', '/plans')
+            self.assertEqual(sent, ['POST'] * (2 if resent else 1))
+
+    def test_query_plans(self):
+        # The queries of the plan, task and work order endpoints look rows
+        # up by index, none scans the task or work order table
+        plan = self.create_plan(2, 2)
+        tasks = json.loads(self.app.get('/plans/%d/tasks' % plan['id']).data)
+        work_orders = json.loads(self.app.get(
+                '/tasks/%d/work_orders' % tasks[0]['id']).data)
+
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            if executemany:
+                parameters = parameters[0]
+            if statement.lstrip().upper().startswith(('SELECT', 'UPDATE',
+                                                      'DELETE')):
+                statements.append((statement, parameters))
+
+        event.listen(planner.models.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            self.app.get('/plans/%d/tasks' % plan['id'])
+            self.app.get('/tasks/%d/work_orders' % tasks[0]['id'])
+            self.app.get('/reports/plan/%d' % plan['id'])
+            self.post_json('/tasks/%d/work_order' % tasks[0]['id'],
+                           {'target_quantity': 1})
+            self.post_json('/work_orders/%d' % work_orders[0]['id'],
+                           {'actual_quantity': 1, 'completed': True},
+                           method = 'put')
+            self.app.delete('/work_orders/%d' % work_orders[1]['id'])
+            self.app.delete('/tasks/%d' % tasks[1]['id'])
+            self.app.delete('/plans/%d' % plan['id'])
+        finally:
+            event.remove(planner.models.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+        full_scan = re.compile(r'^SCAN (TABLE )?(task|work_order)\b(?!.* USING)')
+        self.assertTrue(statements)
+        for statement, parameters in statements:
+            for row in planner.models.engine.execute(
+                    'EXPLAIN QUERY PLAN ' + statement, parameters):
+                self.assertFalse(full_scan.match(row[-1]),
+                                 '%s\n%s' % (row[-1], statement))
+
+    def test_events(self):
+        planner.views.app.config['EVENTS_HEARTBEAT'] = 0.2
+        plan = self.create_plan(1, 1)
+        other = self.create_plan(1, 1)
+        wo = json.loads(self.app.get('/work_orders').data)[0]
+
+        def parse(chunk):
+            fields = dict(line.split(': ', 1) for line in chunk.split('\n') if line)
+            return fields['id'], fields['event'], json.loads(fields['data'])
+
+        try:
+            rv = self.app.get('/events?plan_id=%d' % plan['id'],
+                              buffered = False)
+            self.assertEqual(rv.mimetype, 'text/event-stream')
+            stream = iter(rv.response)
+            start_id, name, data = parse(next(stream))
+            self.assertEqual(name, 'reset')
+
+            # A commit from another thread wakes the waiting subscriber
+            gevent.spawn_later(0.05, self.post_json,
+                               '/work_orders/%d' % wo['id'],
+                               {'actual_quantity': 2, 'completed': True},
+                               method = 'put')
+            received = [parse(next(stream)) for i in range(2)]
+            self.assertEqual([(name, data['id']) for _, name, data in received],
+                             [('task', wo['task_id']), ('work_order', wo['id'])])
+            self.assertEqual(received[0][2]['status'],
+                             planner.models.Status.COMPLETED)
+            self.assertEqual(received[1][2]['plan_id'], plan['id'])
+            # Inventory events are not filtered: the completed work order
+            # debited its product
+            _, name, data = parse(next(stream))
+            self.assertEqual((name, data['id'], data['quantity']),
+                             ('inventory', 1, 14998))
+            self.assertIn('planner_events_subscribers 1',
+                          self.app.get('/metrics').data)
+
+            # Changes of other plans are filtered out
+            self.post_json('/plans/%d/tasks' % other['id'],
+                           {'prod_id': 1, 'quantity': 1})
+            self.assertEqual(next(stream), ': keepalive\n\n')
+            rv.response.close()
+
+            # Resuming replays the events after the last one received
+            rv = self.app.get('/events', buffered = False,
+                              headers = {'Last-Event-ID': start_id})
+            stream = iter(rv.response)
+            self.assertEqual(next(stream), ': resumed\n\n')
+            self.assertEqual(parse(next(stream)), received[0])
+            rv.response.close()
+
+            # Without subscribers commits are not looked up, resuming after
+            # them gets a reset
+            feed = planner.events.event_feed
+            self.assertEqual(feed.active.value, 0)
+            last_id = feed.last_id
+            statements = []
+            def before_cursor_execute(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            event.listen(planner.models.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            try:
+                self.post_json('/work_orders/%d' % wo['id'],
+                               {'actual_quantity': 3}, method = 'put')
+            finally:
+                event.remove(planner.models.engine, 'before_cursor_execute',
+                             before_cursor_execute)
+            self.assertEqual(feed.last_id, last_id)
+            self.assertFalse([stmt for stmt in statements
+                              if 'WHERE task.id IN' in stmt])
+            rv = self.app.get('/events', buffered = False,
+                              headers = {'Last-Event-ID': received[1][0]})
+            stream = iter(rv.response)
+            self.assertEqual(next(stream), ': resumed\n\n')
+            names = [parse(chunk)[1]
+                     for chunk in iter(stream.next, ': keepalive\n\n')]
+            self.assertEqual(names[-1], 'reset')
+            rv.response.close()
+
+            rv = self.app.get('/events?last_event_id=unknown-1',
+                              buffered = False)
+            self.assertEqual(parse(next(iter(rv.response)))[1], 'reset')
+            rv.response.close()
+        finally:
+            planner.views.app.config['EVENTS_HEARTBEAT'] = 15
+
+    def test_filters_and_fields(self):
+        plan = self.create_plan(2, 2)
+        other = self.create_plan(1, 1)
+        work_orders = json.loads(self.app.get('/work_orders').data)
+        self.post_json('/work_orders/%d' % work_orders[0]['id'],
+                       {'actual_quantity': 3}, method = 'put')
+
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(planner.models.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            rv = self.app.get('/work_orders?status=in progress'
+                              '&plan_id=%d&fields=status,actual_quantity'
+                              % plan['id'])
+        finally:
+            event.remove(planner.models.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(json.loads(rv.data), [
+                {'id': work_orders[0]['id'], 'status': 'in progress',
+                 'actual_quantity': 3,
+                 'link': '/work_orders/%d' % work_orders[0]['id']}])
+        select = [stmt for stmt in statements if 'FROM work_order' in stmt][0]
+        self.assertNotIn('created_date', select.split('FROM')[0])
+        self.assertIn('work_order.status = ?', select)
+
+        tasks = json.loads(self.app.get(
+                '/tasks?plan_id=%d,%d&status=not started,in progress'
+                '&fields=actual_quantity' % (plan['id'], other['id'])).data)
+        self.assertEqual([sorted(task) for task in tasks],
+                         [['actual_quantity', 'id', 'link']] * 3)
+        self.assertEqual(sorted(task['actual_quantity'] for task in tasks),
+                         [0, 0, 3])
+
+        self.assertEqual(len(json.loads(self.app.get(
+                '/work_orders?product_id=1&created_after=2000-01-01').data)), 4)
+        self.assertEqual(json.loads(self.app.get(
+                '/plans?created_before=2000-01-01T00:00:00').data), [])
+        self.assertEqual(self.app.get('/tasks?status=done').status_code, 400)
+        self.assertEqual(self.app.get('/plans?fields=nope').status_code, 400)
+        self.assertEqual(self.app.get(
+                '/work_orders?created_after=yesterday').status_code, 400)
+
+        # The plan filter joins the tasks, moving a task changes the result
+        url = '/work_orders?plan_id=%d' % other['id']
+        self.assertEqual(len(json.loads(self.app.get(url).data)), 1)
+        task = json.loads(self.app.get('/plans/%d/tasks' % plan['id']).data)[0]
+        self.post_json('/tasks/%d' % task['id'], {'plan_id': other['id']},
+                       method = 'put')
+        self.assertEqual(len(json.loads(self.app.get(url).data)), 3)
+
+    def test_admission_control(self):
+        plan = self.create_plan(1, 1)
+        wo = json.loads(self.app.get('/work_orders').data)[0]
+        config = planner.views.app.config
+        config.update(ADMISSION_LIMITS = {'report': (1, 1), 'write': (2, 10)},
+                      ADMISSION_TIMEOUT = 0.5, ADMISSION_RETRY_AFTER = 3)
+        planner.views.configure_db(planner.views.app)
+        reports = planner.admission.admission_control.limiters['report']
+        try:
+            # A slow report holds the only report slot
+            self.assertIsNone(reports.acquire(0))
+            queued = gevent.spawn(self.app.get, '/reports/plans')
+            gevent.sleep(0.01)
+            self.assertEqual(reports.waiting, 1)
+
+            # The queue is full, the next report is shed at once
+            start = time.time()
+            rv = self.app.get('/reports/plan/%d' % plan['id'])
+            self.assertEqual(rv.status_code, 503)
+            self.assertEqual(rv.headers['Retry-After'], '3')
+            self.assertLess(time.time() - start, 0.1)
+
+            # Reads and writes have their own limits
+            rv = self.app.put('/work_orders/%d' % wo['id'],
+                              data = json.dumps({'actual_quantity': 1}),
+                              content_type = 'application/json')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(self.app.get('/plans').status_code, 200)
+
+            reports.release()
+            self.assertEqual(queued.get().status_code, 200)
+
+            # Waiting longer than the timeout is rejected too
+            self.assertIsNone(reports.acquire(0))
+            self.assertEqual(self.app.get('/reports/plans').status_code, 503)
+            reports.release()
+
+            text = self.app.get('/metrics').data
+            self.assertIn('planner_admission_rejected_total{class="report",'
+                          'reason="queue_full"} 1', text)
+            self.assertIn('planner_admission_rejected_total{class="report",'
+                          'reason="timeout"} 1', text)
+            self.assertIn('planner_admission_admitted_total{class="write"} 1',
+                          text)
+            self.assertIn('planner_admission_active{class="report"} 0', text)
+        finally:
+            config['ADMISSION_LIMITS'] = {}
+            planner.admission.configure({})
+
+    def test_report(self):
+        plan = self.create_plan(2, 2)
+        other = self.create_plan(1, 1)
+        report = json.loads(self.app.get('/reports/plan/%d' % plan['id']).data)
+        self.assertEqual(len(report['plans']), 1)
+        self.assertEqual(report['plans'][0]['planned_quantity'], 20)
+        self.assertEqual(report['plans'][0]['actual_quantity'], 0)
+        self.assertEqual(len(report['plans'][0]['tasks']), 2)
+        self.assertEqual(self.app.get('/reports/plan/999').status_code, 404)
+        self.assertNotIn(999, planner.reports.report_cache.reports)
+
+        with planner.utils.db_session() as session:
+            session.add(planner.models.Inventory('unused', 7))
+        self.app.get('/reports/plan/%d' % other['id'])
+        all_plans = json.loads(self.app.get('/reports/plans').data)
+        self.assertEqual([p['id'] for p in all_plans['plans']],
+                         [plan['id'], other['id']])
+        # Every product is in the report of every plan, only the products
+        # used in the report of a plan
+        self.assertEqual([(item['product_name'], item['quantity'])
+                          for item in all_plans['inventory']],
+                         [('corn', 15000), ('corn', 15000), ('unused', 7)])
+        self.assertEqual([item['product_id'] for item in report['inventory']],
+                         [1])
+
+        # Cached reports are served without querying the db
+        report, count = self.count_queries('/reports/plan/%d' % plan['id'])
+        self.assertEqual(count, 0)
+
+        # A work order change only invalidates the report of its plan
+        task = report['plans'][0]['tasks'][0]
+        wo = json.loads(self.app.get('/tasks/%d/work_orders'
+                                     % task['id']).data)[0]
+        self.post_json('/work_orders/%d' % wo['id'], {'actual_quantity': 3},
+                       method = 'put')
+        report, count = self.count_queries('/reports/plan/%d' % other['id'])
+        self.assertEqual(count, 0)
+        report, count = self.count_queries('/reports/plan/%d' % plan['id'])
+        self.assertTrue(count > 0)
+        self.assertEqual(report['plans'][0]['actual_quantity'], 3)
+        self.assertEqual(report['plans'][0]['tasks'][0]['status'],
+                         planner.models.Status.INPROGRESS)
+        all_plans, count = self.count_queries('/reports/plans')
+        self.assertTrue(count > 0)
+
+    def test_conditional_get(self):
+        plan = self.create_plan(2, 1)
+        rv = self.app.get('/tasks')
+        etag = rv.headers['ETag']
+
+        tasks, count = self.count_queries('/tasks')
+        self.assertEqual(count, 0)
+        rv = self.app.get('/tasks', headers = {'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertNotEqual(self.app.get('/tasks?limit=1').headers['ETag'],
+                            etag)
+
+        # Writing a work order changes the task rollups
+        wo = json.loads(self.app.get('/work_orders').data)[0]
+        self.post_json('/work_orders/%d' % wo['id'], {'actual_quantity': 1},
+                       method = 'put')
+        rv = self.app.get('/tasks', headers = {'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+        self.assertEqual(json.loads(rv.data)[0]['actual_quantity'], 1)
+
+    def test_response_cache_size(self):
+        self.create_plan(3, 0)
+        planner.views.app.config['RESPONSE_CACHE_SIZE'] = 2
+        try:
+            for task_id in (1, 2, 3):
+                self.app.get('/tasks/%d' % task_id)
+            self.assertEqual(len(planner.cache.response_cache.entries), 2)
+            task, count = self.count_queries('/tasks/1')
+            self.assertTrue(count > 0)
+            task, count = self.count_queries('/tasks/3')
+            self.assertEqual(count, 0)
+        finally:
+            planner.views.app.config['RESPONSE_CACHE_SIZE'] = 1024
+
+    def test_import_inventory(self):
+        ret = planner.utils.populate_inventory()
+        self.assertEqual(ret['inserted'], 6)
+
+        lines = ['corn,100', 'wheat, 20', 'bad line', 'rye,-1', '', 'oats,x']
+        ret = planner.utils.import_inventory(iter(lines), chunk_size = 1,
+                                             commit_every = 2)
+        self.assertEqual((ret['inserted'], ret['updated'], ret['rejected']),
+                         (1, 1, 3))
+        self.assertEqual([line['line'] for line in ret['rejected_lines']],
+                         [3, 4, 6])
+
+        rv = self.app.post('/inventory/import', data = 'corn,5\nsorghum,7\n')
+        ret = json.loads(rv.data)
+        self.assertEqual((ret['inserted'], ret['updated']), (1, 1))
+
+        inventory = dict((item['product_name'], item['quantity']) for item in
+                         json.loads(self.app.get('/inventory').data))
+        self.assertEqual(inventory['corn'], 5)
+        self.assertEqual(inventory['wheat'], 20)
+        self.assertEqual(inventory['sorghum'], 7)
+        self.assertEqual(inventory['herbicide1'], 150)
+        self.assertEqual(len(inventory), 8)
+
+    def test_export(self):
+        config = planner.views.app.config
+        config['EXPORT_CHUNK_SIZE'] = 3
+        try:
+            self.create_plan(3, 2)
+            work_orders = json.loads(self.app.get('/work_orders').data)
+            rv = self.app.get('/export/work_order')
+            self.assertEqual(rv.mimetype, 'application/x-ndjson')
+            self.assertEqual([json.loads(line) for line in rv.data.splitlines()],
+                             [dict((k, v) for k, v in wo.items() if k != 'link')
+                              for wo in work_orders])
+            watermark = rv.headers['X-Export-Watermark']
+            self.assertEqual(int(watermark), work_orders[-1]['id'])
+
+            rv = self.app.get('/export/task?format=csv',
+                              headers = {'Accept-Encoding': 'gzip'})
+            self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+            rows = list(csv.DictReader(StringIO(
+                        gzip.GzipFile(fileobj = StringIO(rv.data)).read())))
+            self.assertEqual(len(rows), 3)
+            self.assertEqual(rows[0]['status'], planner.models.Status.NOTSTARTED)
+
+            # Incremental exports after the watermark
+            self.create_plan(1, 1)
+            rv = self.app.get('/export/work_order?since=%s' % watermark)
+            self.assertEqual(len(rv.data.splitlines()), 1)
+            rv = self.app.get('/export/plan?since=2000-01-01')
+            self.assertEqual(len(rv.data.splitlines()), 2)
+            rv = self.app.get('/export/plan?since=%s'
+                              % rv.headers['X-Export-Watermark'])
+            self.assertEqual((rv.data, rv.headers.get('X-Export-Watermark')),
+                             ('', None))
+
+            self.assertEqual(self.app.get('/export/users').status_code, 404)
+            self.assertEqual(self.app.get('/export/plan?format=xml')
+                             .status_code, 400)
+            self.assertEqual(self.app.get('/export/plan?since=yesterday')
+                             .status_code, 400)
+
+            output = tempfile.NamedTemporaryFile()
+            self.assertEqual(planner.manage.main(
+                    ['export', 'central_inventory', '--format', 'csv',
+                     '--output', output.name]), 0)
+            self.assertEqual(open(output.name).read().splitlines()[:2],
+                             ['id,product_name,quantity', '1,corn,15000'])
+        finally:
+            config['EXPORT_CHUNK_SIZE'] = 5000
+
+    def test_metrics(self):
+        self.create_plan(2, 2)
+        self.app.get('/tasks')
+        self.app.get('/tasks?stream=true').data
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('# TYPE planner_requests_total counter\n', rv.data)
+        self.assertIn('# TYPE planner_request_latency_seconds histogram\n',
+                      rv.data)
+
+        samples = {}
+        for line in rv.data.splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+
+        self.assertEqual(samples['planner_requests_total{endpoint="get_tasks"}'], 2)
+        self.assertEqual(samples['planner_request_latency_seconds_bucket{endpoint="get_tasks",le="+Inf"}'], 2)
+        self.assertGreaterEqual(samples['planner_db_statements_total{endpoint="get_tasks"}'], 2)
+        self.assertGreater(samples['planner_db_seconds_total{endpoint="get_tasks"}'], 0)
+        self.assertEqual(samples['planner_db_rows_total{endpoint="get_tasks"}'], 4)
+
+        # Failed statements do not leave their start time on the connection
+        with planner.models.engine.connect() as conn:
+            for i in range(2):
+                self.assertRaises(Exception, conn.execute,
+                                  'SELECT * FROM no_such_table')
+            self.assertEqual(conn.info['metrics_start'], [])
+
+    def test_row_serializers(self):
+        self.create_plan(1, 2)
+        created = re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(\.\d{6})?$')
+        work_order = {'status': 'not started', 'actual_quantity': 0,
+                      'task_id': 1, 'target_quantity': 1}
+        for url, expected in (
+                ('/inventory', [{'id': 1, 'product_name': 'corn',
+                                 'quantity': 15000}]),
+                ('/plans', [{'id': 1, 'name': 'Plan 1'}]),
+                ('/tasks', [{'id': 1, 'plan_id': 1, 'product_id': 1,
+                             'status': 'not started', 'target_quantity': 10,
+                             'actual_quantity': 0, 'wo_not_started': 2,
+                             'wo_in_progress': 0, 'wo_completed': 0,
+                             'wo_target_quantity': 2,
+                             'wo_actual_quantity': 0}]),
+                ('/work_orders', [dict(work_order, id = 1),
+                                  dict(work_order, id = 2)])):
+            rows = json.loads(self.app.get(url).data)
+            for row, values in zip(rows, expected):
+                values['link'] = '%s/%d' % (url, values['id'])
+                if 'created_date' in row:
+                    # Datetimes are serialized with str()
+                    self.assertRegexpMatches(row['created_date'], created)
+                    values['created_date'] = row['created_date']
+            self.assertEqual(rows, expected)
+
+    def test_db_pool(self):
+        # A greenlet waiting on a pool thread does not block the hub
+        slow = gevent.spawn(planner.dbpool.run, time.sleep, 0.5)
+        gevent.sleep(0.05)
+        start = time.time()
+        rv = self.app.get('/metrics')
+        self.assertLess(time.time() - start, 0.4)
+        self.assertIn('planner_db_pool_active 1', rv.data)
+        slow.join()
+
+        self.create_plan(1, 1)
+        self.assertEqual(len(json.loads(self.app.get('/tasks').data)), 1)
+        rv = self.app.get('/tasks/999')
+        self.assertEqual(rv.status_code, 404)
+        self.assertIn('planner_db_pool_active 0', self.app.get('/metrics').data)
+
+    def test_group_commit(self):
+        plan = self.create_plan(1, 8)
+        task = json.loads(self.app.get('/plans/%d/tasks' % plan['id']).data)[0]
+        work_orders = json.loads(self.app.get(
+                '/tasks/%d/work_orders' % task['id']).data)
+
+        def update(work_id):
+            rv = self.app.put('/work_orders/%d' % work_id,
+                              data = json.dumps({'actual_quantity': 1,
+                                                 'completed': True}),
+                              content_type = 'application/json')
+            return rv.status_code
+
+        writer = planner.writer.group_writer
+        batches, operations = writer.batches, writer.operations
+        planner.views.app.config['GROUP_COMMIT'] = True
+        try:
+            # A failing update only fails its own request
+            ids = [wo['id'] for wo in work_orders] + [999]
+            greenlets = [gevent.spawn(update, work_id) for work_id in ids]
+            gevent.joinall(greenlets)
+        finally:
+            planner.views.app.config['GROUP_COMMIT'] = False
+
+        self.assertEqual([g.value for g in greenlets], [200] * 8 + [404])
+        task = json.loads(self.app.get('/tasks/%d' % task['id']).data)
+        self.assertEqual(task['wo_completed'], 8)
+        self.assertEqual(task['actual_quantity'], 8)
+        with planner.utils.db_session() as session:
+            self.assertEqual(planner.utils.check_task_rollups(session), [])
+
+        # Every update went through the writer, several per batch
+        self.assertEqual(writer.operations - operations, 9)
+        self.assertLess(writer.batches - batches, 9)
+
 if __name__ == '__main__':
     unittest.main()